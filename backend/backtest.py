@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Time-ordered backtest of a model set, for tuning THRESHOLD.
+
+Replays a labeled pipe-delimited CSV in file order through FraudScorer with
+the in-memory history, and each --batch rows are scored with one
+(cascade-aware) predict call. The file must be in time order up to the
+history's lateness window, as on the live stream, so features only see the
+past: a row more than HISTORY_LATENESS older than the newest row before it
+aborts the run before it is scored (sort the file by unix_time first). Memory is bounded by the
+history retention window, not by the size of the file.
+
+Scores are counted into per-label histograms with one bin per threshold
+k/--bins, so precision, recall, F1 and cost at every threshold come from one
+reverse cumulative sum at the end instead of a sort over all scores;
+--threshold is also counted exactly. Rows are grouped into --window seconds
+of unix_time for drift: volume, fraud and flag rates, precision and recall
+at --threshold, mean score, and the PSI of the score distribution against
+the first window.
+
+    python backtest.py --input ../hackathon_test.csv --model ../model.pkl --json backtest.json
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import resource
+import sys
+import time
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+
+from scoring import FraudScorer, MODEL_PATH, FEATURES_PATH, FAST_MODEL_PATH, CASCADE_LOW, CASCADE_HIGH, THRESHOLD
+from features import HISTORY_LATENESS, to_float, to_int
+from train_model import coerce_label
+
+PSI_BINS = 10
+
+# =========
+# THRESHOLD
+# =========
+
+class Sweep:
+    """Score histograms per label; flagged at threshold t means proba >= t, as in decide_flag."""
+
+    def __init__(self, bins: int):
+        self.thresholds = np.arange(bins + 1) / bins
+        self.pos = np.zeros(bins + 1, dtype=np.int64)
+        self.neg = np.zeros(bins + 1, dtype=np.int64)
+        self.pos_amount = np.zeros(bins + 1)
+
+    def add(self, p: np.ndarray, y: np.ndarray, amt: np.ndarray):
+        # Bin k holds thresholds[k] <= p < thresholds[k + 1], so "bins >= k" is exactly p >= thresholds[k].
+        idx = np.clip(np.searchsorted(self.thresholds, p, side="right") - 1, 0, len(self.thresholds) - 1)
+        n = len(self.thresholds)
+        self.pos += np.bincount(idx[y == 1], minlength=n)
+        self.neg += np.bincount(idx[y == 0], minlength=n)
+        self.pos_amount += np.bincount(idx[y == 1], weights=amt[y == 1], minlength=n)
+
+    def table(self, fp_cost: float, fn_cost: float, amount_cost: float) -> Dict[str, np.ndarray]:
+        tp = self.pos[::-1].cumsum()[::-1]
+        fp = self.neg[::-1].cumsum()[::-1]
+        caught = self.pos_amount[::-1].cumsum()[::-1]
+        return metrics(tp, fp, self.pos.sum() - tp, self.neg.sum() - fp, caught,
+                       self.pos_amount.sum() - caught, fp_cost, fn_cost, amount_cost)
+
+def metrics(tp, fp, fn, tn, caught, missed, fp_cost: float, fn_cost: float, amount_cost: float
+            ) -> Dict[str, np.ndarray]:
+    """Precision, recall, F1 and cost from confusion counts (scalars or arrays)."""
+    tp, fp, fn, tn = (np.asarray(v, dtype=float) for v in (tp, fp, fn, tn))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return {"tp": tp, "fp": fp, "fn": fn, "tn": tn, "flagged": tp + fp, "precision": precision,
+            "recall": recall, "f1": f1, "caught_amount": np.asarray(caught), "missed_amount": np.asarray(missed),
+            "cost": fp_cost * fp + fn_cost * fn + amount_cost * np.asarray(missed)}
+
+def row_at(table: Dict[str, np.ndarray], i=None) -> Dict[str, Any]:
+    def value(v):
+        v = v if i is None else v[i]
+        return int(v) if float(v).is_integer() else round(float(v), 6)
+    return {k: value(v) for k, v in table.items()}
+
+# =====
+# DRIFT
+# =====
+
+class Drift:
+    """Per-window counters, keyed by unix_time // window."""
+
+    def __init__(self, window: int, threshold: float):
+        self.window = window
+        self.threshold = threshold
+        self.windows: Dict[int, Dict[str, Any]] = {}
+
+    def add(self, ux: np.ndarray, p: np.ndarray, y: np.ndarray):
+        wid = ux // self.window
+        for w in np.unique(wid):
+            m = wid == w
+            pw, yw = p[m], y[m]
+            flag = pw >= self.threshold
+            c = self.windows.get(int(w))
+            if c is None:
+                c = self.windows[int(w)] = {"n": 0, "labeled": 0, "fraud": 0, "flagged": 0, "labeled_flags": 0,
+                                            "tp": 0, "proba_sum": 0.0, "hist": np.zeros(PSI_BINS, dtype=np.int64)}
+            c["n"] += len(pw)
+            c["labeled"] += int((yw >= 0).sum())
+            c["fraud"] += int((yw == 1).sum())
+            c["flagged"] += int(flag.sum())
+            c["labeled_flags"] += int((flag & (yw >= 0)).sum())
+            c["tp"] += int((flag & (yw == 1)).sum())
+            c["proba_sum"] += float(pw.sum())
+            c["hist"] += np.bincount(np.minimum((pw * PSI_BINS).astype(int), PSI_BINS - 1), minlength=PSI_BINS)
+
+    def rows(self) -> List[Dict[str, Any]]:
+        if not self.windows:
+            return []
+        ref = self.windows[min(self.windows)]["hist"]
+        ref = np.maximum(ref / max(1, ref.sum()), 1e-4)
+        out = []
+        for w in sorted(self.windows):
+            c = self.windows[w]
+            cur = np.maximum(c["hist"] / max(1, c["hist"].sum()), 1e-4)
+            out.append({
+                "start": w * self.window,
+                "n": c["n"],
+                "fraud_rate": round(c["fraud"] / c["labeled"], 6) if c["labeled"] else None,
+                "flag_rate": round(c["flagged"] / c["n"], 6),
+                "precision": round(c["tp"] / c["labeled_flags"], 6) if c["labeled_flags"] else None,
+                "recall": round(c["tp"] / c["fraud"], 6) if c["fraud"] else None,
+                "mean_proba": round(c["proba_sum"] / c["n"], 6),
+                "psi": round(float(((cur - ref) * np.log(cur / ref)).sum()), 6),
+            })
+        return out
+
+# ======
+# REPLAY
+# ======
+
+def read_chunks(path: str, size: int, limit: int) -> Iterator[List[Dict[str, str]]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = csv.DictReader(f, delimiter="|")
+        if limit > 0:
+            rows = itertools.islice(rows, limit)
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if not chunk:
+                return
+            yield chunk
+
+def run(args) -> Dict[str, Any]:
+    scorer = FraudScorer(args.model, args.features, history="memory", db_ttl=0, checkpoint="", replay=False,
+                         fast_model_path=args.fast_model, cascade=(args.cascade_low, args.cascade_high),
+                         write_behind=False)
+    sweep = Sweep(args.bins)
+    drift = Drift(args.window, args.threshold)
+    exact = np.zeros(4, dtype=np.int64)  # tp, fp, fn, tn at --threshold
+    exact_amount = np.zeros(2)  # caught, missed fraud amount
+    stats = {"rows": 0, "labeled": 0, "errors": 0, "out_of_order": 0}
+    stages = {"features_ms": 0.0, "inference_ms": 0.0}
+    newest, read = None, 0
+    t0 = time.perf_counter()
+    for chunk in read_chunks(args.input, args.batch, args.limit):
+        # Checked before scoring: predict_many stores each row as it goes.
+        for tx in chunk:
+            read += 1
+            t = to_int(tx.get("unix_time")) or 0
+            if newest is not None and t < newest:
+                if t < newest - HISTORY_LATENESS:
+                    raise SystemExit(
+                        f"{args.input}: row {read} (unix_time {t}) is {newest - t}s older than an earlier row, "
+                        f"more than the "
+                        f"{HISTORY_LATENESS}s the history accepts; sort the input by unix_time")
+                stats["out_of_order"] += 1
+            newest = t if newest is None else max(newest, t)
+        timings: Dict[str, float] = {}
+        verdicts = scorer.predict_many([(tx, 1) for tx in chunk], timings, with_features=False)
+        for k in stages:
+            stages[k] += timings.get(k, 0.0)
+        p, y, amt, ux = [], [], [], []
+        for tx, v in zip(chunk, verdicts):
+            if isinstance(v, Exception):
+                stats["errors"] += 1
+                continue
+            t = to_int(tx.get("unix_time")) or 0
+            label = coerce_label(tx.get("is_fraud"))
+            p.append(float(v["is_fraud"]) if v["proba"] is None else v["proba"])
+            y.append(-1 if label is None else label)
+            amt.append(to_float(tx.get("amt")) or 0.0)
+            ux.append(t)
+        if not p:
+            continue
+        p, y, amt, ux = np.array(p), np.array(y, dtype=np.int64), np.array(amt), np.array(ux, dtype=np.int64)
+        stats["rows"] += len(p)
+        labeled = y >= 0
+        stats["labeled"] += int(labeled.sum())
+        sweep.add(p[labeled], y[labeled], amt[labeled])
+        drift.add(ux, p, y)
+        flag, pos = p >= args.threshold, y == 1
+        exact += [(flag & pos).sum(), (flag & (y == 0)).sum(), (~flag & pos).sum(), (~flag & (y == 0)).sum()]
+        exact_amount += [amt[flag & pos].sum(), amt[~flag & pos].sum()]
+        if args.progress and stats["rows"] // args.progress != (stats["rows"] - len(p)) // args.progress:
+            print(f"...{stats['rows']} rows, {stats['rows'] / (time.perf_counter() - t0):.0f} rows/s",
+                  file=sys.stderr)
+    elapsed = time.perf_counter() - t0
+    scorer.close()
+
+    costs = (args.fp_cost, args.fn_cost, args.amount_cost)
+    table = sweep.table(*costs)
+    best_f1 = int(np.argmax(table["f1"]))
+    min_cost = int(np.argmin(table["cost"]))
+    stats["fraud"] = int(sweep.pos.sum())
+    return {
+        **stats,
+        "seconds": round(elapsed, 3),
+        "rows_per_s": round(stats["rows"] / elapsed, 1) if elapsed else 0.0,
+        "features_s": round(stages["features_ms"] / 1e3, 3),
+        "inference_s": round(stages["inference_ms"] / 1e3, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "costs": dict(zip(("fp", "fn", "amount"), costs)),
+        "at_threshold": {"threshold": args.threshold, **row_at(metrics(*exact, *exact_amount, *costs))},
+        "best_f1": {"threshold": float(sweep.thresholds[best_f1]), **row_at(table, best_f1)},
+        "min_cost": {"threshold": float(sweep.thresholds[min_cost]), **row_at(table, min_cost)},
+        "sweep": [{"threshold": float(t), **row_at(table, i)} for i, t in enumerate(sweep.thresholds)],
+        "drift": drift.rows(),
+    }
+
+# =========
+# REPORTING
+# =========
+
+def print_row(name: str, r: Dict[str, Any]):
+    print(f"{name:<14} {r['threshold']:>9.3f} {r['flagged']:>9} {r['precision']:>9.4f} {r['recall']:>9.4f} "
+          f"{r['f1']:>9.4f} {r['cost']:>12.1f} {r['missed_amount']:>14.2f}")
+
+def report(res: Dict[str, Any], step: float):
+    print(f"Rows {res['rows']} | labeled {res['labeled']} | fraud {res['fraud']} | errors {res['errors']} "
+          f"| out of order {res['out_of_order']}")
+    print(f"{res['seconds']:.1f}s ({res['rows_per_s']:.0f} rows/s; features {res['features_s']:.1f}s, "
+          f"inference {res['inference_s']:.1f}s) | peak RSS {res['peak_rss_mb']:.0f} MB\n")
+    print(f"{'':<14} {'threshold':>9} {'flagged':>9} {'precision':>9} {'recall':>9} {'f1':>9} {'cost':>12} "
+          f"{'missed amt':>14}")
+    print_row("at --threshold", res["at_threshold"])
+    print_row("best F1", res["best_f1"])
+    print_row("min cost", res["min_cost"])
+    every = max(1, round(step * (len(res["sweep"]) - 1)))
+    for r in res["sweep"][::every]:
+        print_row("", r)
+    if res["drift"]:
+        print(f"\n{'window start':<14} {'n':>9} {'fraud/n':>9} {'flag/n':>9} {'precision':>9} {'recall':>9} "
+              f"{'mean p':>9} {'psi':>9}")
+        fmt = lambda v: f"{v:>9.4f}" if v is not None else f"{'-':>9}"
+        for d in res["drift"]:
+            print(f"{d['start']:<14} {d['n']:>9} {fmt(d['fraud_rate'])} {fmt(d['flag_rate'])} "
+                  f"{fmt(d['precision'])} {fmt(d['recall'])} {fmt(d['mean_proba'])} {fmt(d['psi'])}")
+
+# ====
+# MAIN
+# ====
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Time-ordered backtest and threshold sweep")
+    ap.add_argument("--input", required=True,
+                    help="Pipe-delimited CSV with header and is_fraud, in time order (up to 1h late)")
+    ap.add_argument("--model", default=MODEL_PATH)
+    ap.add_argument("--features", default=FEATURES_PATH)
+    ap.add_argument("--fast-model", default=FAST_MODEL_PATH, help="Cascade first stage (\"\" = off)")
+    ap.add_argument("--cascade-low", type=float, default=CASCADE_LOW)
+    ap.add_argument("--cascade-high", type=float, default=CASCADE_HIGH)
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--batch", type=int, default=2048, help="Rows per scoring call")
+    ap.add_argument("--threshold", type=float, default=THRESHOLD, help="Current threshold, counted exactly")
+    ap.add_argument("--bins", type=int, default=1000, help="Sweep thresholds 0, 1/bins, ..., 1")
+    ap.add_argument("--fp-cost", type=float, default=1.0, help="Cost of a false alarm")
+    ap.add_argument("--fn-cost", type=float, default=10.0, help="Cost of a missed fraud")
+    ap.add_argument("--amount-cost", type=float, default=0.0, help="Cost per unit of missed fraud amount")
+    ap.add_argument("--window", type=int, default=86400, help="Drift window in seconds of unix_time")
+    ap.add_argument("--step", type=float, default=0.05, help="Threshold step of the printed sweep")
+    ap.add_argument("--progress", type=int, default=100000, help="Progress line every N rows (0 = off)")
+    ap.add_argument("--json", default="", help="Write results, including the full sweep, to this file")
+    args = ap.parse_args()
+    if args.bins < 1 or args.batch < 1 or args.window < 1:
+        ap.error("--bins, --batch and --window must be positive")
+
+    res = run(args)
+    report(res, args.step)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(res, f, indent=2)
+        print(f"Saved results -> {args.json}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
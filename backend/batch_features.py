@@ -0,0 +1,251 @@
+"""
+Columnar feature builder for offline training.
+
+Produces the same FEATURE_ORDER matrix as running tx_to_features_mem /
+add_to_history over the rows in time order, but with NumPy/pandas column
+operations instead of a Python loop per row:
+
+  * scalar parsing (amounts, dates, times) runs once per distinct string
+    through the same helpers the online path uses;
+  * window counts come from searchsorted over per-card sorted timestamps;
+  * 24h amount stats come from differences of exact (fixed_amount) prefix sums;
+  * distinct merchants/categories come from previous-occurrence indices.
+
+Transcendental functions and powers go through `math` (libm), because
+NumPy's SIMD kernels differ from it in the last ulp and the matrix must match the
+online path bit for bit. Every row sees the card's whole past: the online
+history evicts entries but keeps each card's summary (last time, merchants
+seen) however long it stays idle, so both agree on cards that come back
+after any gap. `python bench.py parity` checks this, including such cards.
+"""
+
+import math
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from features import (
+    to_float, to_int, to_amount, fixed_amount, amount_stats, hour_of_day, dow_from_date, parse_date,
+    VELOCITY_WINDOWS, DISTINCT_WINDOW, STATS_WINDOW, NEVER, FEATURE_ORDER, MIN_UNIX, MAX_UNIX,
+)
+
+# =======
+# HELPERS
+# =======
+
+def _text(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series([""] * len(df), index=df.index, dtype=object)
+    return df[col].fillna("").astype(str)
+
+def map_unique(s: pd.Series, fn, dtype=float) -> np.ndarray:
+    """Apply a scalar helper once per distinct value and broadcast back."""
+    codes, uniques = pd.factorize(s, sort=False)
+    vals = np.array([fn(u) for u in uniques], dtype=dtype)
+    if len(vals) == 0:
+        return np.zeros(len(s), dtype=dtype)
+    return vals[codes]
+
+def _libm(fn, *arrays) -> np.ndarray:
+    return np.frompyfunc(fn, len(arrays), 1)(*arrays).astype(float)
+
+def haversine_km_vec(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Vectorized haversine_km with identical rounding."""
+    R = 6371.0
+    phi1 = np.radians(lat1); phi2 = np.radians(lat2)
+    dphi = np.radians(lat2 - lat1)
+    dlmb = np.radians(lon2 - lon1)
+    # `x**2` on Python floats is libm pow(), which is not always x*x.
+    a = (_libm(math.pow, _libm(math.sin, dphi / 2), 2.0)
+         + _libm(math.cos, phi1) * _libm(math.cos, phi2) * _libm(math.pow, _libm(math.sin, dlmb / 2), 2.0))
+    with np.errstate(invalid="ignore"):
+        return 2 * R * _libm(math.asin, np.sqrt(a))
+
+def _dob_parts(dob: str):
+    d = parse_date(dob) if dob else None
+    return (d.year, d.month, d.day) if d is not None else (-1, -1, -1)
+
+def compute_age_vec(dob: pd.Series, ux: np.ndarray) -> np.ndarray:
+    """compute_age for whole columns: dob parsed once per distinct value, dates from unix time."""
+    codes, uniques = pd.factorize(dob, sort=False)
+    parts = np.array([_dob_parts(u) for u in uniques], dtype=np.int64)
+    dy, dm, dd = parts[codes].T
+
+    ok = (dy >= 0) & (ux >= MIN_UNIX) & (ux <= MAX_UNIX)
+    days = np.where(ok, ux, 0).astype("datetime64[s]").astype("datetime64[D]")
+    ty = days.astype("datetime64[Y]").astype(np.int64) + 1970
+    tm = days.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    td = (days - days.astype("datetime64[M]")).astype(np.int64) + 1
+    before = (tm < dm) | ((tm == dm) & (td < dd))
+    years = ty - dy - before.astype(np.int64)
+    return np.where(ok, np.maximum(0, years), -1)
+
+# ===============
+# HISTORY WINDOWS
+# ===============
+
+def _window_features(cc_codes: np.ndarray, ux: np.ndarray, fixed: np.ndarray,
+                     has_amount: np.ndarray, merch_codes: np.ndarray, cat_codes: np.ndarray):
+    """
+    History features for rows given in time order (stable). Entry j is visible
+    to row i of the same card iff ux[j] < ux[i], which is exactly what the
+    online path sees when rows are featurized before being added.
+    """
+    n = len(ux)
+    # Card-major, time-minor order; positions of the same card are contiguous.
+    order = np.lexsort((np.arange(n), ux, cc_codes))
+    c = cc_codes[order]; t = ux[order]
+    shift = int(t.min()) - STATS_WINDOW - 1
+    span = int(t.max()) - shift + 1
+    key = c.astype(np.int64) * span + (t - shift)
+    starts = np.searchsorted(c, c, side="left")
+
+    def first_at_or_after(bound):
+        return np.maximum(np.searchsorted(key, c * span + (bound - shift), side="left"), starts)
+
+    hi = first_at_or_after(t)
+    lo = {w: first_at_or_after(t - w) for w in VELOCITY_WINDOWS + (STATS_WINDOW,)}
+
+    res = {}
+    for name, w in zip(("velocity_60s", "velocity_5m", "velocity_15m", "velocity_1h"), VELOCITY_WINDOWS):
+        res[name] = hi - lo[w]
+
+    # Distinct values in [lo, hi): count entries whose previous occurrence is before lo.
+    def distinct(codes):
+        v = codes[order]
+        pair_order = np.lexsort((np.arange(n), v, c))
+        prev = np.full(n, -1, dtype=np.int64)
+        same = (c[pair_order][1:] == c[pair_order][:-1]) & (v[pair_order][1:] == v[pair_order][:-1])
+        prev[pair_order[1:][same]] = pair_order[:-1][same]
+        lo15 = lo[DISTINCT_WINDOW]
+        count = np.zeros(n, dtype=np.int64)
+        rows = np.nonzero(hi > lo15)[0]
+        j = hi[rows] - 1
+        while len(rows):
+            count[rows] += prev[j] < lo15[rows]
+            keep = j > lo15[rows]
+            rows, j = rows[keep], j[keep] - 1
+        return count
+
+    res["unique_merchants_15m"] = distinct(merch_codes)
+    res["unique_categories_15m"] = distinct(cat_codes)
+
+    # Last transaction strictly before ux.
+    has_last = hi > starts
+    prev_t = t[np.maximum(hi - 1, 0)]
+    res["time_since_last_s"] = np.where(has_last, np.maximum(0, t - prev_t), NEVER)
+
+    # Merchant facts: (card, merchant) groups sorted by time.
+    m = merch_codes[order]
+    pm_order = np.lexsort((np.arange(n), t, m, c))
+    pair = np.zeros(n, dtype=np.int64)
+    pc, pmv = c[pm_order], m[pm_order]
+    pair[1:] = np.cumsum((pc[1:] != pc[:-1]) | (pmv[1:] != pmv[:-1]))
+    pt = t[pm_order]
+    pkey = pair * span + (pt - shift)
+    pstarts = np.searchsorted(pair, pair, side="left")
+    row_pair = np.empty(n, dtype=np.int64); row_pair[pm_order] = pair
+    row_pstart = np.empty(n, dtype=np.int64); row_pstart[pm_order] = pstarts
+    before = np.searchsorted(pkey, row_pair * span + (t - shift), side="left") - 1
+    seen = before >= row_pstart
+    res["seen_merchant_before"] = seen.astype(np.int64)
+    res["time_since_last_merchant_s"] = np.where(
+        seen & has_last, np.maximum(0, t - pt[np.maximum(before, 0)]), NEVER)
+
+    # 24h amount stats from prefix sums of Python ints (object arrays), exact like the online sums.
+    valid = has_amount[order]
+    a = fixed[order]
+    def prefix(x):
+        p = np.zeros(n + 1, dtype=x.dtype)
+        np.cumsum(x, out=p[1:])
+        return p
+    pn, ps, pq = prefix(valid.astype(np.int64)), prefix(a), prefix(a * a)
+    lo24 = lo[STATS_WINDOW]
+    cnt = pn[hi] - pn[lo24]; s = ps[hi] - ps[lo24]; q = pq[hi] - pq[lo24]
+    mean, std = np.zeros(n), np.zeros(n)
+    for i in np.nonzero(cnt > 0)[0].tolist():
+        mean[i], std[i] = amount_stats(int(cnt[i]), s[i], q[i])
+    res["user_mean_amt_24h"] = mean
+    res["user_std_amt_24h"] = std
+
+    out = {}
+    for k, v in res.items():
+        out[k] = np.empty(n, dtype=v.dtype)
+        out[k][order] = v
+    return out
+
+# ==================
+# FEATURE EXTRACTION
+# ==================
+
+# Columns computed from the transaction itself, without history.
+ROW_FEATURES = frozenset([
+    "age", "log_amt", "hour", "dow", "is_night", "city_pop",
+    "lat", "long", "merch_lat", "merch_long", "user_merchant_dist_km",
+    "gender_M", "gender_F",
+])
+
+def build_feature_matrix(df: pd.DataFrame, order: List[str] = FEATURE_ORDER) -> np.ndarray:
+    """
+    Feature matrix for a frame of raw string columns already sorted by
+    unix_time. Every row is featurized from the rows before it, matching
+    a tx_to_features_mem + add_to_history loop over the same frame.
+    """
+    if len(df) == 0:
+        return np.zeros((0, len(order)), dtype=float)
+    ux = map_unique(_text(df, "unix_time"), lambda s: to_int(s) or 0, dtype=np.int64)
+    amt_s = _text(df, "amt")
+    amt = map_unique(amt_s, lambda s: to_float(s) or 0.0)
+    fixed = map_unique(amt_s, lambda s: 0 if to_amount(s) is None else fixed_amount(to_amount(s)), dtype=object)
+    has_amount = ~map_unique(amt_s, lambda s: to_amount(s) is None, dtype=bool)
+    lat = map_unique(_text(df, "lat"), to_float)
+    lon = map_unique(_text(df, "long"), to_float)
+    mlat = map_unique(_text(df, "merch_lat"), to_float)
+    mlon = map_unique(_text(df, "merch_long"), to_float)
+
+    # The history pass dominates; skip it when only row-local columns are asked for.
+    feat = {}
+    with_history = bool(set(order) - ROW_FEATURES)
+    if with_history:
+        cc_codes, _ = pd.factorize(_text(df, "cc_num"), sort=False)
+        merch_codes, _ = pd.factorize(_text(df, "merchant"), sort=False)
+        cat_codes, _ = pd.factorize(_text(df, "category"), sort=False)
+        feat = _window_features(cc_codes.astype(np.int64), ux, fixed, has_amount,
+                                merch_codes.astype(np.int64), cat_codes.astype(np.int64))
+
+    hour = map_unique(_text(df, "trans_time"), hour_of_day, dtype=np.int64)
+    feat["age"] = compute_age_vec(_text(df, "dob"), ux)
+    feat["hour"] = hour
+    feat["dow"] = map_unique(_text(df, "trans_date"), dow_from_date, dtype=np.int64)
+    feat["is_night"] = (((0 <= hour) & (hour <= 6)) | (hour >= 22)).astype(np.int64)
+    feat["city_pop"] = map_unique(_text(df, "city_pop"), lambda s: to_int(s) or 0, dtype=np.int64)
+    feat["log_amt"] = map_unique(amt_s, lambda s: math.log1p(to_float(s) or 0.0))
+
+    # `x or 0.0` in the online path maps missing values to 0.0 but keeps real NaNs.
+    complete = np.ones(len(df), dtype=bool)
+    for col in ("lat", "long", "merch_lat", "merch_long"):
+        feat[col] = map_unique(_text(df, col), lambda s: to_float(s) or 0.0)
+        complete &= ~map_unique(_text(df, col), lambda s: to_float(s) is None, dtype=bool)
+    dist = np.zeros(len(df))
+    if complete.any():
+        dist[complete] = haversine_km_vec(lat[complete], lon[complete], mlat[complete], mlon[complete])
+    feat["user_merchant_dist_km"] = dist
+
+    if with_history:
+        mean24 = feat["user_mean_amt_24h"]; std24 = feat["user_std_amt_24h"]
+        feat["user_amt_delta"] = amt - mean24
+        with np.errstate(invalid="ignore", divide="ignore"):
+            feat["amt_z_user"] = np.where(std24 > 0, feat["user_amt_delta"] / np.where(std24 > 0, std24, 1.0), 0.0)
+
+    gender = _text(df, "gender").str.upper()
+    feat["gender_M"] = (gender == "M").to_numpy().astype(np.int64)
+    feat["gender_F"] = (gender == "F").to_numpy().astype(np.int64)
+
+    X = np.zeros((len(df), len(order)), dtype=float)
+    for i, name in enumerate(order):
+        if name in feat:
+            X[:, i] = feat[name]
+    # ordered_feature_row's `float(v or 0.0)` turns -0.0 into 0.0.
+    X[X == 0] = 0.0
+    return X
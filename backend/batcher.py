@@ -0,0 +1,137 @@
+"""
+Dynamic micro-batching for the prediction service.
+
+Callers submit single items and get a Future back. One worker thread pulls
+items off a FIFO queue, waits at most `max_wait_ms` after the first one for
+more to arrive (or until `max_batch` are collected), and hands the whole
+batch to `run_batch`. Because a single thread drains the queue in arrival
+order, history updates made while processing a batch keep the order the
+requests arrived in. Items submitted before close() are still run; later
+ones fail at once.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+_STOP = object()
+
+class MicroBatcher:
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]],
+                 max_batch: int = 64, max_wait_ms: float = 2.0, name: str = "micro-batcher"):
+        """
+        run_batch receives the items in arrival order and returns one result
+        per item; a result that is an Exception fails only that item's future.
+        """
+        self.run_batch = run_batch
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._q: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {
+            "submitted": 0, "batches": 0, "items": 0, "errors": 0,
+            "max_batch_seen": 0, "flush_full": 0, "flush_timeout": 0,
+            "wait_s_total": 0.0, "run_s_total": 0.0,
+        }
+        self._sizes: Dict[int, int] = {}  # power-of-two bucket -> batches
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            if self._closed:
+                fut.set_exception(RuntimeError("Micro-batcher is closed"))
+                return fut
+            self._stats["submitted"] += 1
+            # Under the lock, so nothing lands behind _STOP.
+            self._q.put((item, fut, time.perf_counter()))
+        return fut
+
+    def close(self, timeout: float = 5.0):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._q.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return  # still running a batch; it resolves what it holds
+        while True:
+            try:
+                entry = self._q.get_nowait()
+            except queue.Empty:
+                return
+            if entry is not _STOP:
+                entry[1].set_exception(RuntimeError("Micro-batcher closed before the item ran"))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            sizes = dict(self._sizes)
+        out["queue_depth"] = self._q.qsize()
+        out["mean_batch_size"] = out["items"] / out["batches"] if out["batches"] else 0.0
+        out["mean_queue_wait_ms"] = 1000.0 * out.pop("wait_s_total") / out["items"] if out["items"] else 0.0
+        out["mean_batch_run_ms"] = 1000.0 * out.pop("run_s_total") / out["batches"] if out["batches"] else 0.0
+        out["batch_size_buckets"] = {f"<={k}": v for k, v in sorted(sizes.items())}
+        out["max_batch"] = self.max_batch
+        out["max_wait_ms"] = self.max_wait * 1000.0
+        return out
+
+    # ===========
+    # WORKER LOOP
+    # ===========
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                nxt = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+            except queue.Empty:
+                return batch, False
+            if nxt is _STOP:
+                self._q.put(_STOP)
+                return batch, False
+            batch.append(nxt)
+        return batch, True
+
+    def _loop(self):
+        while True:
+            first = self._q.get()
+            if first is _STOP:
+                return
+            batch, full = self._collect(first)
+            started = time.perf_counter()
+            items = [item for item, _, _ in batch]
+            try:
+                results = self.run_batch(items)
+            except Exception as e:
+                results = [e] * len(items)
+            ran = time.perf_counter() - started
+
+            errors = 0
+            for (_, fut, _), res in zip(batch, results):
+                if isinstance(res, Exception):
+                    errors += 1
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+            bucket = 1
+            while bucket < len(batch):
+                bucket *= 2
+            with self._lock:
+                st = self._stats
+                st["batches"] += 1
+                st["items"] += len(batch)
+                st["errors"] += errors
+                st["max_batch_seen"] = max(st["max_batch_seen"], len(batch))
+                st["flush_full" if full else "flush_timeout"] += 1
+                st["wait_s_total"] += sum(started - t for _, _, t in batch)
+                st["run_s_total"] += ran
+                self._sizes[bucket] = self._sizes.get(bucket, 0) + 1
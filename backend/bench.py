@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the scoring pipeline.
+
+pipeline: replays a pipe-delimited transaction file at a fixed rate through a
+local SSE stand-in, serves mock flag / frontend endpoints, runs
+sse_to_predict (and fraud_api in http mode) against them and reports per-stage
+latency histograms, sustained tx/s and process memory over time. With
+--frontend hub the dashboard feed is read from the /stream hub instead of
+the mock frontend POST endpoint.
+
+    python bench.py pipeline --input ../hackathon_train.csv --rate 200 --limit 5000
+
+features: microbenchmarks of tx_to_features_mem (and optionally the SQLite
+path) against the size of one card's history.
+
+    python bench.py features --sizes 100,1000,10000,100000
+
+parity: builds the feature matrix with batch_features and with the online
+history (tx_to_features_mem + add_to_history, evicting as the stream does)
+and fails (exit 1) unless they match bit for bit. The synthetic data has
+cards that go idle for longer than the history retention and come back to
+merchants they used before, plus same-second ties and missing amounts.
+
+    python bench.py parity --cards 200 --idle-days 70
+    python bench.py parity --input ../hackathon_train.csv --limit 50000
+
+flags: pushes synthetic flags through flag_outbox.FlagOutbox into the mock
+flag endpoint (with injected errors and, optionally, a restart half way)
+and checks that every flag arrived.
+
+    python bench.py flags --count 5000 --flag-error-rate 0.1 --restart-after 1
+
+All accept --json OUT to save results and --baseline FILE to fail (exit 1)
+when a tracked number got worse by more than --tolerance.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("queue_ms", "predict_ms", "features_ms", "store_ms", "inference_ms", "frontend_ms", "total_ms")
+
+# =========
+# REPORTING
+# =========
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+    pick = lambda q: v[min(len(v) - 1, int(q * len(v)))]
+    return {"n": len(v), "mean": statistics.fmean(v), "p50": pick(0.50), "p90": pick(0.90),
+            "p99": pick(0.99), "max": v[-1]}
+
+def histogram(values: List[float], width: int = 40) -> List[str]:
+    """Power-of-two buckets, one text bar per non-empty bucket."""
+    if not values:
+        return []
+    counts: Dict[int, int] = {}
+    for x in values:
+        b = 0
+        while (1 << b) * 0.01 < x and b < 40:
+            b += 1
+        counts[b] = counts.get(b, 0) + 1
+    top = max(counts.values())
+    lines = []
+    for b in range(min(counts), max(counts) + 1):
+        c = counts.get(b, 0)
+        lines.append(f"  <= {(1 << b) * 0.01:>10.2f} ms {c:>7} {'#' * max(1 if c else 0, c * width // top)}")
+    return lines
+
+def print_stage(name: str, values: List[float]):
+    p = percentiles(values)
+    if not p["n"]:
+        return
+    print(f"{name:<14} n={p['n']:<7} mean={p['mean']:.2f} p50={p['p50']:.2f} "
+          f"p90={p['p90']:.2f} p99={p['p99']:.2f} max={p['max']:.2f} (ms)")
+    for line in histogram(values):
+        print(line)
+
+def check_baseline(results: Dict[str, Any], path: str, tolerance: float) -> int:
+    """
+    Compares the tracked numbers with a previous --json run: latencies may not
+    grow, and throughput may not shrink, by more than tolerance.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    failures = []
+    for key, cur in results.get("tracked", {}).items():
+        old = base.get("tracked", {}).get(key)
+        if old is None or cur is None or not old:
+            continue
+        worse = (old - cur) / old if key.endswith("tx_per_s") else (cur - old) / old
+        status = "REGRESSION" if worse > tolerance else "ok"
+        print(f"{key:<40} {old:>12.3f} -> {cur:>12.3f} ({worse:+.1%}) {status}")
+        if worse > tolerance:
+            failures.append(key)
+    return 1 if failures else 0
+
+def finish(results: Dict[str, Any], args) -> int:
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results -> {args.json}")
+    if args.baseline:
+        return check_baseline(results, args.baseline, args.tolerance)
+    return 0
+
+# ================
+# PIPELINE (MOCKS)
+# ================
+
+def load_transactions(path: str, limit: int) -> List[Dict[str, str]]:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rows = []
+        for row in csv.DictReader(f, delimiter="|"):
+            row.pop("is_fraud", None)  # the live stream does not carry labels
+            rows.append(row)
+            if limit and len(rows) >= limit:
+                break
+    return rows
+
+class Mocks:
+    """SSE stand-in plus flag / frontend endpoints, recording arrival times."""
+
+    def __init__(self, txs, rate: float, flag_latency_ms: float, flag_error_rate: float,
+                 frontend_latency_ms: float):
+        self.txs = txs
+        self.rate = rate
+        self.flag_latency = flag_latency_ms / 1e3
+        self.flag_error_rate = flag_error_rate
+        self.frontend_latency = frontend_latency_ms / 1e3
+        self.emitted: Dict[str, float] = {}
+        self.flagged: Dict[str, float] = {}
+        self.flag_hits: Dict[str, int] = {}
+        self.posted: Dict[str, float] = {}
+        self.flag_errors = 0
+        self.all_posted = asyncio.Event()
+        self.subscribed = asyncio.Event()  # set up front unless a /stream reader must connect first
+
+    async def stream(self, request):
+        from aiohttp import web
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        await self.subscribed.wait()
+        start = time.perf_counter()
+        for i, tx in enumerate(self.txs):
+            if self.rate > 0:
+                delay = start + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.emitted.setdefault(tx["trans_num"], time.perf_counter())
+            await resp.write(b"data: " + json.dumps(tx).encode("utf-8") + b"\n\n")
+        # Keep the connection open so the processor does not reconnect and replay.
+        await self.all_posted.wait()
+        return resp
+
+    async def flag(self, request):
+        from aiohttp import web
+        body = await request.json()
+        if self.flag_latency:
+            await asyncio.sleep(self.flag_latency)
+        if random.random() < self.flag_error_rate:
+            self.flag_errors += 1
+            return web.Response(status=503)
+        self.flagged.setdefault(body.get("trans_num"), time.perf_counter())
+        self.flag_hits[body.get("trans_num")] = self.flag_hits.get(body.get("trans_num"), 0) + 1
+        self._check_done()
+        return web.json_response({"ok": True})
+
+    async def frontend(self, request):
+        from aiohttp import web
+        body = await request.json()
+        if self.frontend_latency:
+            await asyncio.sleep(self.frontend_latency)
+        self.post(body["transaction"].get("trans_num"))
+        return web.json_response({"ok": True})
+
+    def post(self, trans_num: str):
+        self.posted.setdefault(trans_num, time.perf_counter())
+        self._check_done()
+
+    async def read_hub(self, url: str):
+        """Subscribes to a /stream hub, resuming with Last-Event-ID after a dropped connection."""
+        import aiohttp
+        last_id = None
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+            while not self.all_posted.is_set():
+                try:
+                    headers = {"Last-Event-ID": last_id} if last_id else {}
+                    async with session.get(url, headers=headers) as resp:
+                        self.subscribed.set()
+                        async for line in resp.content:
+                            if line.startswith(b"id:"):
+                                last_id = line[3:].strip().decode()
+                            elif line.startswith(b"data:"):
+                                self.post(json.loads(line[5:]).get("trans_num"))
+                except (aiohttp.ClientError, ConnectionError):
+                    await asyncio.sleep(0.2)
+
+    def _check_done(self):
+        # Flags are sent in the background, so both endpoints must have seen every tx.
+        if self.txs and len(self.posted) >= len(self.txs) and len(self.flagged) >= len(self.txs):
+            self.all_posted.set()
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+async def wait_http(url: str, timeout: float):
+    import aiohttp
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+def stop(proc: subprocess.Popen):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+async def run_pipeline(args) -> Dict[str, Any]:
+    from aiohttp import web
+
+    txs = load_transactions(args.input, args.limit)
+    if not txs:
+        raise SystemExit(f"No transactions in {args.input}")
+    mocks = Mocks(txs, args.rate, args.flag_latency_ms, args.flag_error_rate, args.frontend_latency_ms)
+    app = web.Application()
+    app.router.add_get("/stream", mocks.stream)
+    app.router.add_post("/flag", mocks.flag)
+    app.router.add_post("/frontend", mocks.frontend)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    work = tempfile.mkdtemp(prefix="fraud-bench-")
+    trace_path = os.path.join(work, "trace.jsonl")
+    base = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ)
+    env.update({
+        "FRAUD_MODEL": args.model, "FRAUD_FEATURES": args.features, "FRAUD_HISTORY": args.history,
+        # Always a scratch database: store=1 must not write into the real history.
+        "FRAUD_DB": os.path.join(work, "history.db"),
+        "FRAUD_BATCH_WINDOW_MS": str(args.batch_window_ms),
+        "STREAM_URL": f"{base}/stream", "FLAG_URL": f"{base}/flag",
+        "FRONTEND_POST_URL": f"{base}/frontend" if args.frontend == "post" else "",
+        "LOCAL_PREDICT_URL": f"http://127.0.0.1:{args.api_port}/predict?store=1",
+        "PREDICT_MODE": args.mode, "SHARDS": str(args.shards),
+        "MAX_WORKERS": str(args.workers), "TRACE_PATH": trace_path,
+        "FLAG_OUTBOX": os.path.join(work, "flag_outbox.jsonl"),
+    })
+    if args.frontend == "hub" and args.mode == "inprocess":
+        env["METRICS_PORT"] = str(args.api_port)  # the hub is served next to /metrics
+    hub_reader = None
+    if args.frontend == "post":
+        mocks.subscribed.set()
+
+    procs: Dict[str, subprocess.Popen] = {}
+    logs = []
+    def spawn(name, cmd):
+        log = open(os.path.join(work, f"{name}.log"), "w", encoding="utf-8")
+        logs.append(log)
+        procs[name] = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    memory: List[Dict[str, Any]] = []
+    try:
+        if args.mode == "http":
+            spawn("fraud_api", [sys.executable, "-m", "uvicorn", "fraud_api:app", "--host", "127.0.0.1",
+                                "--port", str(args.api_port), "--log-level", "warning"])
+            await wait_http(f"http://127.0.0.1:{args.api_port}/health", args.startup_timeout)
+        if args.frontend == "hub":
+            hub_reader = asyncio.create_task(mocks.read_hub(f"http://127.0.0.1:{args.api_port}/stream"))
+        spawn("sse_to_predict", [sys.executable, "sse_to_predict.py"])
+
+        t0 = time.perf_counter()
+        last_progress, last_count = t0, 0
+        while not mocks.all_posted.is_set():
+            await asyncio.sleep(args.sample_every)
+            now = time.perf_counter()
+            sample = {"t": round(now - t0, 2), "done": len(mocks.posted)}
+            for name, p in procs.items():
+                sample[f"{name}_rss_mb"] = rss_mb(p.pid)
+            memory.append(sample)
+            if len(mocks.posted) + len(mocks.flagged) != last_count:
+                last_progress, last_count = now, len(mocks.posted) + len(mocks.flagged)
+            elif now - last_progress > args.idle_timeout:
+                print(f"[WARN] No progress for {args.idle_timeout:.0f}s; stopping early", file=sys.stderr)
+                break
+            if any(p.poll() is not None for p in procs.values()):
+                print(f"[WARN] A process exited early; logs in {work}", file=sys.stderr)
+                break
+    finally:
+        for name in ("sse_to_predict", "fraud_api"):
+            if name in procs:
+                stop(procs[name])
+        for log in logs:
+            log.close()
+        mocks.all_posted.set()
+        mocks.subscribed.set()
+        if hub_reader is not None:
+            hub_reader.cancel()
+            await asyncio.gather(hub_reader, return_exceptions=True)
+        await runner.cleanup()
+
+    traces = []
+    if os.path.exists(trace_path):
+        with open(trace_path, "r", encoding="utf-8") as f:
+            traces = [json.loads(line) for line in f if line.strip()]
+
+    e2e_flag = [(mocks.flagged[k] - mocks.emitted[k]) * 1e3 for k in mocks.flagged if k in mocks.emitted]
+    e2e_front = [(mocks.posted[k] - mocks.emitted[k]) * 1e3 for k in mocks.posted if k in mocks.emitted]
+    done_times = sorted(mocks.posted.values())
+    first_emit = min(mocks.emitted.values()) if mocks.emitted else None
+    elapsed = (done_times[-1] - first_emit) if done_times and first_emit is not None else 0.0
+
+    # Completions per whole second, ignoring the partial first and last ones.
+    per_second: Dict[int, int] = {}
+    for t in done_times:
+        sec = int(t - first_emit)
+        per_second[sec] = per_second.get(sec, 0) + 1
+    steady = [per_second.get(s, 0) for s in range(1, int(elapsed))] if elapsed >= 3 else []
+
+    stages = {k: [t[k] for t in traces if k in t] for k in STAGES}
+    stages["e2e_flag_ms"] = e2e_flag
+    stages["e2e_frontend_ms"] = e2e_front
+    summary = {k: percentiles(v) for k, v in stages.items()}
+    tx_per_s = len(done_times) / elapsed if elapsed > 0 else None
+    sustained = statistics.median(steady) if steady else tx_per_s
+    peak_rss = {k: max((m[k] for m in memory if m.get(k) is not None), default=None)
+                for k in memory[0] if k.endswith("_rss_mb")} if memory else {}
+
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("func", "json", "baseline")},
+        "sent": len(txs), "completed": len(done_times), "flagged": len(mocks.flagged),
+        "flag_errors_injected": mocks.flag_errors, "elapsed_s": elapsed,
+        "tx_per_s": tx_per_s, "sustained_tx_per_s": sustained,
+        "stages": summary, "memory": memory, "peak_rss_mb": peak_rss, "logs": work,
+        "tracked": {
+            "sustained_tx_per_s": sustained,
+            **{f"{k}.p50": s.get("p50") for k, s in summary.items() if s.get("n")},
+            **{f"{k}.p99": s.get("p99") for k, s in summary.items() if s.get("n")},
+        },
+    }
+
+    print(f"\nSent {len(txs)} | completed {len(done_times)} | flagged {len(mocks.flagged)} "
+          f"| injected flag errors {mocks.flag_errors} | {elapsed:.2f}s")
+    if tx_per_s:
+        print(f"Throughput: {tx_per_s:.1f} tx/s overall, {sustained:.1f} tx/s sustained (median per second)\n")
+    for k, v in stages.items():
+        print_stage(k, v)
+    if memory:
+        print("\nMemory (RSS MB):")
+        step = max(1, len(memory) // 10)
+        shown = memory[::step] if (len(memory) - 1) % step == 0 else memory[::step] + [memory[-1]]
+        for m in shown:
+            rss = "  ".join(f"{k[:-7]}={v:.0f}" for k, v in m.items() if k.endswith("_rss_mb") and v)
+            print(f"  t={m['t']:>7.1f}s done={m['done']:>7}  {rss}")
+    print(f"\nProcess logs: {work}")
+    return results
+
+def cmd_pipeline(args) -> int:
+    return finish(asyncio.run(run_pipeline(args)), args)
+
+# ===================
+# FEATURE MICROBENCH
+# ===================
+
+def synthetic_history(n: int, gap: int, merchants: int, start: int = 1_600_000_000):
+    """One card with n past transactions every gap seconds."""
+    rnd = random.Random(n)
+    cats = ["grocery_pos", "gas_transport", "shopping_net", "food_dining", "misc_pos", "travel"]
+    txs = []
+    for i in range(n):
+        txs.append({
+            "cc_num": "4000123412341234", "unix_time": str(start + i * gap),
+            "amt": f"{rnd.uniform(1, 300):.2f}", "merchant": f"merchant_{rnd.randrange(merchants)}",
+            "category": rnd.choice(cats), "trans_date": "2020-09-13", "trans_time": "12:00:00",
+            "dob": "1980-01-01", "lat": "40.0", "long": "-75.0",
+            "merch_lat": "40.1", "merch_long": "-75.1", "city_pop": "1000", "gender": "F",
+            "trans_num": f"bench{i}",
+        })
+    return txs
+
+def time_calls(fn, calls: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(calls):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1e6)
+    p = percentiles(samples)
+    return {"p50_us": p["p50"], "p99_us": p["p99"], "mean_us": p["mean"]}
+
+def cmd_features(args) -> int:
+    from features import build_history, add_to_history, tx_to_features_mem, connect_db, ensure_schema, \
+        insert_txs, tx_to_features
+
+    results: Dict[str, Any] = {"config": {k: v for k, v in vars(args).items()
+                                          if k not in ("func", "json", "baseline")},
+                               "sizes": {}, "tracked": {}}
+    print(f"{'history':>9} {'path':<12} {'p50 us':>10} {'p99 us':>10} {'mean us':>10}")
+    for n in [int(s) for s in args.sizes.split(",") if s]:
+        txs = synthetic_history(n + args.calls, args.gap, args.merchants)
+        past, new = txs[:n], txs[n:]
+        row: Dict[str, Any] = {}
+
+        history = build_history()
+        for tx in past:
+            add_to_history(history, tx)
+        # Lookup only: same point in time, repeated.
+        row["lookup"] = time_calls(lambda: tx_to_features_mem(new[0], history), args.calls)
+        # Streaming step: features then append, advancing through time.
+        it = iter(new)
+        def step():
+            tx = next(it)
+            tx_to_features_mem(tx, history)
+            add_to_history(history, tx)
+        row["stream_step"] = time_calls(step, args.calls)
+
+        if args.sqlite:
+            with tempfile.TemporaryDirectory() as d:
+                conn = connect_db(os.path.join(d, "bench.db"))
+                ensure_schema(conn)
+                insert_txs(conn, past)
+                row["sqlite_lookup"] = time_calls(lambda: tx_to_features(new[0], conn), args.calls)
+                conn.close()
+
+        for path, r in row.items():
+            print(f"{n:>9} {path:<12} {r['p50_us']:>10.1f} {r['p99_us']:>10.1f} {r['mean_us']:>10.1f}")
+            results["tracked"][f"{path}.{n}.p50_us"] = r["p50_us"]
+        results["sizes"][n] = row
+    return finish(results, args)
+
+# =============
+# ENGINE PARITY
+# =============
+
+def synthetic_cards(cards: int, per_card: int, idle_days: float, merchants: int, start: int = 1_600_000_000):
+    """
+    Cards that trade in bursts separated by idle gaps of up to idle_days,
+    revisiting merchants from before the gap; some rows share a second or
+    lack an amount.
+    """
+    rnd = random.Random(cards * 7919 + per_card)
+    base = synthetic_history(1, 60, merchants)[0]
+    txs = []
+    for c in range(cards):
+        t = start + rnd.randrange(86400)
+        for i in range(per_card):
+            r = rnd.random()
+            if r < 0.05:
+                t += rnd.randrange(int(idle_days * 86400) // 2, int(idle_days * 86400) + 1)
+            elif r < 0.15:
+                pass  # same second as the previous row
+            else:
+                t += rnd.randrange(1, 4 * 3600)
+            txs.append({
+                **base, "cc_num": f"4000{c:012d}", "unix_time": str(t),
+                "amt": "" if rnd.random() < 0.02 else f"{rnd.uniform(1, 300):.2f}",
+                "merchant": f"merchant_{rnd.randrange(merchants)}",
+                "category": rnd.choice(("grocery_pos", "gas_transport", "shopping_net", "travel")),
+                "trans_num": f"parity{c}_{i}",
+            })
+    return txs
+
+def cmd_parity(args) -> int:
+    import numpy as np
+    import pandas as pd
+    from batch_features import build_feature_matrix
+    from features import FEATURE_ORDER, History, add_to_history, ordered_feature_row, to_int, \
+        tx_to_features_mem
+
+    if args.input:
+        df = pd.read_csv(args.input, sep="|", dtype=str, keep_default_na=False)
+    else:
+        df = pd.DataFrame(synthetic_cards(args.cards, args.per_card, args.idle_days, args.merchants))
+    df["_ux"] = [to_int(v) or 0 for v in df["unix_time"]]
+    df = df.sort_values("_ux", kind="stable").drop(columns="_ux").reset_index(drop=True)
+    if args.limit > 0:
+        df = df.iloc[:args.limit]
+
+    t0 = time.perf_counter()
+    X = build_feature_matrix(df, FEATURE_ORDER)
+    batch_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    history = History(evict_every=args.evict_every)
+    rows = []
+    for tx in df.to_dict("records"):
+        rows.append(ordered_feature_row(tx_to_features_mem(tx, history), FEATURE_ORDER))
+        add_to_history(history, tx)
+        history.maybe_evict()
+    R = np.array(rows, dtype=float).reshape(-1, len(FEATURE_ORDER))
+    online_s = time.perf_counter() - t0
+
+    differ = X.view(np.int64) != R.view(np.int64)
+    mismatches = {name: int(differ[:, i].sum()) for i, name in enumerate(FEATURE_ORDER) if differ[:, i].any()}
+    print(f"{len(df)} rows, {df['cc_num'].nunique()} cards, {history.evicted} entries evicted | "
+          f"batch {batch_s:.2f}s, online {online_s:.2f}s")
+    for name, n in mismatches.items():
+        print(f"[FAIL] {name}: {n} rows differ", file=sys.stderr)
+    if not mismatches:
+        print("Batch and online features match bit for bit.")
+    results = {"rows": len(df), "mismatches": mismatches,
+               "tracked": {"batch_s": batch_s, "online_s": online_s}}
+    return finish(results, args) or (1 if mismatches else 0)
+
+# =================
+# FLAG OUTBOX BENCH
+# =================
+
+async def run_flags(args) -> Dict[str, Any]:
+    import aiohttp
+    from aiohttp import web
+    from flag_outbox import FlagOutbox, http_sender
+
+    mocks = Mocks([], 0, args.flag_latency_ms, args.flag_error_rate, 0)
+    app = web.Application()
+    app.router.add_post("/flag", mocks.flag)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    work = tempfile.mkdtemp(prefix="fraud-flags-")
+    path = os.path.join(work, "flag_outbox.jsonl")
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency))
+    send = http_sender(session, f"http://127.0.0.1:{args.port}/flag",
+                       {"Content-Type": "application/json"},
+                       {"Content-Type": "application/x-www-form-urlencoded"})
+    def outbox():
+        return FlagOutbox(send, path, args.concurrency, base_delay=args.retry_base_delay,
+                          max_delay=args.retry_max_delay)
+
+    names = [f"flag{i}" for i in range(args.count)]
+    box = outbox()
+    t0 = time.perf_counter()
+    try:
+        await box.start()
+        for name in names:
+            box.add(name, 1)
+        resumed = None
+        if args.restart_after > 0:
+            await box.drain(args.restart_after)
+            await box.close()
+            resumed = len(box.pending)
+            box = outbox()
+            await box.start()
+        drained = await box.drain(args.timeout)
+        elapsed = time.perf_counter() - t0
+        stats = box.stats()
+    finally:
+        await box.close()
+        await session.close()
+        await runner.cleanup()
+
+    missing = sum(1 for n in names if n not in mocks.flagged)
+    duplicates = sum(c - 1 for c in mocks.flag_hits.values())
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("func", "json", "baseline")},
+        "flags": args.count, "delivered": len(mocks.flagged), "missing": missing,
+        "duplicates": duplicates, "drained": drained, "resumed_after_restart": resumed,
+        "flag_errors_injected": mocks.flag_errors, "elapsed_s": elapsed, "outbox": stats,
+        "tracked": {"flag_tx_per_s": len(mocks.flagged) / elapsed if elapsed > 0 else None},
+    }
+    print(f"Flags {args.count} | delivered {len(mocks.flagged)} | missing {missing} | duplicates {duplicates} "
+          f"| injected errors {mocks.flag_errors} | retries {stats['retries']} | {elapsed:.2f}s "
+          f"({results['tracked']['flag_tx_per_s']:.0f}/s)")
+    if resumed is not None:
+        print(f"Restarted after {args.restart_after:.1f}s with {resumed} flags pending in the journal")
+    print(f"Journal: {path}")
+    return results
+
+def cmd_flags(args) -> int:
+    results = asyncio.run(run_flags(args))
+    return finish(results, args) or (1 if results["missing"] else 0)
+
+# ====
+# MAIN
+# ====
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Fraud pipeline benchmarks")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    def common(p):
+        p.add_argument("--json", default="", help="Write results to this file")
+        p.add_argument("--baseline", default="", help="Previous --json output to compare against")
+        p.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+
+    p = sub.add_parser("pipeline", help="End-to-end replay through mocks")
+    p.add_argument("--input", required=True, help="Pipe-delimited CSV with header")
+    p.add_argument("--limit", type=int, default=2000)
+    p.add_argument("--rate", type=float, default=100.0, help="Events per second, 0 = as fast as possible")
+    p.add_argument("--mode", choices=("http", "inprocess"), default="http")
+    p.add_argument("--shards", type=int, default=0)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--history", choices=("sqlite", "memory"), default="sqlite")
+    p.add_argument("--model", default=os.path.abspath(os.path.join(HERE, "..", "model.pkl")))
+    p.add_argument("--features", default=os.path.join(HERE, "features.json"))
+    p.add_argument("--batch-window-ms", type=float, default=0.0)
+    p.add_argument("--flag-latency-ms", type=float, default=20.0)
+    p.add_argument("--flag-error-rate", type=float, default=0.0)
+    p.add_argument("--frontend-latency-ms", type=float, default=5.0)
+    p.add_argument("--frontend", choices=("post", "hub"), default="post",
+                   help="Dashboard feed: POSTs to the mock frontend, or a reader on the /stream hub")
+    p.add_argument("--port", type=int, default=8790, help="Port for the mock stream/flag/frontend")
+    p.add_argument("--api-port", type=int, default=8791, help="Port for fraud_api in http mode")
+    p.add_argument("--sample-every", type=float, default=1.0, help="Memory sampling interval (s)")
+    p.add_argument("--idle-timeout", type=float, default=30.0)
+    p.add_argument("--startup-timeout", type=float, default=120.0)
+    common(p)
+    p.set_defaults(func=cmd_pipeline)
+
+    p = sub.add_parser("features", help="tx_to_features_mem vs. history size")
+    p.add_argument("--sizes", default="100,1000,10000,100000")
+    p.add_argument("--calls", type=int, default=2000)
+    p.add_argument("--gap", type=int, default=60, help="Seconds between a card's transactions")
+    p.add_argument("--merchants", type=int, default=500)
+    p.add_argument("--sqlite", action="store_true", help="Also time the SQLite history path")
+    common(p)
+    p.set_defaults(func=cmd_features)
+
+    p = sub.add_parser("parity", help="batch_features vs. the online history, bit for bit")
+    p.add_argument("--input", default="", help="Pipe-delimited CSV (default: synthetic cards)")
+    p.add_argument("--limit", type=int, default=0)
+    p.add_argument("--cards", type=int, default=200)
+    p.add_argument("--per-card", type=int, default=100)
+    p.add_argument("--idle-days", type=float, default=70.0, help="Longest idle gap of a synthetic card")
+    p.add_argument("--merchants", type=int, default=50)
+    p.add_argument("--evict-every", type=int, default=500, help="Online history: adds between evictions")
+    common(p)
+    p.set_defaults(func=cmd_parity)
+
+    p = sub.add_parser("flags", help="Flag outbox against a mock flag endpoint")
+    p.add_argument("--count", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--flag-latency-ms", type=float, default=20.0)
+    p.add_argument("--flag-error-rate", type=float, default=0.1)
+    p.add_argument("--retry-base-delay", type=float, default=0.5)
+    p.add_argument("--retry-max-delay", type=float, default=8.0)
+    p.add_argument("--restart-after", type=float, default=0.0,
+                   help="Close the outbox after this many seconds and resume from its journal")
+    p.add_argument("--timeout", type=float, default=120.0)
+    p.add_argument("--port", type=int, default=8790)
+    common(p)
+    p.set_defaults(func=cmd_flags)
+
+    args = ap.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Compact, memory-mappable format for the RandomForest.
+
+export_forest writes every tree of a fitted sklearn forest into flat arrays
+(one .npy file each) with node indices global across trees. CompactForest
+maps them read-only, so all worker processes share one copy through the page
+cache and nothing is unpickled at startup. Traversal follows sklearn exactly
+(float32 inputs, `x <= threshold`, NaNs routed by missing_go_to_left) and the
+tree probabilities are summed in estimator order, so predict_proba matches
+the pickled model bit for bit.
+
+Per-row cost is a few numpy calls per tree level, so single transactions and
+small batches score far faster than through sklearn; very large offline
+batches are still quicker with the pickled model.
+
+    python compact_forest.py --model ../model.pkl --output ../model_forest
+"""
+
+import argparse
+import json
+import os
+from typing import Any, Dict
+
+import numpy as np
+
+FORMAT_VERSION = 1
+ARRAYS = ("feature", "threshold", "left", "right", "missing_left", "value", "roots")
+
+# ======
+# EXPORT
+# ======
+
+def _values_are_fractions() -> bool:
+    """sklearn >= 1.4 stores class fractions in tree_.value and returns them as is."""
+    import sklearn
+    major, minor = (int(p) for p in sklearn.__version__.split(".")[:2])
+    return (major, minor) >= (1, 4)
+
+def export_forest(model, directory: str) -> Dict[str, Any]:
+    """Writes model's trees to directory; returns the metadata."""
+    trees = [est.tree_ for est in model.estimators_]
+    if any(t.n_outputs != 1 for t in trees):
+        raise ValueError("Only single-output forests can be exported")
+
+    sizes = np.array([t.node_count for t in trees], dtype=np.int64)
+    roots = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+    total = int(sizes.sum())
+    if total >= np.iinfo(np.int32).max:
+        raise ValueError(f"Forest too large to export ({total} nodes)")
+
+    feature = np.empty(total, dtype=np.int32)
+    threshold = np.empty(total, dtype=np.float64)
+    left = np.empty(total, dtype=np.int32)
+    right = np.empty(total, dtype=np.int32)
+    missing_left = np.zeros(total, dtype=np.bool_)
+    value = np.empty((total, len(model.classes_)), dtype=np.float64)
+
+    for t, base in zip(trees, roots):
+        sl = slice(int(base), int(base) + t.node_count)
+        leaf = t.children_left < 0
+        feature[sl] = np.where(leaf, 0, t.feature)
+        threshold[sl] = t.threshold
+        # Leaves keep -1 children; internal children are offset to global ids.
+        left[sl] = np.where(leaf, -1, t.children_left + base)
+        right[sl] = np.where(leaf, -1, t.children_right + base)
+        if hasattr(t, "missing_go_to_left"):
+            missing_left[sl] = t.missing_go_to_left.astype(bool)
+        v = t.value[:, 0, :].astype(np.float64)
+        if not _values_are_fractions():
+            # Older sklearn stores weighted counts and normalizes in predict_proba.
+            norm = v.sum(axis=1)[:, np.newaxis]
+            norm[norm == 0.0] = 1.0
+            v = v / norm
+        value[sl] = v
+
+    os.makedirs(directory, exist_ok=True)
+    arrays = dict(feature=feature, threshold=threshold, left=left, right=right,
+                  missing_left=missing_left, value=value, roots=roots)
+    for name in ARRAYS:
+        np.save(os.path.join(directory, f"{name}.npy"), arrays[name])
+
+    meta = {
+        "format": FORMAT_VERSION,
+        "classes": np.asarray(model.classes_).tolist(),
+        "n_features": int(model.n_features_in_),
+        "n_trees": len(trees),
+        "n_nodes": total,
+    }
+    with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+# =========
+# INFERENCE
+# =========
+
+class CompactForest:
+    """predict / predict_proba over the exported arrays, without sklearn."""
+
+    def __init__(self, directory: str, mmap: bool = True):
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact forest format {meta.get('format')!r} in '{directory}'")
+        mode = "r" if mmap else None
+        for name in ARRAYS:
+            # Plain ndarray views over the mapping: fancy indexing on np.memmap is slower.
+            arr = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode)
+            setattr(self, name, np.asarray(arr))
+        self.directory = directory
+        self.classes_ = np.asarray(meta["classes"])
+        self.n_features_in_ = int(meta["n_features"])
+        self.n_trees = int(meta["n_trees"])
+
+    def apply(self, X) -> np.ndarray:
+        """Leaf node ids, shape (n_samples, n_trees)."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has shape {X.shape}, expected (n, {self.n_features_in_})")
+        n, T = len(X), self.n_trees
+        flat = X.ravel()
+        has_nan = bool(np.isnan(flat).any())
+        offset = np.repeat(np.arange(n, dtype=np.int64) * X.shape[1], T)
+        node = np.tile(self.roots, n)
+
+        # Only (sample, tree) pairs still at an internal node advance each level.
+        active = np.flatnonzero(self.left[node] >= 0)
+        while active.size:
+            nd = node[active]
+            x = flat[offset[active] + self.feature[nd]]
+            go_left = x <= self.threshold[nd]
+            if has_nan:
+                go_left |= np.isnan(x) & self.missing_left[nd]
+            nd = np.where(go_left, self.left[nd], self.right[nd])
+            node[active] = nd
+            active = active[self.left[nd] >= 0]
+        return node.reshape(n, T)
+
+    def predict_proba(self, X) -> np.ndarray:
+        leaves = self.apply(X)
+        out = np.zeros((len(leaves), len(self.classes_)), dtype=np.float64)
+        # Tree by tree, like sklearn's accumulation, to keep identical rounding.
+        for t in range(self.n_trees):
+            out += self.value[leaves[:, t]]
+        out /= self.n_trees
+        return out
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+def is_compact_forest(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+def main():
+    ap = argparse.ArgumentParser(description="Export a pickled forest to the compact format")
+    ap.add_argument("--model", default="../model.pkl")
+    ap.add_argument("--output", default="../model_forest")
+    args = ap.parse_args()
+
+    import joblib
+    meta = export_forest(joblib.load(args.model), args.output)
+    print(f"Exported {meta['n_trees']} trees / {meta['n_nodes']} nodes -> {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+On-disk cache of the training feature matrix.
+
+A cache directory holds X.npy (loaded memory-mapped), y.npy and meta.json,
+which records what the matrix was built from: a content hash of the input
+file, the row limit, the feature columns in X order and a fingerprint of the
+feature code. meta.json is written last, so an interrupted build never looks
+valid; a cache whose meta differs from the current run is rebuilt.
+
+Columns are reusable on their own: when the feature list changes, the
+columns that are still wanted are copied over and only the new ones are
+computed (see reusable_columns / merge_feature_cache).
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Modules whose code defines the matrix; any edit to them changes the fingerprint.
+FEATURE_SOURCES = ("features.py", "batch_features.py", "parallel_features.py")
+
+def matrix_path(directory: str) -> str:
+    return os.path.join(directory, "X.npy")
+
+def file_digest(path: str, block: int = 1 << 20) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def code_fingerprint() -> str:
+    here = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.blake2b(digest_size=20)
+    for name in FEATURE_SOURCES:
+        h.update(name.encode("utf-8"))
+        with open(os.path.join(here, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def cache_meta(input_path: str, limit: int, order: List[str]) -> Dict[str, Any]:
+    return {
+        "input_hash": file_digest(input_path),
+        "limit": limit,
+        "code": code_fingerprint(),
+        "features": list(order),
+    }
+
+def _read_meta(directory: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_meta(directory: str, meta: Dict[str, Any]):
+    with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+def load_feature_cache(directory: str, meta: Dict[str, Any]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """(X, y) if directory holds a complete cache built with the same meta, else None."""
+    if _read_meta(directory) != meta:
+        return None
+    return np.load(matrix_path(directory), mmap_mode="r"), np.load(os.path.join(directory, "y.npy"))
+
+def reusable_columns(directory: str, meta: Dict[str, Any], trust_code: bool = False,
+                     ) -> Optional[Tuple[np.ndarray, np.ndarray, List[str]]]:
+    """
+    (X, y, columns) of a cache over the same input and limit, where columns
+    are the cached feature names still listed in meta. Requires the same
+    feature code unless trust_code (the caller vouches that existing columns
+    are computed as before, e.g. after only adding a feature).
+    """
+    cached = _read_meta(directory)
+    if cached is None or (cached.get("input_hash"), cached.get("limit")) != (meta["input_hash"], meta["limit"]):
+        return None
+    if cached.get("code") != meta["code"] and not trust_code:
+        return None
+    X = np.load(matrix_path(directory), mmap_mode="r")
+    return X, np.load(os.path.join(directory, "y.npy")), list(cached["features"])
+
+def invalidate_feature_cache(directory: str):
+    try:
+        os.remove(os.path.join(directory, "meta.json"))
+    except FileNotFoundError:
+        pass
+
+def save_feature_cache(directory: str, X: np.ndarray, y: np.ndarray, meta: Dict[str, Any]):
+    """Stores y and meta; X too unless it already lives at matrix_path(directory)."""
+    os.makedirs(directory, exist_ok=True)
+    if not (isinstance(X, np.memmap) and os.path.abspath(X.filename) == os.path.abspath(matrix_path(directory))):
+        np.save(matrix_path(directory), X)
+    np.save(os.path.join(directory, "y.npy"), y)
+    _write_meta(directory, meta)
+
+def merge_feature_cache(directory: str, meta: Dict[str, Any], y: np.ndarray,
+                        parts: Sequence[Tuple[np.ndarray, List[str]]]) -> np.ndarray:
+    """
+    Writes X with meta["features"] columns taken from parts, a list of
+    (matrix, column names) with the same rows (the cached X may be one of
+    them), and returns it memory-mapped.
+    """
+    source = {}
+    for X, names in parts:
+        for i, name in enumerate(names):
+            source.setdefault(name, (X, i))
+    tmp = os.path.join(directory, "X.tmp.npy")
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float64, shape=(len(y), len(meta["features"])))
+    for j, name in enumerate(meta["features"]):
+        X, i = source[name]
+        out[:, j] = X[:, i]
+    out.flush()
+    del out
+    invalidate_feature_cache(directory)
+    os.replace(tmp, matrix_path(directory))
+    np.save(os.path.join(directory, "y.npy"), y)
+    _write_meta(directory, meta)
+    return np.load(matrix_path(directory), mmap_mode="r")
@@ -1,14 +1,21 @@
 import math
-from typing import Dict, Any, List, Optional
+import os
+import sqlite3
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 from dateutil import parser as dtparser
-from collections import defaultdict
 import bisect
-import numpy as np
+from array import array
 
 # =======
 # HELPERS
 # =======
 
+# Unix times datetime can represent (years 1..9999).
+MIN_UNIX = -62135596800
+MAX_UNIX = 253402300799
+
 def to_float(x) -> Optional[float]:
     try:
         if x is None or x == "":
@@ -25,18 +32,68 @@ def to_int(x) -> Optional[int]:
     except Exception:
         return None
 
+# Fast path for the stream's ISO dates; anything else goes through dateutil.
+@lru_cache(maxsize=1 << 16)
+def _iso_ymd(s: str) -> Optional[Tuple[int, int, int]]:
+    """(year, month, day) of a valid 'YYYY-MM-DD', else None."""
+    if len(s) != 10 or s[4] != "-" or s[7] != "-" or not s.isascii():
+        return None
+    y, m, d = s[0:4], s[5:7], s[8:10]
+    if not (y.isdigit() and m.isdigit() and d.isdigit()):
+        return None
+    y, m, d = int(y), int(m), int(d)
+    if not (1 <= y and 1 <= m <= 12 and 1 <= d <= _days_in_month(y, m)):
+        return None
+    return y, m, d
+
+def _days_in_month(y: int, m: int) -> int:
+    if m == 2:
+        return 29 if (y % 4 == 0 and (y % 100 != 0 or y % 400 == 0)) else 28
+    return 30 if m in (4, 6, 9, 11) else 31
+
+def days_from_civil(y: int, m: int, d: int) -> int:
+    """Days since 1970-01-01 of a proleptic Gregorian date (H. Hinnant's algorithm)."""
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((m + 9) % 12) + 2) // 5 + d - 1
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+def civil_from_days(z: int) -> Tuple[int, int, int]:
+    """Inverse of days_from_civil."""
+    z += 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (m <= 2), m, d
+
+def _ymd(s: str) -> Tuple[int, int, int]:
+    """Date parts of s; raises like dateutil when s is not a date."""
+    parts = _iso_ymd(s)
+    if parts is None:
+        dt = dtparser.parse(s)
+        parts = (dt.year, dt.month, dt.day)
+    return parts
+
 def parse_date(s: str):
     try:
-        return dtparser.parse(s)
+        parts = _iso_ymd(s)
+        return datetime(*parts) if parts is not None else dtparser.parse(s)
     except Exception:
         return None
 
 def compute_age(dob: str, at_unix: int) -> int:
     try:
-        dob_dt = dtparser.parse(dob)
-        from datetime import datetime, timezone
-        t = datetime.fromtimestamp(int(at_unix), tz=timezone.utc)
-        years = t.year - dob_dt.year - ((t.month, t.day) < (dob_dt.month, dob_dt.day))
+        by, bm, bd = _ymd(dob)
+        ux = int(at_unix)
+        if not MIN_UNIX <= ux <= MAX_UNIX:
+            return -1
+        y, m, d = civil_from_days(ux // 86400)
+        years = y - by - ((m, d) < (bm, bd))
         return max(0, years)
     except Exception:
         return -1
@@ -59,8 +116,9 @@ def hour_of_day(trans_time: str) -> int:
         return -1
 
 def dow_from_date(trans_date: str) -> int:
+    """Weekday (Monday=0) of the local trans_date; it does not match unix_time's UTC date."""
     try:
-        return dtparser.parse(trans_date).weekday()
+        return (days_from_civil(*_ymd(trans_date)) + 3) % 7
     except Exception:
         return -1
 
@@ -74,53 +132,533 @@ def safe_str(x) -> str:
 # IN-MEMORY HISTORY
 # ==================
 
-def build_history():
-    return defaultdict(list)
+VELOCITY_WINDOWS = (60, 5*60, 15*60, 60*60)
+DISTINCT_WINDOW = 15*60
+STATS_WINDOW = 24*60*60
+NEVER = 10**9
+# Entries are kept this long behind the newest one; transactions arriving up to
+# HISTORY_LATENESS late still see exact windows.
+HISTORY_LATENESS = 60*60
+HISTORY_RETENTION = STATS_WINDOW + HISTORY_LATENESS
+EVICT_EVERY = 10_000  # adds between eviction sweeps
+# The interned name table is compacted once it holds twice the names still in
+# use at the last compaction (and at least this many).
+INTERN_COMPACT_MIN = 4096
+# Column storage: int64 times, float64 amounts (NaN when absent), int32
+# interned merchant / category ids; MISSING marks an absent time.
+MISSING = -(2**63)
+# Window sums add amounts as integers in units of 2**-AMOUNT_BITS, which is
+# exact for every float amount of magnitude 2**-28 or more. Sums and sums of
+# squares are then exact and identical in every history backend, and mean/std
+# are rounded once, from the exact values.
+AMOUNT_BITS = 80
+_AMOUNT_MAX = 2.0 ** 512
+
+def to_amount(x) -> Optional[float]:
+    """Amount as the window stats count it: a finite float, else None."""
+    v = to_float(x)
+    if v is None or not abs(v) < _AMOUNT_MAX:
+        return None
+    return v
+
+def fixed_amount(v: float) -> int:
+    return int(math.ldexp(v, AMOUNT_BITS))
+
+def amount_stats(n: int, s: int, q: int):
+    """Mean/std (population) from the count, sum and sum of squares of fixed_amount values."""
+    if n <= 0:
+        return 0.0, 0.0
+    scale = n << AMOUNT_BITS
+    var = (n * q - s * s) / (scale * scale)
+    return s / scale, (math.sqrt(var) if var > 0 else 0.0)
+
+class CardState:
+    """
+    History of one card with incrementally maintained window aggregates.
+
+    Entries are parallel typed arrays (time, amount, merchant id, category id)
+    sorted by time, ties in arrival order; about 24 bytes each. Every window is a
+    [lo, hi) slice over them where hi points past the last entry strictly
+    before the queried time. For an in-order stream the slices only move
+    forward, so a query is O(1) amortized; out-of-order arrivals and queries
+    stay exact and just pay for the extra movement.
+
+    evict() drops entries no window reaches any more; what outlives them is
+    the per-merchant summary and the time of the newest evicted entry.
+    """
+
+    __slots__ = (
+        "times", "amounts", "merchants", "categories",
+        "qt", "hi", "lo", "merch_15", "cat_15", "n_24", "s_24", "q_24",
+        "merchant_slot", "merchant_seen", "evicted_last",
+    )
+
+    def __init__(self):
+        self.times = array("q")
+        self.amounts = array("d")
+        self.merchants = array("i")
+        self.categories = array("i")
+        self.qt: Optional[int] = None  # time the slices currently point at
+        self.hi = 0
+        self.lo = {w: 0 for w in VELOCITY_WINDOWS + (STATS_WINDOW,)}
+        self.merch_15: Dict[int, int] = {}
+        self.cat_15: Dict[int, int] = {}
+        self.n_24 = 0
+        self.s_24 = 0
+        self.q_24 = 0
+        # merchant id -> slot; merchant_seen[3*slot:3*slot+3] holds its first,
+        # prev and last seen time, prev being the latest time < last (or MISSING).
+        self.merchant_slot: Dict[int, int] = {}
+        self.merchant_seen = array("q")
+        self.evicted_last: Optional[int] = None
+
+    # --- window aggregates ---
+
+    def _distinct_in(self, i):
+        m, c = self.merchants[i], self.categories[i]
+        self.merch_15[m] = self.merch_15.get(m, 0) + 1
+        self.cat_15[c] = self.cat_15.get(c, 0) + 1
+
+    def _distinct_out(self, i):
+        for counter, key in ((self.merch_15, self.merchants[i]), (self.cat_15, self.categories[i])):
+            k = counter[key] - 1
+            if k:
+                counter[key] = k
+            else:
+                del counter[key]
 
-def add_to_history(history, tx, counter=[0]):
+    def _stats_in(self, i):
+        a = self.amounts[i]
+        if a == a:
+            a = fixed_amount(a)
+            self.n_24 += 1; self.s_24 += a; self.q_24 += a * a
+
+    def _stats_out(self, i):
+        a = self.amounts[i]
+        if a == a:
+            a = fixed_amount(a)
+            self.n_24 -= 1; self.s_24 -= a; self.q_24 -= a * a
+
+    @staticmethod
+    def _slide(lo, hi, nlo, nhi, enter, leave):
+        """Move an aggregate from [lo, hi) to [nlo, nhi), growing before shrinking."""
+        if nhi <= lo or nlo >= hi:
+            for i in range(lo, hi): leave(i)
+            for i in range(nlo, nhi): enter(i)
+            return
+        for i in range(nlo, lo): enter(i)
+        for i in range(hi, nhi): enter(i)
+        for i in range(lo, nlo): leave(i)
+        for i in range(nhi, hi): leave(i)
+
+    def _seek(self, i, bound):
+        """Move index i until times[:i] < bound <= times[i:]."""
+        times = self.times
+        n = len(times)
+        while i < n and times[i] < bound:
+            i += 1
+        while i > 0 and times[i - 1] >= bound:
+            i -= 1
+        return i
+
+    def seek(self, ux):
+        """Point every window at [ux - w, ux)."""
+        if self.qt == ux:
+            return
+        hi = self._seek(self.hi, ux)
+        lo = {w: self._seek(i, ux - w) for w, i in self.lo.items()}
+        self._slide(self.lo[DISTINCT_WINDOW], self.hi, lo[DISTINCT_WINDOW], hi,
+                    self._distinct_in, self._distinct_out)
+        self._slide(self.lo[STATS_WINDOW], self.hi, lo[STATS_WINDOW], hi,
+                    self._stats_in, self._stats_out)
+        self.hi, self.lo, self.qt = hi, lo, ux
+
+    # --- updates ---
+
+    def add(self, t: int, amount: Optional[float], merchant: int, category: int):
+        """Adds an entry (interned ids, amount from to_amount); returns a token that discard() accepts to undo it."""
+        if amount is None:
+            amount = math.nan
+        times = self.times
+        if not times or t >= times[-1]:
+            idx = len(times)
+        else:
+            idx = bisect.bisect_right(times, t)
+        times.insert(idx, t)
+        self.amounts.insert(idx, amount)
+        self.merchants.insert(idx, merchant)
+        self.categories.insert(idx, category)
+
+        # Only entries before the current query time sit inside the slices.
+        if self.qt is not None and t < self.qt:
+            self.hi += 1
+            for w in self.lo:
+                if t < self.qt - w:
+                    self.lo[w] += 1
+                elif w == DISTINCT_WINDOW:
+                    self._distinct_in(idx)
+                elif w == STATS_WINDOW:
+                    self._stats_in(idx)
+
+        slot = self.merchant_slot.get(merchant)
+        if slot is None:
+            self.merchant_slot[merchant] = len(self.merchant_slot)
+            self.merchant_seen.extend((t, MISSING, t))
+            return idx, merchant, None
+        seen = self.merchant_seen
+        j = 3 * slot
+        first, prev, last = seen[j:j + 3]
+        if t > last:
+            seen[j + 1], seen[j + 2] = last, t
+        elif t < last:
+            seen[j] = min(first, t)
+            if t > prev:
+                seen[j + 1] = t
+        return idx, merchant, (first, prev, last)
+
+    def discard(self, token):
+        """Undoes add(); tokens must be discarded in reverse order of their adds."""
+        idx, merchant, seen = token
+        t = self.times[idx]
+        if self.qt is not None and t < self.qt:
+            self.hi -= 1
+            for w in self.lo:
+                if t < self.qt - w:
+                    self.lo[w] -= 1
+                elif w == DISTINCT_WINDOW:
+                    self._distinct_out(idx)
+                elif w == STATS_WINDOW:
+                    self._stats_out(idx)
+        del self.times[idx], self.amounts[idx], self.merchants[idx], self.categories[idx]
+        if seen is None:
+            # First sighting: LIFO discards mean it still owns the last slot.
+            del self.merchant_slot[merchant]
+            del self.merchant_seen[-3:]
+        else:
+            j = 3 * self.merchant_slot[merchant]
+            self.merchant_seen[j:j + 3] = array("q", seen)
+
+    def evict(self, before: int) -> int:
+        """
+        Drops entries older than before; returns how many. Outstanding undo
+        tokens become invalid, so only evict between batches.
+        """
+        k = bisect.bisect_left(self.times, before)
+        if not k:
+            return 0
+        if self.qt is not None and k > min(self.lo.values()):
+            # Evicting inside a live window (a stale query point): rebuild on next seek.
+            self.qt, self.hi = None, 0
+            self.lo = {w: 0 for w in self.lo}
+            self.merch_15.clear(); self.cat_15.clear()
+            self.n_24 = self.s_24 = self.q_24 = 0
+        elif self.qt is not None:
+            self.hi -= k
+            self.lo = {w: i - k for w, i in self.lo.items()}
+        self.evicted_last = max(self.times[k - 1], self.evicted_last or self.times[k - 1])
+        del self.times[:k], self.amounts[:k], self.merchants[:k], self.categories[:k]
+        return k
+
+    def empty(self) -> bool:
+        """Holds nothing, not even a summary (every add was discarded): same as no card at all."""
+        return not self.times and self.evicted_last is None and not self.merchant_slot
+
+    def used_ids(self, ids: set):
+        ids.update(self.merchants); ids.update(self.categories); ids.update(self.merchant_slot)
+
+    def remap(self, new: Dict[int, int]):
+        """Renumbers interned ids (old -> new); every id in use must be mapped."""
+        self.merchants = array("i", [new[i] for i in self.merchants])
+        self.categories = array("i", [new[i] for i in self.categories])
+        self.merchant_slot = {new[m]: slot for m, slot in self.merchant_slot.items()}
+        self.merch_15 = {new[m]: k for m, k in self.merch_15.items()}
+        self.cat_15 = {new[c]: k for c, k in self.cat_15.items()}
+
+    # --- queries (valid after seek(ux)) ---
+
+    def velocity(self, w: int) -> int:
+        return self.hi - self.lo[w]
+
+    def last_time(self) -> Optional[int]:
+        if self.hi:
+            return self.times[self.hi - 1]
+        if self.evicted_last is not None and self.evicted_last < self.qt:
+            return self.evicted_last
+        return None
+
+    def _seen(self, merchant: Optional[int]):
+        slot = self.merchant_slot.get(merchant)
+        if slot is None:
+            return None
+        return self.merchant_seen[3 * slot:3 * slot + 3]
+
+    def seen_merchant(self, merchant: Optional[int]) -> int:
+        seen = self._seen(merchant)
+        return 1 if seen is not None and seen[0] < self.qt else 0
+
+    def last_merchant_time(self, merchant: Optional[int]) -> Optional[int]:
+        seen = self._seen(merchant)
+        if seen is None or seen[0] >= self.qt:
+            return None
+        first, prev, last = seen
+        if last < self.qt:
+            return last
+        if prev != MISSING and prev < self.qt:
+            return prev
+        for i in range(self.hi - 1, -1, -1):
+            if self.merchants[i] == merchant:
+                return self.times[i]
+        # Only reachable for queries older than the eviction horizon.
+        return first
+
+class History(dict):
     """
-    Adds a transaction to history. counter is a tie-breaker to prevent bisect
-    from trying to compare dicts when timestamps are equal.
+    cc_num -> CardState with bounded memory: every EVICT_EVERY adds, entries
+    older than the newest transaction minus retention are dropped. Cards keep
+    their summary for good, so every feature stays exact; only cards left
+    empty by discarded adds are deleted. The sweep runs from maybe_evict(),
+    which callers invoke between batches.
+
+    Merchant and category names are interned once here; cards store ids.
+    Sweeps renumber them densely once unused names pile up.
+    """
+
+    def __init__(self, retention: int = HISTORY_RETENTION, evict_every: int = EVICT_EVERY):
+        super().__init__()
+        self.retention = retention
+        self.evict_every = evict_every
+        self.adds = 0
+        self.entries = 0  # live entries over all cards
+        self.evicted = 0
+        self.watermark: Optional[int] = None
+        self.ids: Dict[str, int] = {}
+        self.ids_in_use = 0  # names left after the last compaction
+
+    def intern(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.ids)
+        return i
+
+    def __missing__(self, cc: str) -> CardState:
+        state = self[cc] = CardState()
+        return state
+
+    def maybe_evict(self) -> int:
+        if self.adds < self.evict_every:
+            return 0
+        return self.evict()
+
+    def evict(self) -> int:
+        self.adds = 0
+        newest = max((s.times[-1] for s in self.values() if s.times), default=None)
+        if newest is not None:
+            self.watermark = newest if self.watermark is None else max(self.watermark, newest)
+        before = None if self.watermark is None else self.watermark - self.retention
+        n, empty = 0, []
+        for cc, s in self.items():
+            if before is not None:
+                n += s.evict(before)
+            if s.empty():
+                empty.append(cc)
+        for cc in empty:
+            del self[cc]
+        self.entries -= n
+        self.evicted += n
+        if len(self.ids) >= max(INTERN_COMPACT_MIN, 2 * self.ids_in_use):
+            self.compact_ids()
+        return n
+
+    def compact_ids(self):
+        """Drops interned names no card refers to and renumbers the rest in order."""
+        used: set = set()
+        for s in self.values():
+            s.used_ids(used)
+        names = [name for name, i in self.ids.items() if i in used]
+        new = {self.ids[name]: j for j, name in enumerate(names)}
+        for s in self.values():
+            s.remap(new)
+        self.ids = {name: j for j, name in enumerate(names)}
+        self.ids_in_use = len(names)
+
+    def size(self) -> int:
+        return self.entries
+
+def build_history(retention: int = HISTORY_RETENTION):
+    return History(retention)
+
+def history_features_mem(history, cc: str, ux: int, merchant: str) -> tuple:
+    state = history.get(cc)
+    if state is None:
+        return (0, 0, 0, 0, 0, 0, 0, None, None, 0, 0, 0)
+    state.seek(ux)
+    mid = history.ids.get(merchant)
+    return (
+        *(state.velocity(w) for w in VELOCITY_WINDOWS),
+        len(state.merch_15), len(state.cat_15),
+        state.seen_merchant(mid), state.last_time(), state.last_merchant_time(mid),
+        state.n_24, state.s_24, state.q_24,
+    )
+
+def add_to_history(history, tx):
+    """
+    Adds a transaction to its card's history, parsing the fields features need
+    once. Returns a token for discard_from_history.
     """
     cc = safe_str(tx.get("cc_num"))
     t = to_int(tx.get("unix_time")) or 0
-    counter[0] += 1
-    bisect.insort(history[cc], (t, counter[0], tx))
-
-def get_recent(history, cc, before_unix, window_secs):
-    lo = before_unix - window_secs
-    return [tx for t, _, tx in history.get(cc, []) if lo <= t < before_unix]
-
-def get_last(history, cc, before_unix):
-    h = history.get(cc, [])
-    for t, _, tx in reversed(h):
-        if t < before_unix:
-            return tx
-    return None
-
-def has_seen_merchant(history, cc, merchant, before_unix):
-    h = history.get(cc, [])
-    for t, _, tx in reversed(h):
-        if t < before_unix and safe_str(tx.get("merchant")) == merchant:
-            return 1
-    return 0
-
-def distinct_merchants(history, cc, before_unix, window_secs):
-    lo = before_unix - window_secs
-    return len({safe_str(tx.get("merchant")) for t, _, tx in history.get(cc, []) if lo <= t < before_unix})
-
-def distinct_categories(history, cc, before_unix, window_secs):
-    lo = before_unix - window_secs
-    return len({safe_str(tx.get("category")) for t, _, tx in history.get(cc, []) if lo <= t < before_unix})
-
-def user_amount_stats(history, cc, before_unix, window_secs):
-    lo = before_unix - window_secs
-    vals = [to_float(tx.get("amt")) for t, _, tx in history.get(cc, []) if lo <= t < before_unix]
-    vals = [v for v in vals if v is not None]
-    if not vals:
-        return 0.0, 0.0
-    arr = np.array(vals)
-    return float(np.mean(arr)), float(np.std(arr))
+    history.adds += 1
+    history.entries += 1
+    return cc, history[cc].add(t, to_amount(tx.get("amt")),
+                               history.intern(safe_str(tx.get("merchant"))),
+                               history.intern(safe_str(tx.get("category"))))
+
+def discard_from_history(history, token):
+    cc, card_token = token
+    history[cc].discard(card_token)
+    history.entries -= 1
+
+# ==============
+# SQLITE HISTORY
+# ==============
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+TX_COLUMNS = [
+    "transaction_id", "unix_time", "trans_date", "trans_time",
+    "ssn", "cc_num", "acct_num", "first", "last", "gender",
+    "street", "city", "state", "zip", "lat", "long",
+    "city_pop", "job", "dob", "category", "amt", "merchant", "merch_lat", "merch_long",
+]
+_REAL_COLUMNS = {"lat", "long", "amt", "merch_lat", "merch_long"}
+# Keys the features group by are stored the way safe_str sees them.
+_KEY_COLUMNS = {"cc_num", "merchant", "category"}
+
+INSERT_TX_SQL = (
+    f"INSERT OR IGNORE INTO tx ({', '.join(TX_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in TX_COLUMNS)})"
+)
+
+# One statement per feature lookup; every part is a range scan on an index.
+# card_merchant only has rows once compact_history has removed old tx rows.
+HISTORY_SQL = f"""
+SELECT
+  (SELECT MAX(unix_time) FROM tx WHERE cc_num = :cc AND unix_time < :ux),
+  (SELECT MAX(last_time) FROM card_merchant WHERE cc_num = :cc AND last_time < :ux),
+  (SELECT MAX(unix_time) FROM tx WHERE cc_num = :cc AND merchant = :merchant AND unix_time < :ux),
+  (SELECT last_time FROM card_merchant WHERE cc_num = :cc AND merchant = :merchant AND last_time < :ux),
+  COALESCE(SUM(unix_time >= :ux - {VELOCITY_WINDOWS[0]}), 0),
+  COALESCE(SUM(unix_time >= :ux - {VELOCITY_WINDOWS[1]}), 0),
+  COALESCE(SUM(unix_time >= :ux - {VELOCITY_WINDOWS[2]}), 0),
+  COALESCE(SUM(unix_time >= :ux - {VELOCITY_WINDOWS[3]}), 0),
+  COUNT(DISTINCT CASE WHEN unix_time >= :ux - {DISTINCT_WINDOW} THEN COALESCE(merchant, '') END),
+  COUNT(DISTINCT CASE WHEN unix_time >= :ux - {DISTINCT_WINDOW} THEN COALESCE(category, '') END),
+  amount_sums(amt)
+FROM tx
+WHERE cc_num = :cc AND unix_time >= :ux - {STATS_WINDOW} AND unix_time < :ux
+"""
+
+COMPACT_SUMMARY_SQL = """
+INSERT INTO card_merchant (cc_num, merchant, last_time)
+SELECT cc_num, merchant, MAX(unix_time) FROM tx
+WHERE unix_time < ? AND cc_num IS NOT NULL AND merchant IS NOT NULL
+GROUP BY cc_num, merchant
+ON CONFLICT (cc_num, merchant) DO UPDATE SET last_time = MAX(last_time, excluded.last_time)
+"""
+
+class _AmountSums:
+    """amount_sums(amt): 'n,s,q' over fixed_amount values; SQLite integers would overflow."""
+
+    def __init__(self):
+        self.n = self.s = self.q = 0
+
+    def step(self, v):
+        v = None if v is None else to_amount(v)
+        if v is not None:
+            a = fixed_amount(v)
+            self.n += 1; self.s += a; self.q += a * a
+
+    def finalize(self):
+        return f"{self.n},{self.s},{self.q}"
+
+def _register_functions(conn: sqlite3.Connection):
+    # Same sums as the in-memory path, so both backends produce identical stats.
+    conn.create_aggregate("amount_sums", 1, _AmountSums)
+
+def connect_db(path: str) -> sqlite3.Connection:
+    """
+    Opens a history connection: WAL so readers never block the writer, and a
+    large statement cache so the feature/insert statements stay prepared.
+    Connections are not shared between threads; open one per thread.
+    """
+    conn = sqlite3.connect(path, timeout=30.0, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    _register_functions(conn)
+    return conn
+
+def ensure_schema(conn: sqlite3.Connection):
+    with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+        conn.executescript(f.read())
+    _register_functions(conn)
+    conn.commit()
+
+def _tx_row(tx: Dict[str, Any]) -> tuple:
+    row = []
+    for col in TX_COLUMNS:
+        if col == "transaction_id":
+            v = tx.get("transaction_id") or tx.get("trans_num")
+        elif col == "unix_time":
+            v = to_int(tx.get("unix_time")) or 0
+        elif col == "city_pop":
+            v = to_int(tx.get("city_pop"))
+        elif col in _REAL_COLUMNS:
+            v = to_float(tx.get(col))
+        elif col in _KEY_COLUMNS:
+            v = safe_str(tx.get(col))
+        else:
+            v = tx.get(col)
+            v = None if v is None else str(v)
+        row.append(v)
+    return tuple(row)
+
+def insert_txs(conn: sqlite3.Connection, txs: List[Dict[str, Any]], commit: bool = True) -> int:
+    """
+    Inserts transactions in one statement batch; duplicates by transaction id
+    are ignored. Returns how many rows were inserted.
+    """
+    inserted = conn.executemany(INSERT_TX_SQL, [_tx_row(tx) for tx in txs]).rowcount
+    if commit:
+        conn.commit()
+    return inserted
+
+def insert_tx(conn: sqlite3.Connection, tx: Dict[str, Any], commit: bool = True) -> int:
+    return insert_txs(conn, [tx], commit=commit)
+
+def compact_history(conn: sqlite3.Connection, before: int, commit: bool = True) -> int:
+    """
+    TTL compaction: folds tx rows older than before into card_merchant and
+    deletes them. Features stay exact for transactions newer than
+    before + STATS_WINDOW. Returns the number of rows removed.
+    """
+    conn.execute(COMPACT_SUMMARY_SQL, (before,))
+    removed = conn.execute("DELETE FROM tx WHERE unix_time < ?", (before,)).rowcount
+    if commit:
+        conn.commit()
+    return removed
+
+def _latest(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+def history_features_db(conn: sqlite3.Connection, cc: str, ux: int, merchant: str) -> tuple:
+    row = conn.execute(HISTORY_SQL, {"cc": cc, "ux": ux, "merchant": merchant}).fetchone()
+    last_tx, last_summary, merch_tx, merch_summary, v60, v5m, v15m, v1h, um, uc, sums = row
+    n, s, q = (int(v) for v in sums.split(",")) if sums else (0, 0, 0)  # NULL: no rows in the window
+    last_time = _latest(last_tx, last_summary)
+    last_merchant = _latest(merch_tx, merch_summary)
+    return (v60, v5m, v15m, v1h, um, uc, 1 if last_merchant is not None else 0,
+            last_time, last_merchant, n, s, q)
 
 # ==================
 # FEATURE EXTRACTION
@@ -137,7 +675,12 @@ FEATURE_ORDER = [
     "gender_M", "gender_F",
 ]
 
-def tx_to_features_mem(tx: Dict[str, Any], history) -> Dict[str, float]:
+def _tx_features(tx: Dict[str, Any], history_lookup) -> Dict[str, float]:
+    """
+    Builds the feature map for tx. history_lookup(cc, ux, merchant) returns the
+    history aggregates over transactions strictly before ux (see
+    history_features_mem / history_features_db).
+    """
     ux = to_int(tx.get("unix_time")) or 0
     amt = to_float(tx.get("amt")) or 0.0
     lat = to_float(tx.get("lat"))
@@ -153,35 +696,12 @@ def tx_to_features_mem(tx: Dict[str, Any], history) -> Dict[str, float]:
     is_night = is_night_time(hour)
     city_pop = to_int(tx.get("city_pop")) or 0
 
-    v60  = len(get_recent(history, cc, ux, 60))
-    v5m  = len(get_recent(history, cc, ux, 5*60))
-    v15m = len(get_recent(history, cc, ux, 15*60))
-    v1h  = len(get_recent(history, cc, ux, 60*60))
-
-    last = get_last(history, cc, ux)
-    if last:
-        last_time = to_int(last.get("unix_time")) or 0
-        time_since_last = max(0, ux - last_time)
-        last_lat = to_float(last.get("lat"))
-        last_lon = to_float(last.get("long"))
-        last_mlat = to_float(last.get("merch_lat"))
-        last_mlon = to_float(last.get("merch_long"))
-        dist_km = haversine_km(last_mlat or last_lat, last_mlon or last_lon, mlat or lat, mlon or lon)
-        # time since last same merchant
-        time_since_last_merchant = 10**9
-        for t, _, tx2 in reversed(history.get(cc, [])):
-            if t < ux and safe_str(tx2.get("merchant")) == merchant:
-                time_since_last_merchant = max(0, ux - t)
-                break
-    else:
-        time_since_last = 10**9
-        dist_km = float("nan")
-        time_since_last_merchant = 10**9
-
-    seen_before = has_seen_merchant(history, cc, merchant, ux)
-    uniq_merch_15 = distinct_merchants(history, cc, ux, 15*60)
-    uniq_cat_15 = distinct_categories(history, cc, ux, 15*60)
-    mean24, std24 = user_amount_stats(history, cc, ux, 24*60*60)
+    (v60, v5m, v15m, v1h, uniq_merch_15, uniq_cat_15, seen_before,
+     last_time, last_merchant, n24, s24, q24) = history_lookup(cc, ux, merchant)
+    mean24, std24 = amount_stats(n24, s24, q24)
+
+    time_since_last = max(0, ux - last_time) if last_time is not None else NEVER
+    time_since_last_merchant = max(0, ux - last_merchant) if last_merchant is not None else NEVER
     amt_delta = amt - mean24
     z = amt_delta / std24 if std24 > 0 else 0.0
 
@@ -206,5 +726,11 @@ def tx_to_features_mem(tx: Dict[str, Any], history) -> Dict[str, float]:
         "gender_M": gM, "gender_F": gF,
     }
 
+def tx_to_features_mem(tx: Dict[str, Any], history) -> Dict[str, float]:
+    return _tx_features(tx, lambda cc, ux, merchant: history_features_mem(history, cc, ux, merchant))
+
+def tx_to_features(tx: Dict[str, Any], conn: sqlite3.Connection) -> Dict[str, float]:
+    return _tx_features(tx, lambda cc, ux, merchant: history_features_db(conn, cc, ux, merchant))
+
 def ordered_feature_row(feat: Dict[str, float], order: List[str]) -> List[float]:
     return [float(feat.get(name, 0.0) or 0.0) for name in order]
@@ -0,0 +1,349 @@
+"""
+Durable outbox for flag submissions.
+
+add(trans_num, flag_value) records the verdict in an append-only journal
+and queues it; `concurrency` sender tasks deliver queued flags through an
+async send callable (see http_sender), which returns the HTTP status.
+A failed attempt is parked on a timer wheel: one ticker task wakes every
+`tick` seconds and releases every retry that fell due in that slot, instead
+of one sleeping task per flag. Adding a trans_num that is still pending
+only updates its value, so each flag is delivered once, with the latest
+verdict. At most max_pending flags are held; new ones beyond that are
+dropped and counted, so an endpoint that stays down cannot exhaust memory.
+
+The journal is JSON lines: {"t": trans_num, "f": flag} when queued and
+{"t": trans_num, "d": status} when delivered or given up. Records are
+buffered on the event loop and written by one journal task in an executor,
+so a burst of flags costs one write (and fsync) instead of one each. On
+start the journal is replayed (queued minus finished is pending again) and
+rewritten with just the pending entries; the journal task rewrites it again
+whenever finished records dominate. Delivery is at-least-once: a flag in
+flight during a crash is sent again after restart, while one added within
+the last journal write of a crash can be lost.
+"""
+
+import asyncio
+import json
+import math
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from logs import get_logger
+from metrics import Counter, Gauge, Histogram
+
+log = get_logger("flag_outbox")
+
+SEND_SECONDS = Histogram("flag_outbox_send_seconds", "Time per flag POST attempt", ["result"])
+RETRIES = Counter("flag_outbox_retries_total", "Flag attempts rescheduled after a failure")
+RESULTS = Counter("flag_outbox_results_total", "Flags finished, by result", ["result"])
+
+# Statuses worth retrying; any other non-2xx means the request itself is wrong.
+RETRYABLE = {408, 425, 429}
+
+class TimerWheel:
+    """Hashed timer wheel: schedule() is O(1), advance() returns the items due this tick."""
+
+    def __init__(self, tick: float, slots: int = 512):
+        self.tick = tick
+        self.slots: List[List[Tuple[int, Any]]] = [[] for _ in range(slots)]
+        self.position = 0
+        self.size = 0
+
+    def schedule(self, item: Any, delay: float):
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.slots)
+        slot = (self.position + offset) % len(self.slots)
+        self.slots[slot].append((rounds, item))
+        self.size += 1
+
+    def advance(self) -> List[Any]:
+        self.position = (self.position + 1) % len(self.slots)
+        due, keep = [], []
+        for rounds, item in self.slots[self.position]:
+            if rounds:
+                keep.append((rounds - 1, item))
+            else:
+                due.append(item)
+        self.slots[self.position] = keep
+        self.size -= len(due)
+        return due
+
+def http_sender(session, url: str, headers_json: Dict[str, str], headers_form: Dict[str, str]
+                ) -> Callable[[str, int], Awaitable[int]]:
+    """send(trans_num, flag_value) -> status: JSON POST, resent form-encoded on 400/415."""
+    async def send(trans_num: str, flag_value: int) -> int:
+        payload = {"trans_num": trans_num, "flag_value": int(flag_value)}
+        async with session.post(url, headers=headers_json, json=payload) as resp:
+            status, text = resp.status, await resp.text()
+        if status in (400, 415):
+            async with session.post(url, headers=headers_form, data=payload) as resp:
+                status, text = resp.status, await resp.text()
+        log.debug("Flag %s: HTTP %d %s", trans_num, status, text.strip())
+        return status
+    return send
+
+class FlagOutbox:
+    def __init__(self, send: Callable[[str, int], Awaitable[int]], path: str = "",
+                 concurrency: int = 4, max_attempts: int = 0, base_delay: float = 0.5,
+                 max_delay: float = 8.0, tick: float = 0.1, fsync: bool = False,
+                 max_pending: int = 100_000):
+        """
+        path "" keeps the outbox in memory only. max_attempts 0 retries until
+        delivered (permanent 4xx answers still give up). max_pending caps the
+        flags held at once; flags added beyond it are dropped.
+        """
+        self.send = send
+        self.path = path
+        self.concurrency = max(1, int(concurrency))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.max_pending = max(1, int(max_pending))
+        self.pending: Dict[str, int] = {}
+        self.attempts: Dict[str, int] = {}
+        self.wheel = TimerWheel(tick)
+        self._ready: "asyncio.Queue[str]" = asyncio.Queue()
+        self._queued = set()  # in _ready, on the wheel or being sent
+        self._journal = None
+        self._finished_records = 0
+        self._buffer: List[Dict[str, Any]] = []  # records not yet written to the journal
+        self._dirty = asyncio.Event()
+        self._rewrite_due = False
+        self._closing = False
+        self._journal_task: Optional[asyncio.Task] = None
+        self._overflowing = False
+        self._tasks: List[asyncio.Task] = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stats = {"added": 0, "coalesced": 0, "delivered": 0, "failed": 0, "dropped": 0,
+                       "retries": 0, "in_flight": 0}
+        Gauge("flag_outbox_pending", "Flags queued, in flight or waiting for a retry", fn=lambda: len(self.pending))
+
+    # =======
+    # JOURNAL
+    # =======
+
+    def _load(self) -> Dict[str, int]:
+        pending: Dict[str, int] = {}
+        if not self.path or not os.path.exists(self.path):
+            return pending
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    if "d" in rec:
+                        pending.pop(rec["t"], None)
+                    else:
+                        pending[rec["t"]] = int(rec["f"])
+                except (ValueError, KeyError, TypeError):
+                    continue  # torn last line after a crash, or a malformed record
+        return pending
+
+    def _write_pending(self, entries: List[Tuple[str, int]]) -> str:
+        """Writes entries to a temp journal (runs in an executor thread); returns its path."""
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for t, v in entries:
+                f.write(json.dumps({"t": t, "f": v}) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        return tmp
+
+    async def _rewrite(self):
+        """
+        Replaces the journal with the pending entries only. Buffered records
+        stay buffered and are written to the new journal afterwards; replaying
+        them on top of the snapshot changes nothing, and if the rewrite fails
+        they still go to the old one.
+        """
+        self._finished_records = sum("d" in rec for rec in self._buffer)
+        tmp = await asyncio.get_running_loop().run_in_executor(
+            None, self._write_pending, list(self.pending.items()))
+        os.replace(tmp, self.path)
+        journal, self._journal = self._journal, open(self.path, "a", encoding="utf-8")
+        if journal is not None:
+            journal.close()
+
+    def _write_records(self, records: List[Dict[str, Any]]):
+        """Appends records to the journal (runs in an executor thread)."""
+        self._journal.write("".join(json.dumps(rec) + "\n" for rec in records))
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    async def _journal_writer(self):
+        """The only task touching the journal file: rewrites it when due, writes buffered records in order."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            if self._rewrite_due:
+                self._rewrite_due = False
+                try:
+                    await self._rewrite()
+                except Exception as e:
+                    log.error("Rewriting %s failed, keeping the full journal: %s", self.path, e)
+            if self._buffer:
+                records, self._buffer = self._buffer, []
+                try:
+                    await loop.run_in_executor(None, self._write_records, records)
+                except Exception as e:
+                    log.error("Appending %d records to %s failed: %s", len(records), self.path, e)
+            if self._closing and not self._buffer:
+                return
+
+    def _append(self, rec: Dict[str, Any]):
+        if self._journal is None:
+            return
+        self._buffer.append(rec)
+        self._dirty.set()
+
+    def _finish(self, trans_num: str, status: int, result: str):
+        self.pending.pop(trans_num, None)
+        self.attempts.pop(trans_num, None)
+        self._queued.discard(trans_num)
+        self._stats[result] += 1
+        RESULTS.labels(result).inc()
+        self._append({"t": trans_num, "d": status})
+        self._finished_records += 1
+        if (self._journal is not None and not self._rewrite_due
+                and self._finished_records > max(10_000, 2 * len(self.pending))):
+            self._rewrite_due = True
+            self._dirty.set()
+        if len(self.pending) < self.max_pending:
+            self._overflowing = False
+        if not self.pending:
+            self._idle.set()
+
+    # =========
+    # LIFECYCLE
+    # =========
+
+    async def start(self):
+        """Resumes pending flags from the journal and starts the sender and ticker tasks."""
+        self.pending = self._load()
+        if self.path:
+            await self._rewrite()
+        if self.pending:
+            log.info("Resuming %d pending flags from %s", len(self.pending), self.path)
+            self._idle.clear()
+            for t in self.pending:
+                self._enqueue(t)
+        self._tasks = [asyncio.create_task(self._sender()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._ticker()))
+        if self._journal is not None:
+            self._journal_task = asyncio.create_task(self._journal_writer())
+
+    async def close(self):
+        """Stops sending; anything not delivered stays in the journal for the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._journal_task is not None:
+            self._closing = True
+            self._dirty.set()
+            await asyncio.gather(self._journal_task, return_exceptions=True)
+            self._journal_task = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Waits until nothing is pending; False on timeout."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "pending": len(self.pending), "retry_scheduled": self.wheel.size}
+
+    # =======
+    # SENDING
+    # =======
+
+    def add(self, trans_num: str, flag_value: int):
+        flag_value = int(flag_value)
+        if trans_num in self.pending:
+            self._stats["coalesced"] += 1
+            if self.pending[trans_num] == flag_value:
+                return
+        elif len(self.pending) >= self.max_pending:
+            self._stats["dropped"] += 1
+            RESULTS.labels("dropped").inc()
+            if not self._overflowing:
+                self._overflowing = True
+                log.error("Flag outbox is full (%d pending), dropping new flags until it drains",
+                          len(self.pending))
+            return
+        else:
+            self._stats["added"] += 1
+        self.pending[trans_num] = flag_value
+        self._idle.clear()
+        self._append({"t": trans_num, "f": flag_value})
+        self._enqueue(trans_num)
+
+    def _enqueue(self, trans_num: str):
+        if trans_num not in self._queued:
+            self._queued.add(trans_num)
+            self._ready.put_nowait(trans_num)
+
+    def _retry_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _sender(self):
+        while True:
+            trans_num = await self._ready.get()
+            value = self.pending.get(trans_num)
+            if value is None:
+                self._queued.discard(trans_num)
+                continue
+            self._stats["in_flight"] += 1
+            t0 = time.perf_counter()
+            try:
+                status = await self.send(trans_num, value)
+                error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                status, error = None, e
+            finally:
+                self._stats["in_flight"] -= 1
+            ok = status is not None and 200 <= status < 300
+            SEND_SECONDS.labels("ok" if ok else "error").observe(time.perf_counter() - t0)
+
+            if ok:
+                if self.pending.get(trans_num) != value:  # updated while in flight
+                    self._queued.discard(trans_num)
+                    self._enqueue(trans_num)
+                else:
+                    self._finish(trans_num, status, "delivered")
+                continue
+            attempt = self.attempts.get(trans_num, 0) + 1
+            self.attempts[trans_num] = attempt
+            permanent = status is not None and 400 <= status < 500 and status not in RETRYABLE
+            if permanent or (self.max_attempts and attempt >= self.max_attempts):
+                log.error("Giving up on flagging %s after %d attempts (%s)", trans_num, attempt,
+                          f"HTTP {status}" if status is not None else error)
+                self._finish(trans_num, status or 0, "failed")
+                continue
+            log.debug("Flag %s failed: %s (attempt %d)", trans_num,
+                        f"HTTP {status}" if status is not None else error, attempt)
+            self._stats["retries"] += 1
+            RETRIES.inc()
+            self.wheel.schedule(trans_num, self._retry_delay(attempt))
+
+    async def _ticker(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for trans_num in self.wheel.advance():
+                self._ready.put_nowait(trans_num)
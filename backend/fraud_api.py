@@ -1,93 +1,283 @@
 #!/usr/bin/env python3
 
+import asyncio
+import hmac
 import os
-import json
-import sqlite3
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, List, Optional, Union
 
-import joblib
-import numpy as np
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import Body, Depends, FastAPI, Header, Query, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
-from features import ensure_schema, insert_tx, tx_to_features, ordered_feature_row, FEATURE_ORDER
+from scoring import FraudScorer, DB_PATH, MODEL_PATH, FEATURES_PATH, HISTORY_MODE
+from features import FEATURE_ORDER
+from batcher import MicroBatcher
+from metrics import CONTENT_TYPE, Gauge, render
+from stream_hub import StreamHub, decide_flag, scored_event
+from rollups import ROLLUPS, Rollups
+from model_reload import ModelReloader
+from wire import BatchVerdicts, Transaction, Verdict, encode, negotiate, FLOAT32, MSGPACK
 
-DB_PATH = os.environ.get("FRAUD_DB", "../history.db")
-MODEL_PATH = os.environ.get("FRAUD_MODEL", "../model.pkl")
-FEATURES_PATH = os.environ.get("FRAUD_FEATURES", "features.json")
+# Micro-batching of concurrent /predict calls; a window of 0 disables it.
+BATCH_WINDOW_MS = float(os.environ.get("FRAUD_BATCH_WINDOW_MS", "0"))
+BATCH_MAX = int(os.environ.get("FRAUD_BATCH_MAX", "64"))
+# GET /stream: stored predictions as server-sent events for the dashboards.
+# The last STREAM_BUFFER events are kept for Last-Event-ID resumes and
+# clients that fall behind; THRESHOLD decides the flag shown (as in sse_to_predict).
+STREAM_BUFFER = int(os.environ.get("FRAUD_STREAM_BUFFER", "1024"))
+STREAM_ORIGIN = os.environ.get("FRAUD_STREAM_ORIGIN", "*")
+THRESHOLD = float(os.environ.get("THRESHOLD", "0.35"))
+# /admin endpoints require this X-Admin-Token; unset, they answer 403.
+ADMIN_TOKEN = os.environ.get("FRAUD_ADMIN_TOKEN", "")
 
 app = FastAPI(title="Fraud API", version="1.0.2") # This must exist at top-level.
 
+# Other media types /predict answers in, picked by the Accept header (wire.py).
+WIRE_RESPONSES = {200: {"content": {
+    MSGPACK: {},
+    FLOAT32: {"description": "float32 rows of proba, is_fraud and the features, named by X-Fraud-Columns"},
+}}}
+
 # =======
 # GLOBALS
 # =======
 
-conn: Optional[sqlite3.Connection] = None
-model = None
-feature_order = FEATURE_ORDER
+scorer: Optional[FraudScorer] = None
+batcher: Optional[MicroBatcher] = None
+hub = StreamHub(STREAM_BUFFER)
+rollups: Optional[Rollups] = None
+reloader: Optional[ModelReloader] = None
 
 @app.on_event("startup")
 def startup():
     """Initialize DB and load model on server start."""
-    global conn, model, feature_order
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    ensure_schema(conn)
-
-    if not os.path.exists(MODEL_PATH):
-        raise RuntimeError(
-            f"Model file not found at '{MODEL_PATH}'. Train first, e.g.: "
-            f"python train_model.py --input transactions.csv --db {DB_PATH} --output-model {MODEL_PATH}"
-        )
-    model = joblib.load(MODEL_PATH)
-
-    if os.path.exists(FEATURES_PATH):
-        try:
-            with open(FEATURES_PATH, "r", encoding="utf-8") as f:
-                feature_order = json.load(f)
-        except Exception:
-            feature_order = FEATURE_ORDER
+    global scorer, batcher, rollups, reloader
+    scorer = FraudScorer(MODEL_PATH, FEATURES_PATH, DB_PATH, HISTORY_MODE)
+    reloader = ModelReloader(scorer)
+    if ROLLUPS:
+        rollups = Rollups(DB_PATH)
+
+    if BATCH_WINDOW_MS > 0:
+        batcher = MicroBatcher(run_batch, max_batch=BATCH_MAX, max_wait_ms=BATCH_WINDOW_MS)
+
+    Gauge("fraud_history_entries", "Transactions held in scoring history",
+          fn=lambda: scorer.history_size()["entries"])
+    if scorer.writer is not None:
+        Gauge("fraud_write_behind_queue_depth", "tx rows waiting for the background writer",
+              fn=lambda: scorer.writer.stats()["queue_depth"])
+    if batcher is not None:
+        Gauge("fraud_batcher_queue_depth", "Requests waiting for a micro-batch",
+              fn=lambda: batcher.stats()["queue_depth"])
+
+@app.on_event("startup")
+async def start_hub():
+    hub.bind(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+def shutdown():
+    if reloader is not None:
+        reloader.close()
+    if batcher is not None:
+        batcher.close()
+    if scorer is not None:
+        scorer.close()
+    if rollups is not None:
+        rollups.close()
 
 @app.get("/health")
 def health():
     return {
         "ok": True,
-        "model_loaded": model is not None,
+        "model_loaded": scorer is not None,
+        "model": scorer.model_info() if scorer is not None else None,
         "db": DB_PATH,
-        "feature_count": len(feature_order),
+        "history": HISTORY_MODE,
+        "feature_count": len(scorer.feature_order if scorer is not None else FEATURE_ORDER),
+        "batcher": batcher.stats() if batcher is not None else None,
+        "cascade": scorer.cascade_stats() if scorer is not None else None,
+        "write_behind": scorer.writer.stats() if scorer is not None and scorer.writer is not None else None,
+        "stream": hub.stats(),
+        "rollups": rollups.stats() if rollups is not None else None,
     }
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of the process-wide metrics."""
+    return Response(render(), media_type=CONTENT_TYPE)
+
 @app.get("/feature-names")
 def feature_names():
-    return {"features": feature_order}
+    return {"features": scorer.feature_order if scorer is not None else FEATURE_ORDER}
 
-@app.post("/predict")
-def predict(
-    tx: Dict[str, Any],
+def _require_scorer() -> FraudScorer:
+    if scorer is None:
+        raise HTTPException(status_code=503, detail="Model or DB not initialized.")
+    return scorer
+
+def run_batch(items: List[Any]) -> List[Any]:
+    """
+    MicroBatcher callback for (tx, store, features) items: one predict_many
+    call; each verdict comes back with the call's timings.
+    """
+    timings: Dict[str, float] = {}
+    verdicts = scorer.predict_many([(tx, store) for tx, store, _ in items], timings,
+                                   with_features=any(f for _, _, f in items))
+    return [v if isinstance(v, Exception) else (v, timings) for v in verdicts]
+
+@app.post("/predict", response_model=Verdict, response_model_exclude_none=True, responses=WIRE_RESPONSES)
+async def predict(
+    body: Transaction,
     store: int = Query(0, description="If 1, store tx in DB after prediction"),
+    features: int = Query(0, description="If 1, include the feature values in the verdict"),
+    accept: Optional[str] = Header(None),
 ):
-    """History-aware prediction endpoint."""
-    if model is None or conn is None:
+    """
+    History-aware prediction endpoint (features use only the past relative to
+    tx['unix_time']). With micro-batching the request waits for its batch
+    without holding a worker thread.
+    """
+    s = _require_scorer()
+    tx = body.as_tx()
+    if batcher is not None:
+        verdict, timings = await asyncio.wrap_future(batcher.submit((tx, store, bool(features))))
+        timings = dict(timings)  # shared by the batch
+    else:
+        timings = {}
+        verdict = await run_in_threadpool(s.predict, tx, store, timings, bool(features))
+    if store:
+        publish(tx, verdict)
+    return encoded([verdict], accept, features, timings, batch=False)
+
+def publish(tx: Dict[str, Any], verdict: Dict[str, Any]):
+    """Broadcasts a stored transaction with its verdict on /stream and counts it in the rollups."""
+    flag_value = decide_flag(bool(verdict.get("is_fraud", False)), verdict.get("proba"), THRESHOLD)
+    if rollups is not None:
+        rollups.add(tx, flag_value)
+    hub.publish_threadsafe(scored_event(tx, verdict, flag_value, THRESHOLD))
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """features_ms=1.2 -> 'features;dur=1.200' (Server-Timing header syntax)."""
+    return ", ".join(f"{k[:-3]};dur={v:.3f}" for k, v in timings.items() if k.endswith("_ms"))
+
+def encoded(verdicts: List[Dict[str, Any]], accept: Optional[str], features: int,
+            timings: Dict[str, float], batch: bool) -> Response:
+    """Verdicts in the media type the client accepts (see wire.py), with the encode time in Server-Timing."""
+    media = negotiate(accept)
+    t0 = time.perf_counter()
+    content, headers = encode(verdicts, media, bool(features), batch)
+    if timings:
+        timings["encode_ms"] = (time.perf_counter() - t0) * 1e3
+        headers["Server-Timing"] = server_timing(timings)
+    return Response(content, media_type=media, headers=headers)
+
+@app.post("/predict/batch", response_model=BatchVerdicts, response_model_exclude_none=True,
+          responses=WIRE_RESPONSES)
+def predict_batch(
+    body: List[Union[Transaction, Any]],  # items that are not objects get an error entry
+    store: int = Query(0, description="If 1, store all txs in DB in one transaction"),
+    features: int = Query(0, description="If 1, include the feature values in the verdicts"),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Ordered batch prediction. Features are built one tx at a time so later
+    transactions see earlier ones from the same batch; the inserts only
+    become durable (in a single commit) when store=1. A row that cannot be
+    scored gets {"error": ...} in its place; the others are unaffected.
+    """
+    s = _require_scorer()
+    ok = [i for i, t in enumerate(body) if isinstance(t, Transaction)]
+    txs = [body[i].as_tx() for i in ok]
+    scored = s.predict_batch(txs, store, with_features=bool(features)) if txs else []
+    results: List[Dict[str, Any]] = [{"error": "Expected a transaction object"}] * len(body)
+    for i, tx, verdict in zip(ok, txs, scored):
+        if isinstance(verdict, Exception):
+            results[i] = {"error": f"{type(verdict).__name__}: {verdict}"}
+            continue
+        results[i] = verdict
+        if store:
+            publish(tx, verdict)
+    return encoded(results, accept, features, {}, batch=True)
+
+@app.get("/stream")
+async def stream(
+    last_event_id: Optional[str] = Header(None),
+    backlog: int = Query(0, ge=0, description="Buffered events sent to a new client before live ones"),
+):
+    """
+    Server-sent events of stored transactions with their verdicts.
+    Reconnecting EventSources resume after their Last-Event-ID; a client
+    that falls behind the buffer skips ahead instead of slowing the API.
+    """
+    return StreamingResponse(
+        hub.events(hub.cursor_for(last_event_id, backlog)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                 "Access-Control-Allow-Origin": STREAM_ORIGIN},
+    )
+
+@app.get("/stats")
+def stats(
+    start: Optional[int] = Query(None, description="Range start (unix_time, inclusive); default: first hour"),
+    end: Optional[int] = Query(None, description="Range end (unix_time, exclusive); default: last hour"),
+    limit: int = Query(20, ge=0, description="Rows per breakdown, 0 = all"),
+    series: Optional[str] = Query(None, description="Add a per-bucket series: minute or hour"),
+):
+    """
+    Counts, amounts and flags of stored transactions in a time range, overall
+    and by category, state and merchant, read from the minute/hour rollups.
+    """
+    if rollups is None:
+        raise HTTPException(status_code=503, detail="Rollups are off (set FRAUD_ROLLUPS=1).")
+    try:
+        return rollups.query(start, end, limit, series)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# =====
+# ADMIN
+# =====
+
+def _require_admin(x_admin_token: Optional[str] = Header(None)) -> ModelReloader:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are off (set FRAUD_ADMIN_TOKEN).")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Missing or wrong X-Admin-Token.")
+    if reloader is None:
         raise HTTPException(status_code=503, detail="Model or DB not initialized.")
+    return reloader
 
-    # Build features (using only past relative to tx['unix_time']).
-    feat_map = tx_to_features(tx, conn)
-    X = np.array([ordered_feature_row(feat_map, feature_order)], dtype=float)
+@app.get("/admin/model")
+def model_status(r: ModelReloader = Depends(_require_admin)):
+    """Live model, reload state and, while shadowing, agreement and latency against the live model."""
+    return r.stats()
 
-    # Predict.
-    is_fraud = int(model.predict(X)[0])
+@app.post("/admin/model/reload", status_code=202)
+def model_reload(
+    body: Dict[str, Any] = Body(default={}),
+    r: ModelReloader = Depends(_require_admin),
+):
+    """
+    Loads {"model", "features", "fast_model"} (default: the live paths again;
+    others must be inside FRAUD_MODEL_DIR) in the background, then swaps it in or shadow-scores it ("mode": "swap" /
+    "shadow"). /predict keeps answering with the live model meanwhile.
+    """
     try:
-        proba = float(model.predict_proba(X)[0, 1])
-    except Exception:
-        proba = None
+        started = r.reload(body.get("model"), body.get("features"), body.get("fast_model"), body.get("mode"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not started:
+        raise HTTPException(status_code=409, detail="A reload is already running.")
+    return r.stats()
 
-    # Optionally store this tx as history AFTER prediction.
-    if store:
-        insert_tx(conn, tx)
+@app.post("/admin/model/promote")
+def model_promote(r: ModelReloader = Depends(_require_admin)):
+    if not r.promote():
+        raise HTTPException(status_code=409, detail="No shadow model to promote.")
+    return r.stats()
 
-    return {
-        "is_fraud": bool(is_fraud),
-        "proba": proba,
-        "features": {
-            k: float(feat_map.get(k, 0.0) if feat_map.get(k) is not None else 0.0)
-            for k in feature_order
-        },
-    }
+@app.post("/admin/model/discard")
+def model_discard(r: ModelReloader = Depends(_require_admin)):
+    if not r.discard():
+        raise HTTPException(status_code=409, detail="No shadow model to discard.")
+    return r.stats()
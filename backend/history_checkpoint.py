@@ -0,0 +1,168 @@
+"""
+Checkpoints of the in-memory history (features.History).
+
+save_history writes every card's columns and merchant summary into one .npz
+of flat arrays (nothing is pickled) and atomically replaces the previous
+file; load_history rebuilds the History with bulk copies. replay_tail then
+adds the tx rows the checkpoint lacks from SQLite (newer ones, and ones
+stored up to HISTORY_LATENESS late), so a restart is back to exact features
+without replaying the whole table.
+"""
+
+import bisect
+import itertools
+import json
+import os
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from features import (
+    HISTORY_LATENESS, MISSING, CardState, History, add_to_history, safe_str, to_amount,
+)
+
+FORMAT_VERSION = 1
+
+def _pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def _unpack_strings(blob: np.ndarray, offsets: np.ndarray) -> List[str]:
+    raw = blob.tobytes()
+    return [raw[a:b].decode("utf-8") for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+def _concat(parts, dtype) -> np.ndarray:
+    return np.frombuffer(b"".join(p.tobytes() for p in parts), dtype=dtype)
+
+# ====
+# SAVE
+# ====
+
+def save_history(history: History, path: str) -> Dict[str, Any]:
+    """Writes history to path (via a temp file + rename); returns the metadata."""
+    cards = list(history.items())
+    states = [s for _, s in cards]
+    newest = max((s.times[-1] for s in states if s.times), default=None)
+    meta = {
+        "format": FORMAT_VERSION,
+        "cards": len(cards),
+        "entries": sum(len(s.times) for s in states),
+        "through": newest,  # newest transaction time included
+        "watermark": history.watermark,
+        "retention": history.retention,
+        "evicted": history.evicted,
+    }
+    card_blob, card_offsets = _pack_strings([cc for cc, _ in cards])
+    name_blob, name_offsets = _pack_strings(list(history.ids))  # ids are insertion order
+
+    arrays = {
+        "meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+        "card_blob": card_blob, "card_offsets": card_offsets,
+        "name_blob": name_blob, "name_offsets": name_offsets,
+        "card_len": np.array([len(s.times) for s in states], dtype=np.int64),
+        "times": _concat([s.times for s in states], np.int64),
+        "amounts": _concat([s.amounts for s in states], np.float64),
+        "merchants": _concat([s.merchants for s in states], np.int32),
+        "categories": _concat([s.categories for s in states], np.int32),
+        # Merchant summary: ids in slot order, then first/prev/last per slot.
+        "seen_len": np.array([len(s.merchant_slot) for s in states], dtype=np.int64),
+        "seen_ids": np.array([m for s in states for m in s.merchant_slot], dtype=np.int32),
+        "seen_times": _concat([s.merchant_seen for s in states], np.int64),
+        "evicted_last": np.array([MISSING if s.evicted_last is None else s.evicted_last for s in states],
+                                 dtype=np.int64),
+    }
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+    return meta
+
+# ====
+# LOAD
+# ====
+
+def load_history(path: str) -> Tuple[History, Dict[str, Any]]:
+    with np.load(path, allow_pickle=False) as z:
+        meta = json.loads(z["meta"].tobytes().decode("utf-8"))
+        if meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported history checkpoint format {meta.get('format')!r} in '{path}'")
+        a = {k: z[k] for k in z.files}
+
+    history = History(meta["retention"])
+    history.watermark = meta["watermark"]
+    history.evicted = meta["evicted"]
+    history.entries = meta["entries"]
+    history.ids = {name: i for i, name in enumerate(_unpack_strings(a["name_blob"], a["name_offsets"]))}
+    history.ids_in_use = len(history.ids)
+
+    ends = np.cumsum(a["card_len"]).tolist()
+    seen_ends = np.cumsum(a["seen_len"]).tolist()
+    start = seen_start = 0
+    for i, cc in enumerate(_unpack_strings(a["card_blob"], a["card_offsets"])):
+        end, seen_end = ends[i], seen_ends[i]
+        s = CardState()
+        s.times.frombytes(a["times"][start:end].tobytes())
+        s.amounts.frombytes(a["amounts"][start:end].tobytes())
+        s.merchants.frombytes(a["merchants"][start:end].tobytes())
+        s.categories.frombytes(a["categories"][start:end].tobytes())
+        s.merchant_slot = {m: j for j, m in enumerate(a["seen_ids"][seen_start:seen_end].tolist())}
+        s.merchant_seen.frombytes(a["seen_times"][3 * seen_start:3 * seen_end].tobytes())
+        last = int(a["evicted_last"][i])
+        s.evicted_last = None if last == MISSING else last
+        history[cc] = s
+        start, seen_start = end, seen_end
+    return history, meta
+
+# ===========
+# TAIL REPLAY
+# ===========
+
+REPLAY_COLUMNS = ("cc_num", "unix_time", "amt", "merchant", "category")
+
+def _in_snapshot(history: History, tx: Dict[str, Any], claimed: set) -> bool:
+    """Whether tx matches a history entry no earlier row claimed (and claims it)."""
+    cc = safe_str(tx["cc_num"])
+    state = history.get(cc)
+    if state is None:
+        return False
+    t, amount = tx["unix_time"], to_amount(tx["amt"])
+    merchant = history.ids.get(safe_str(tx["merchant"]))
+    category = history.ids.get(safe_str(tx["category"]))
+    for i in range(bisect.bisect_left(state.times, t), bisect.bisect_right(state.times, t)):
+        a = state.amounts[i]
+        if ((cc, i) not in claimed and state.merchants[i] == merchant and state.categories[i] == category
+                and (a == amount or (amount is None and a != a))):
+            claimed.add((cc, i))
+            return True
+    return False
+
+def _rows(conn: sqlite3.Connection, where: str, params: tuple):
+    sql = f"SELECT {', '.join(REPLAY_COLUMNS)} FROM tx {where} ORDER BY unix_time, rowid"
+    return (dict(zip(REPLAY_COLUMNS, row)) for row in conn.execute(sql, params))
+
+def replay_tail(history: History, conn: sqlite3.Connection, since: Optional[int] = None,
+                overlap: int = HISTORY_LATENESS) -> int:
+    """
+    Adds the tx rows a checkpoint through `since` lacks (all rows if None) in
+    time order; returns how many. Rows up to `overlap` seconds before since
+    are read too, so rows sharing since's second and rows stored that late
+    are not lost; those already in the history are skipped. Eviction keeps
+    running, so a long tail stays bounded.
+    """
+    if since is None:
+        replay, rows = [], _rows(conn, "", ())
+    else:
+        # Match the whole overlap before adding any of it: adds shift entries.
+        claimed: set = set()
+        replay = [tx for tx in _rows(conn, "WHERE unix_time BETWEEN ? AND ?", (since - overlap, since))
+                  if not _in_snapshot(history, tx, claimed)]
+        rows = _rows(conn, "WHERE unix_time > ?", (since,))
+    n = 0
+    for tx in itertools.chain(replay, rows):
+        add_to_history(history, tx)
+        history.maybe_evict()
+        n += 1
+    return n
@@ -0,0 +1,106 @@
+"""
+Level-gated, buffered logging for the backend processes.
+
+get_logger(name) returns a standard logging.Logger under the "fraud"
+hierarchy, configured once per process from the environment:
+
+  LOG_LEVEL         DEBUG / INFO (default) / WARNING / ERROR
+  LOG_FORMAT        "text" (default) or "json" (one object per line)
+  LOG_BUFFER        records held before a write (default 256)
+  LOG_FLUSH_SECS    longest a buffered record waits (default 1.0)
+
+Records go through a queue to a listener thread, so callers (including the
+asyncio loop) never block on stdout; the listener writes in batches and
+flushes at once on WARNING and above. Use %-style arguments so messages
+below LOG_LEVEL are never formatted.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_BUFFER = int(os.getenv("LOG_BUFFER", "256"))
+LOG_FLUSH_SECS = float(os.getenv("LOG_FLUSH_SECS", "1.0"))
+
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False)
+
+class BufferedHandler(logging.handlers.MemoryHandler):
+    """MemoryHandler that also flushes once the oldest buffered record is flush_secs old."""
+
+    def __init__(self, capacity: int, target: logging.Handler, flush_secs: float):
+        super().__init__(capacity, flushLevel=logging.WARNING, target=target)
+        self.flush_secs = flush_secs
+
+    def shouldFlush(self, record: logging.LogRecord) -> bool:
+        return (super().shouldFlush(record)
+                or time.time() - self.buffer[0].created >= self.flush_secs)
+
+    def flush(self):
+        super().flush()
+        if self.target is not None:
+            self.target.flush()
+
+class _Listener(logging.handlers.QueueListener):
+    """Flushes its handlers whenever the queue has been idle for flush_secs."""
+
+    def __init__(self, q, handler: logging.Handler, flush_secs: float):
+        super().__init__(q, handler)
+        self.flush_secs = flush_secs
+
+    def dequeue(self, block: bool):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_secs)
+            except queue.Empty:
+                for h in self.handlers:
+                    h.flush()
+
+def _configure():
+    global _listener
+    root = logging.getLogger("fraud")
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    root.propagate = False
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else
+                        logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    buffered = BufferedHandler(max(1, LOG_BUFFER), stream, LOG_FLUSH_SECS)
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(q))
+    _listener = _Listener(q, buffered, LOG_FLUSH_SECS)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    """Drains the queue and flushes the buffer (also runs at exit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for h in _listener.handlers:
+            h.flush()
+        _listener = None
+
+def get_logger(name: str) -> logging.Logger:
+    if _listener is None and not logging.getLogger("fraud").handlers:
+        _configure()
+    return logging.getLogger(f"fraud.{name}")
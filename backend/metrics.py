@@ -0,0 +1,160 @@
+"""
+Process-wide metrics in the Prometheus text exposition format.
+
+A small stand-in for prometheus_client: Counter, Gauge and Histogram, with
+optional labels, registered by name in REGISTRY and rendered by render().
+A metric given fn= is evaluated at scrape time instead (queue depth,
+history size, ...). Updates take a per-metric lock, so threads may share
+them.
+"""
+
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from sub-millisecond feature lookups to slow remote POSTs.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: Dict[str, "Metric"] = {}
+_registry_lock = threading.Lock()
+
+def _fmt(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if float(v).is_integer() and abs(v) < 1e15:
+        return str(int(v))
+    return repr(float(v))
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 fn: Optional[Callable[[], object]] = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        with _registry_lock:
+            REGISTRY[name] = self  # re-registering replaces (e.g. a new scorer)
+
+    def labels(self, *values) -> "_Labeled":
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {values}")
+        return _Labeled(self, tuple(str(v) for v in values))
+
+    def samples(self) -> List[Tuple[Tuple[str, ...], float]]:
+        """(label values, value) pairs; fn may return a number or {labels tuple: number}."""
+        if self.fn is not None:
+            try:
+                v = self.fn()
+            except Exception:
+                return []
+            if isinstance(v, dict):
+                return [((k,) if isinstance(k, str) else tuple(k), float(x)) for k, x in v.items()]
+            return [((), float(v))] if v is not None else []
+        with self._lock:
+            return [(k, float(v)) for k, v in self._values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, v in self.samples():
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_fmt(v)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _inc(self, key: Tuple[str, ...], amount: float):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def inc(self, amount: float = 1.0):
+        self._inc((), amount)
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def _set(self, key: Tuple[str, ...], value: float):
+        with self._lock:
+            self._values[key] = value
+
+    def set(self, value: float):
+        self._set((), value)
+
+    def dec(self, amount: float = 1.0):
+        self._inc((), -amount)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _observe(self, key: Tuple[str, ...], value: float):
+        i = bisect_left(self.buckets, value)  # first bucket with value <= le
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    def observe(self, value: float):
+        self._observe((), value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(s[0]), s[1]) for k, s in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (math.inf,), counts):
+                cumulative += c
+                le = 'le="' + _fmt(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+class _Labeled:
+    """One label combination of a metric: metric.labels("flag").observe(0.2)."""
+
+    def __init__(self, metric: Metric, key: Tuple[str, ...]):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float = 1.0):
+        self.metric._inc(self.key, amount)
+
+    def dec(self, amount: float = 1.0):
+        self.metric._inc(self.key, -amount)
+
+    def set(self, value: float):
+        self.metric._set(self.key, value)
+
+    def observe(self, value: float):
+        self.metric._observe(self.key, value)
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    lines: List[str] = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,215 @@
+"""
+Model reloads for a running FraudScorer, without a restart.
+
+reload() loads a model, feature list and fast model (by default the live
+paths again) on a background thread, while requests keep scoring with the
+live bundle. The new bundle then either goes live at once ("swap") or is
+shadow-scored against live traffic first ("shadow"). A shadow is promoted
+after promote_after scored transactions if its flag disagreement rate
+stays at or below max_disagreement. Otherwise it waits for promote() or
+discard(). Swapping replaces one reference, so calls in flight finish
+with the model they started with.
+
+With watch_secs > 0 a thread polls the files' modification times and
+reloads once a change has been stable for one poll (a half-written pickle
+is not picked up).
+
+Paths passed to reload() must lie inside model_dir (relative ones are taken
+from there): loading a pickle runs code, so callers cannot point it anywhere
+else.
+"""
+
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from logs import get_logger
+from scoring import FraudScorer, load_bundle
+
+# Poll interval for FRAUD_MODEL / FRAUD_FEATURES / FRAUD_FAST_MODEL changes (0 = off).
+MODEL_WATCH = float(os.environ.get("FRAUD_MODEL_WATCH", "0"))
+# "swap" or "shadow"; promotion needs PROMOTE_AFTER shadowed rows (0 = manual only).
+RELOAD_MODE = os.environ.get("FRAUD_RELOAD_MODE", "swap")
+SHADOW_PROMOTE_AFTER = int(os.environ.get("FRAUD_SHADOW_PROMOTE_AFTER", "1000"))
+SHADOW_MAX_DISAGREEMENT = float(os.environ.get("FRAUD_SHADOW_MAX_DISAGREEMENT", "0.01"))
+# Directory reload() may load models and feature lists from ("" = FRAUD_MODEL's directory).
+MODEL_DIR = os.environ.get("FRAUD_MODEL_DIR", "")
+
+MODES = ("swap", "shadow")
+
+log = get_logger("model_reload")
+
+def _mtime(path: str) -> Optional[float]:
+    """Newest modification time of a file, or of the files in a directory (compact forests)."""
+    if not path:
+        return None
+    try:
+        if os.path.isdir(path):
+            return max([os.path.getmtime(path)] +
+                       [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path)])
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+class ModelReloader:
+    def __init__(self, scorer: FraudScorer, watch_secs: float = MODEL_WATCH, mode: str = RELOAD_MODE,
+                 promote_after: int = SHADOW_PROMOTE_AFTER,
+                 max_disagreement: float = SHADOW_MAX_DISAGREEMENT, model_dir: str = MODEL_DIR):
+        if mode not in MODES:
+            raise ValueError(f"Unknown reload mode '{mode}' (expected swap or shadow)")
+        self.scorer = scorer
+        self.model_dir = os.path.realpath(model_dir or os.path.dirname(os.path.abspath(scorer.bundle.paths["model"])))
+        self.watch_secs = watch_secs
+        self.mode = mode
+        self.promote_after = promote_after
+        self.max_disagreement = max_disagreement
+        self.state = "idle"  # idle / loading / shadow / failed
+        self.error: Optional[str] = None
+        self.swaps = 0
+        self._lock = threading.Lock()
+        self._held = False  # shadow over the disagreement limit, waiting for a decision
+        self._seen = self._fingerprint(scorer.bundle.paths)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="model-reload", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _fingerprint(paths: Dict[str, str]):
+        return tuple(_mtime(paths[k]) for k in ("model", "features", "fast_model"))
+
+    def _confine(self, path: str) -> str:
+        """path resolved inside model_dir; ValueError if it leads out of it."""
+        resolved = os.path.realpath(os.path.join(self.model_dir, path))
+        if os.path.commonpath([resolved, self.model_dir]) != self.model_dir:
+            raise ValueError(f"'{path}' is outside the model directory")
+        return resolved
+
+    # =======
+    # LOADING
+    # =======
+
+    def reload(self, model_path: Optional[str] = None, features_path: Optional[str] = None,
+               fast_model_path: Optional[str] = None, mode: Optional[str] = None) -> bool:
+        """
+        Starts a background load; False when one is already running. Paths
+        left out keep the live ones; given ones must be inside model_dir ("" for
+        fast_model turns the cascade off).
+        """
+        mode = self.mode if mode is None else mode
+        if mode not in MODES:
+            raise ValueError(f"Unknown reload mode '{mode}' (expected swap or shadow)")
+        live = self.scorer.bundle.paths
+        paths = {
+            "model": live["model"] if model_path is None else self._confine(model_path),
+            "features": live["features"] if features_path is None else self._confine(features_path),
+            "fast_model": live["fast_model"] if fast_model_path is None
+            else fast_model_path and self._confine(fast_model_path),
+        }
+        with self._lock:
+            if self.state == "loading":
+                return False
+            self.state, self.error = "loading", None
+        threading.Thread(target=self._load, args=(paths, mode), name="model-load", daemon=True).start()
+        return True
+
+    def _load(self, paths: Dict[str, str], mode: str):
+        t0 = time.perf_counter()
+        seen = self._fingerprint(paths)
+        try:
+            bundle = load_bundle(paths["model"], paths["features"], paths["fast_model"], self.scorer.db_path)
+        except Exception as e:
+            log.error("Model reload from %s failed: %s", paths["model"], e)
+            with self._lock:
+                self.state, self.error = "failed", str(e)
+                self._seen = seen  # do not retry the same broken files
+            return
+        log.info("Loaded %s in %.2fs (%s)", paths["model"], time.perf_counter() - t0, mode)
+        with self._lock:
+            self._seen = seen
+            self._held = False
+            if mode == "swap":
+                self.scorer.swap(bundle)
+                self.swaps += 1
+                self.state = "idle"
+            else:
+                self.scorer.set_shadow(bundle)
+                self.state = "shadow"
+
+    # ========
+    # DECISION
+    # ========
+
+    def promote(self) -> bool:
+        """Makes the shadow live; False without one."""
+        with self._lock:
+            shadow = self.scorer.shadow
+            if shadow is None:
+                return False
+            self.scorer.swap(shadow)
+            self.swaps += 1
+            self.state, self._held = "idle", False
+            return True
+
+    def discard(self) -> bool:
+        """Drops the shadow; False without one."""
+        with self._lock:
+            if self.scorer.shadow is None:
+                return False
+            self.scorer.set_shadow(None)
+            self.state, self._held = "idle", False
+            return True
+
+    def _check_shadow(self):
+        st = self.scorer.shadow_stats()
+        if st is None or self._held or not self.promote_after or st["rows"] < self.promote_after:
+            return
+        if st["flag_disagree_rate"] <= self.max_disagreement:
+            log.info("Promoting shadow model after %d rows (flag disagreement %.4f)",
+                     st["rows"], st["flag_disagree_rate"])
+            self.promote()
+        else:
+            self._held = True
+            log.warning("Shadow model disagrees on %.2f%% of flags (limit %.2f%%); keeping it for review",
+                        100 * st["flag_disagree_rate"], 100 * self.max_disagreement)
+
+    # =======
+    # WATCHER
+    # =======
+
+    def _loop(self):
+        interval = self.watch_secs if self.watch_secs > 0 else 1.0
+        pending = None
+        while not self._stop.wait(interval):
+            try:
+                self._check_shadow()
+                if self.watch_secs <= 0 or self.state == "loading":
+                    continue
+                current = self._fingerprint(self.scorer.bundle.paths)
+                if current == self._seen or current[0] is None:
+                    pending = None
+                elif current == pending:  # unchanged since the last poll
+                    log.info("Model files changed; reloading")
+                    self.reload()
+                    pending = None
+                else:
+                    pending = current
+            except Exception as e:
+                log.exception("Model watcher failed: %s", e)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "mode": self.mode,
+            "swaps": self.swaps,
+            "watch_secs": self.watch_secs,
+            "live": self.scorer.model_info(),
+            "shadow": self.scorer.shadow_stats(),
+            "promote_after": self.promote_after,
+            "max_disagreement": self.max_disagreement,
+        }
@@ -0,0 +1,125 @@
+"""
+Sharded, streamed feature generation for training.
+
+History features only depend on earlier transactions of the same card, so
+the input can be split by cc_num and every partition featurized on its own:
+
+  1. a first pass reads just unix_time and is_fraud in chunks and fixes each
+     row's global position (stable time order, like the in-memory trainer);
+  2. a second pass streams the full rows into per-partition spill files
+     (one pickle per chunk and partition), routed by the same crc32 card
+     hash as the scoring shards;
+  3. a process pool runs build_feature_matrix on each partition and writes
+     the labeled rows straight into their final place in a .npy memmap.
+
+Peak memory is one chunk plus one partition, and the result is bit-identical
+to build_feature_matrix over the whole sorted file.
+"""
+
+import os
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from batch_features import _text, build_feature_matrix, map_unique
+from features import FEATURE_ORDER, to_int
+
+CHUNK_ROWS = 200_000
+
+def _read_chunks(path: str, chunksize: int, usecols=None):
+    return pd.read_csv(path, sep="|", dtype=str, keep_default_na=False,
+                       chunksize=chunksize, usecols=usecols)
+
+def _partition_of(cc: pd.Series, n: int) -> np.ndarray:
+    return map_unique(cc, lambda s: zlib.crc32(s.encode("utf-8")) % n, dtype=np.int64)
+
+def _build_partition(job) -> int:
+    part_paths, out_path, order = job
+    df = pd.concat([pd.read_pickle(p) for p in part_paths], ignore_index=True)
+    if len(df) == 0:
+        return 0
+    rank = df.pop("_rank").to_numpy()
+    pos = df.pop("_pos").to_numpy()
+    idx = np.argsort(rank, kind="stable")
+    df = df.iloc[idx].reset_index(drop=True)
+    pos = pos[idx]
+    X = build_feature_matrix(df, order)
+    keep = pos >= 0
+    out = np.load(out_path, mmap_mode="r+")
+    out[pos[keep]] = X[keep]
+    out.flush()
+    return int(keep.sum())
+
+def build_training_matrix(path: str, out_path: str, label_fn: Callable[[str], Optional[int]],
+                          workers: int = 0, limit: int = 0, chunksize: int = CHUNK_ROWS,
+                          order: List[str] = FEATURE_ORDER, workdir: Optional[str] = None,
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Labeled training matrix of the CSV at path (rows in stable unix_time
+    order, first limit rows if limit > 0), written to out_path as .npy and
+    returned memory-mapped, together with the labels.
+    """
+    workers = workers or os.cpu_count() or 1
+
+    # Pass 1: global order and labels from two columns.
+    ux_parts, label_parts, labeled_parts = [], [], []
+    for chunk in _read_chunks(path, chunksize, usecols=["unix_time", "is_fraud"]):
+        ux_parts.append(map_unique(chunk["unix_time"], lambda v: to_int(v) or 0, dtype=np.int64))
+        label_parts.append(map_unique(chunk["is_fraud"], lambda v: label_fn(v) or 0, dtype=np.int64))
+        labeled_parts.append(map_unique(chunk["is_fraud"], lambda v: label_fn(v) is not None, dtype=bool))
+    ux = np.concatenate(ux_parts) if ux_parts else np.zeros(0, dtype=np.int64)
+    labels = np.concatenate(label_parts) if label_parts else np.zeros(0, dtype=np.int64)
+    labeled = np.concatenate(labeled_parts) if labeled_parts else np.zeros(0, dtype=bool)
+    n = len(ux)
+
+    order_idx = np.argsort(ux, kind="stable")
+    if limit > 0:
+        order_idx = order_idx[:limit]
+    rank = np.full(n, -1, dtype=np.int64)
+    rank[order_idx] = np.arange(len(order_idx))
+    labeled_sorted = labeled[order_idx]
+    pos = np.full(n, -1, dtype=np.int64)
+    pos[order_idx[labeled_sorted]] = np.arange(int(labeled_sorted.sum()))
+    y = labels[order_idx][labeled_sorted]
+
+    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float64, shape=(len(y), len(order)))
+    del out
+
+    # Pass 2: spill selected rows into per-card partitions.
+    n_parts = max(1, 4 * workers)
+    tmp = tempfile.mkdtemp(prefix="fraud-parts-", dir=workdir)
+    try:
+        part_paths: List[List[str]] = [[] for _ in range(n_parts)]
+        offset = 0
+        for c, chunk in enumerate(_read_chunks(path, chunksize)):
+            rows = np.arange(offset, offset + len(chunk))
+            offset += len(chunk)
+            sel = rank[rows] >= 0
+            if not sel.any():
+                continue
+            chunk = chunk[sel].copy()
+            chunk["_rank"] = rank[rows[sel]]
+            chunk["_pos"] = pos[rows[sel]]
+            parts = _partition_of(_text(chunk, "cc_num"), n_parts)
+            for p, group in chunk.groupby(parts, sort=False):
+                part_paths[p].append(os.path.join(tmp, f"part{p}-{c}.pkl"))
+                group.to_pickle(part_paths[p][-1])
+
+        # Pass 3: featurize partitions in parallel.
+        jobs = [(paths, out_path, order) for paths in part_paths if paths]
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                written = sum(pool.map(_build_partition, jobs))
+        else:
+            written = sum(map(_build_partition, jobs))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if written != len(y):
+        raise RuntimeError(f"Feature generation wrote {written} of {len(y)} rows")
+    return np.load(out_path, mmap_mode="r"), y
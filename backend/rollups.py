@@ -0,0 +1,233 @@
+"""
+Time-bucketed rollups of scored transactions for the statistics views.
+
+Rollups.add(tx, flag) counts a transaction and its amount into its minute
+and hour bucket of unix_time, overall and by category, merchant and state.
+Counts are summed in memory and a background thread upserts the deltas into
+tx_rollup (schema.sql) every flush_secs, so scoring never waits on the write.
+
+query() answers a [start, end) range from whole hour buckets plus minute
+buckets for the partial hours at either end, so its cost follows the number
+of buckets and keys in the range, not the number of transactions. Minute
+rows more than minute_ttl behind the newest one are deleted; a range that
+reaches back past them is widened to whole hours.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from features import connect_db, ensure_schema, to_float, to_int
+from logs import get_logger
+from metrics import Gauge, Histogram
+
+# Off by default; FRAUD_ROLLUPS=1 enables them in fraud_api (and in-process sse_to_predict).
+ROLLUPS = os.environ.get("FRAUD_ROLLUPS", "0") == "1"
+ROLLUP_FLUSH_SECS = float(os.environ.get("FRAUD_ROLLUP_FLUSH_SECS", "1.0"))
+ROLLUP_MINUTE_TTL = int(os.environ.get("FRAUD_ROLLUP_MINUTE_TTL", str(48 * 3600)))
+
+MINUTE, HOUR = 60, 3600
+RESOLUTIONS = {"minute": MINUTE, "hour": HOUR}
+DIMENSIONS = ("category", "merchant", "state")
+
+UPSERT_SQL = """
+INSERT INTO tx_rollup (res, dim, bucket, key, fraud, n, amt) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (res, dim, bucket, key, fraud) DO UPDATE SET n = n + excluded.n, amt = amt + excluded.amt
+"""
+SUM_SQL = """
+SELECT key, fraud, SUM(n), SUM(amt) FROM tx_rollup
+WHERE res = ? AND dim = ? AND bucket >= ? AND bucket < ? GROUP BY key, fraud
+"""
+SERIES_SQL = """
+SELECT bucket, fraud, n, amt FROM tx_rollup
+WHERE res = ? AND dim = 'all' AND bucket >= ? AND bucket < ?
+"""
+
+log = get_logger("rollups")
+
+FLUSH_SECONDS = Histogram("fraud_rollup_flush_seconds", "Time per upsert of pending rollup deltas")
+
+def _ceil(t: int, step: int) -> int:
+    return t + -t % step
+
+def _floor(t: int, step: int) -> int:
+    return t - t % step
+
+class Rollups:
+    def __init__(self, db_path: str, flush_secs: float = ROLLUP_FLUSH_SECS,
+                 minute_ttl: int = ROLLUP_MINUTE_TTL):
+        """minute_ttl 0 keeps minute buckets forever."""
+        self.db_path = db_path
+        self.flush_secs = flush_secs
+        self.minute_ttl = minute_ttl
+        # (res, dim, bucket, key, fraud) -> [count, amount] not yet written.
+        self._pending: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._newest = 0  # newest minute bucket added
+        self._pruned = 0
+        self._stats = {"added": 0, "flushes": 0, "rows_upserted": 0}
+        ensure_schema(self.conn())
+        Gauge("fraud_rollup_pending", "Rollup rows waiting for the next flush", fn=lambda: len(self._pending))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="rollups", daemon=True)
+        self._thread.start()
+
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect_db(self.db_path)
+        return conn
+
+    # ========
+    # UPDATING
+    # ========
+
+    def add(self, tx: Dict[str, Any], flag_value: int):
+        ux = to_int(tx.get("unix_time"))
+        if ux is None:
+            return
+        amt = to_float(tx.get("amt")) or 0.0
+        fraud = 1 if flag_value else 0
+        keys = [("all", "")] + [(d, str(tx.get(d) or "Unknown")) for d in DIMENSIONS]
+        with self._lock:
+            pending = self._pending
+            for res in (MINUTE, HOUR):
+                bucket = _floor(ux, res)
+                for dim, key in keys:
+                    k = (res, dim, bucket, key, fraud)
+                    c = pending.get(k)
+                    if c is None:
+                        pending[k] = [1, amt]
+                    else:
+                        c[0] += 1
+                        c[1] += amt
+            self._newest = max(self._newest, _floor(ux, MINUTE))
+            self._stats["added"] += 1
+
+    def flush(self):
+        """Writes the pending deltas in one transaction; failed ones are kept for the next flush."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                newest = self._newest
+            if not pending:
+                return
+            t0 = time.perf_counter()
+            conn = self.conn()
+            try:
+                with conn:
+                    conn.executemany(UPSERT_SQL, [(*k, n, a) for k, (n, a) in pending.items()])
+                    if self.minute_ttl and newest - self._pruned >= HOUR:
+                        for dim in ("all",) + DIMENSIONS:
+                            conn.execute("DELETE FROM tx_rollup WHERE res = ? AND dim = ? AND bucket < ?",
+                                         (MINUTE, dim, newest - self.minute_ttl))
+                        self._pruned = newest
+            except sqlite3.Error as e:
+                log.error("Rollup flush of %d rows failed: %s", len(pending), e)
+                with self._lock:
+                    for k, (n, a) in pending.items():
+                        c = self._pending.setdefault(k, [0, 0.0])
+                        c[0] += n
+                        c[1] += a
+                return
+            FLUSH_SECONDS.observe(time.perf_counter() - t0)
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["rows_upserted"] += len(pending)
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_secs):
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception("Rollup flush failed: %s", e)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(10)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "pending": len(self._pending), "flush_secs": self.flush_secs}
+
+    # ========
+    # QUERYING
+    # ========
+
+    def spans(self, start: int, end: int) -> List[Tuple[int, int, int]]:
+        """(res, lo, hi) bucket ranges covering [start, end), widened to whole minutes."""
+        start, end = _floor(start, MINUTE), _ceil(end, MINUTE)
+        horizon = self.conn().execute(
+            "SELECT MIN(bucket) FROM tx_rollup WHERE res = ? AND dim = 'all'", (MINUTE,)).fetchone()[0]
+
+        def edge(lo: int, hi: int) -> Tuple[int, int, int]:
+            if horizon is not None and lo >= horizon:
+                return (MINUTE, lo, hi)
+            return (HOUR, _floor(lo, HOUR), _ceil(hi, HOUR))
+
+        h0, h1 = _ceil(start, HOUR), _floor(end, HOUR)
+        if h0 >= h1:
+            return [edge(start, end)] if start < end else []
+        out = [(HOUR, h0, h1)]
+        if start < h0:
+            out.append(edge(start, h0))
+        if h1 < end:
+            out.append(edge(h1, end))
+        return out
+
+    def query(self, start: Optional[int] = None, end: Optional[int] = None, limit: int = 20,
+              series: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Counts and amounts for unix_time in [start, end) (default: everything),
+        overall and per category, state and merchant (top `limit` by count,
+        0 = all), plus a per-bucket series at the "minute" or "hour" resolution.
+        """
+        if series is not None and series not in RESOLUTIONS:
+            raise ValueError(f"Unknown series resolution '{series}' (expected minute or hour)")
+        self.flush()
+        conn = self.conn()
+        if start is None or end is None:
+            lo, hi = conn.execute("SELECT MIN(bucket), MAX(bucket) FROM tx_rollup WHERE res = ? AND dim = 'all'",
+                                  (HOUR,)).fetchone()
+            start = (lo or 0) if start is None else start
+            end = (hi + HOUR if hi is not None else 0) if end is None else end
+        spans = self.spans(start, end)
+
+        def summed(dim: str) -> Dict[str, List[float]]:
+            out: Dict[str, List[float]] = {}
+            for res, lo, hi in spans:
+                for key, fraud, n, amt in conn.execute(SUM_SQL, (res, dim, lo, hi)):
+                    c = out.setdefault(key, [0, 0, 0.0, 0.0])
+                    c[0] += n
+                    c[2] += amt
+                    if fraud:
+                        c[1] += n
+                        c[3] += amt
+            return out
+
+        def row(c: List[float]) -> Dict[str, Any]:
+            return {"count": c[0], "fraud": c[1], "amount": round(c[2], 2), "fraud_amount": round(c[3], 2),
+                    "fraud_rate": round(c[1] / c[0], 4) if c[0] else 0.0}
+
+        totals = summed("all").get("", [0, 0, 0.0, 0.0])
+        out: Dict[str, Any] = {"start": start, "end": end, "spans": spans, "totals": row(totals), "by": {}}
+        for dim in DIMENSIONS:
+            ranked = sorted(summed(dim).items(), key=lambda kv: (-kv[1][0], kv[0]))
+            out["by"][dim] = [{"key": k, **row(c)} for k, c in (ranked[:limit] if limit else ranked)]
+        if series is not None:
+            res = RESOLUTIONS[series]
+            buckets: Dict[int, List[float]] = {}
+            for bucket, fraud, n, amt in conn.execute(SERIES_SQL, (res, _floor(start, res), _ceil(end, res))):
+                c = buckets.setdefault(bucket, [0, 0, 0.0, 0.0])
+                c[0] += n
+                c[2] += amt
+                if fraud:
+                    c[1] += n
+                    c[3] += amt
+            out["series"] = [{"t": b, **row(c)} for b, c in sorted(buckets.items())]
+        return out
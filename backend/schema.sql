@@ -34,3 +34,27 @@ CREATE TABLE IF NOT EXISTS tx (
 CREATE INDEX IF NOT EXISTS idx_tx_ccnum_time ON tx (cc_num, unix_time);
 CREATE INDEX IF NOT EXISTS idx_tx_time ON tx (unix_time);
 CREATE INDEX IF NOT EXISTS idx_tx_merchant ON tx (merchant);
+CREATE INDEX IF NOT EXISTS idx_tx_ccnum_merchant_time ON tx (cc_num, merchant, unix_time);
+
+-- Newest time per (card, merchant) among rows removed by compact_history,
+-- so "seen merchant before" and "time since last" survive the TTL.
+CREATE TABLE IF NOT EXISTS card_merchant (
+  cc_num    TEXT NOT NULL,
+  merchant  TEXT NOT NULL,
+  last_time INTEGER NOT NULL,
+  PRIMARY KEY (cc_num, merchant)
+) WITHOUT ROWID;
+
+-- Scored transactions counted per minute (res=60) and hour (res=3600) bucket
+-- of unix_time, overall (dim 'all', key '') and by category, merchant and
+-- state, split by the flag shown on the dashboard. Kept by rollups.py.
+CREATE TABLE IF NOT EXISTS tx_rollup (
+  res     INTEGER NOT NULL,
+  bucket  INTEGER NOT NULL,
+  dim     TEXT NOT NULL,
+  key     TEXT NOT NULL,
+  fraud   INTEGER NOT NULL,
+  n       INTEGER NOT NULL,
+  amt     REAL NOT NULL,
+  PRIMARY KEY (res, dim, bucket, key, fraud)
+) WITHOUT ROWID;
@@ -0,0 +1,563 @@
+"""
+Scoring engine shared by fraud_api (over HTTP) and sse_to_predict (in-process
+mode): model, feature order and history backend behind one code path, so
+both produce identical verdicts.
+"""
+
+import os
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import joblib
+import numpy as np
+
+from compact_forest import CompactForest, is_compact_forest
+from logs import get_logger
+from metrics import Counter, Histogram
+from history_checkpoint import load_history, replay_tail, save_history
+from write_behind import WriteBehind
+from features import (
+    FEATURE_ORDER, EVICT_EVERY, HISTORY_RETENTION, build_history, add_to_history, discard_from_history,
+    connect_db, ensure_schema, insert_tx, compact_history, tx_to_features, tx_to_features_mem,
+    ordered_feature_row,
+)
+
+DB_PATH = os.environ.get("FRAUD_DB", "../history.db")
+# A joblib pickle, or a directory written by compact_forest.export_forest (memory-mapped).
+MODEL_PATH = os.environ.get("FRAUD_MODEL", "../model.pkl")
+FEATURES_PATH = os.environ.get("FRAUD_FEATURES", "features.json")
+# "sqlite": history lives in FRAUD_DB; "memory": per-process in-memory history.
+HISTORY_MODE = os.environ.get("FRAUD_HISTORY", "sqlite")
+# SQLite mode: >0 compacts away tx rows this many seconds older than the newest one.
+DB_TTL = int(os.environ.get("FRAUD_DB_TTL", "0"))
+# Memory mode: history checkpoint for warm restarts ("" = off), seconds between
+# writes, and whether to replay FRAUD_DB tx rows missing from the checkpoint on load.
+CHECKPOINT_PATH = os.environ.get("FRAUD_CHECKPOINT", "")
+CHECKPOINT_EVERY = float(os.environ.get("FRAUD_CHECKPOINT_EVERY", "60"))
+CHECKPOINT_REPLAY = os.environ.get("FRAUD_CHECKPOINT_REPLAY", "0") == "1"
+# Memory mode: also persist stored transactions to FRAUD_DB's tx table from a
+# background writer (group commits of up to MAX_BATCH rows, at most
+# MAX_DELAY_MS after the first; SYNC is the SQLite synchronous pragma).
+WRITE_BEHIND = os.environ.get("FRAUD_WRITE_BEHIND", "0") == "1"
+WRITE_MAX_BATCH = int(os.environ.get("FRAUD_WRITE_MAX_BATCH", "1000"))
+WRITE_MAX_DELAY_MS = float(os.environ.get("FRAUD_WRITE_MAX_DELAY_MS", "50"))
+WRITE_SYNC = os.environ.get("FRAUD_WRITE_SYNC", "NORMAL")
+# Cascade: a small first-stage model (train_model.py --fast-model; "" = off)
+# decides alone when its fraud probability is outside [LOW, HIGH]; the main
+# model scores the rest. The band should bracket the downstream THRESHOLD.
+FAST_MODEL_PATH = os.environ.get("FRAUD_FAST_MODEL", "")
+CASCADE_LOW = float(os.environ.get("FRAUD_CASCADE_LOW", "0.05"))
+CASCADE_HIGH = float(os.environ.get("FRAUD_CASCADE_HIGH", "0.9"))
+# Shadow scoring (model_reload.py) counts flag disagreements at the stream's
+# THRESHOLD; at most SHADOW_MAX_PENDING calls wait for the shadow thread.
+THRESHOLD = float(os.environ.get("THRESHOLD", "0.35"))
+SHADOW_MAX_PENDING = int(os.environ.get("FRAUD_SHADOW_MAX_PENDING", "64"))
+
+log = get_logger("scoring")
+
+STAGE_SECONDS = Histogram("fraud_scoring_stage_seconds",
+                          "Scoring time per call by stage: features, inference (predict_proba), store",
+                          ["stage"])
+SCORED = Counter("fraud_scored_total", "Transactions scored, by deciding model tier", ["tier"])
+SHADOW_SECONDS = Histogram("fraud_shadow_inference_seconds", "Inference time per call, live and shadow model",
+                           ["model"])
+
+def load_feature_order(path: str) -> List[str]:
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return FEATURE_ORDER
+
+def load_model(path: str, db_path: str = DB_PATH):
+    if not os.path.exists(path):
+        raise RuntimeError(
+            f"Model file not found at '{path}'. Train first, e.g.: "
+            f"python train_model.py --input transactions.csv --db {db_path} --output-model {path}"
+        )
+    if is_compact_forest(path):
+        return CompactForest(path)
+    return joblib.load(path)
+
+class ModelBundle(NamedTuple):
+    """Everything a verdict depends on; swapped as one reference."""
+    model: Any
+    fast_model: Any
+    feature_order: List[str]
+    paths: Dict[str, str]
+    loaded_at: float
+
+def load_bundle(model_path: str = MODEL_PATH, features_path: str = FEATURES_PATH,
+                fast_model_path: str = FAST_MODEL_PATH, db_path: str = DB_PATH) -> ModelBundle:
+    """
+    Loads and checks a model set: the feature list may only name features
+    FEATURE_ORDER computes, each once, and each model must take that many
+    features (in that order, when it records their names). One warm-up call
+    per model pays first-call costs (lazy imports, page faults on
+    memory-mapped forests) before it goes live.
+    """
+    order = load_feature_order(features_path)
+    unknown = [name for name in order if name not in FEATURE_ORDER]
+    if unknown:
+        raise ValueError(f"{features_path} lists unknown features: {', '.join(map(str, unknown))}")
+    if len(set(order)) != len(order):
+        raise ValueError(f"{features_path} lists a feature more than once")
+    models = [load_model(model_path, db_path)]
+    if fast_model_path:
+        models.append(load_model(fast_model_path, db_path))
+    for m in models:
+        n = getattr(m, "n_features_in_", len(order))
+        if n != len(order):
+            raise ValueError(f"Model expects {n} features but {features_path} lists {len(order)}")
+        names = getattr(m, "feature_names_in_", None)
+        if names is not None and list(names) != order:
+            raise ValueError(f"Model was trained on features {list(names)}, not those in {features_path}")
+        try:
+            m.predict_proba(np.zeros((1, len(order))))
+        except AttributeError:
+            m.predict(np.zeros((1, len(order))))
+    paths = {"model": model_path, "features": features_path, "fast_model": fast_model_path}
+    return ModelBundle(models[0], models[1] if fast_model_path else None, order, paths, time.time())
+
+class FraudScorer:
+    def __init__(self, model_path: str = MODEL_PATH, features_path: str = FEATURES_PATH,
+                 db_path: str = DB_PATH, history: str = HISTORY_MODE, db_ttl: int = DB_TTL,
+                 checkpoint: str = CHECKPOINT_PATH, replay: bool = CHECKPOINT_REPLAY,
+                 fast_model_path: str = FAST_MODEL_PATH,
+                 cascade: Tuple[float, float] = (CASCADE_LOW, CASCADE_HIGH),
+                 write_behind: bool = WRITE_BEHIND):
+        if history not in ("sqlite", "memory"):
+            raise ValueError(f"Unknown history mode '{history}'")
+        if write_behind and history != "memory":
+            raise ValueError("Write-behind needs FRAUD_HISTORY=memory (SQLite mode reads features from the tx table)")
+        if db_ttl and db_ttl < HISTORY_RETENTION:
+            raise ValueError(f"FRAUD_DB_TTL must be at least {HISTORY_RETENTION}s (24h window + lateness)")
+        if not cascade[0] <= cascade[1]:
+            raise ValueError(f"Cascade band {cascade} is empty (need LOW <= HIGH)")
+        self.bundle = load_bundle(model_path, features_path, fast_model_path, db_path)
+        self.shadow: Optional[ModelBundle] = None
+        self._shadow_pool: Optional[ThreadPoolExecutor] = None
+        self._shadow_lock = threading.Lock()
+        self._shadow_pending = 0
+        self._shadow_stats: Dict[str, Any] = {}
+        self.cascade = cascade
+        self.tier_counts = {"fast": 0, "full": 0}
+        self._tier_lock = threading.Lock()
+        self.db_path = db_path
+        self.history_mode = history
+        self.db_ttl = db_ttl
+        self._stored = 0
+        self.checkpoint = checkpoint
+        self._checkpointed = time.monotonic()
+
+        self._local = threading.local()
+        if history == "sqlite":
+            ensure_schema(self.conn())
+            # Running tx row count for history_size(): this scorer's own commits
+            # and compactions on top of the count at startup.
+            self._rows = self.conn().execute("SELECT COUNT(*) FROM tx").fetchone()[0]
+            self._rows_lock = threading.Lock()
+            self.history = None
+            # SQLite serializes writers itself; each thread has its own connection.
+            self._lock = nullcontext()
+        else:
+            self.history = self._restore(replay)
+            self._lock = threading.Lock()
+        self.writer = None
+        self._unwritten: List[Dict[str, Any]] = []
+        if write_behind:
+            self.writer = WriteBehind(db_path, WRITE_MAX_BATCH, WRITE_MAX_DELAY_MS, WRITE_SYNC, ttl=db_ttl)
+
+    # Read-only views of the live bundle; replace models with swap().
+    @property
+    def model(self):
+        return self.bundle.model
+
+    @property
+    def fast_model(self):
+        return self.bundle.fast_model
+
+    @property
+    def feature_order(self) -> List[str]:
+        return self.bundle.feature_order
+
+    def conn(self):
+        """This thread's history connection; sqlite3 connections must not be shared."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect_db(self.db_path)
+        return conn
+
+    # ========
+    # FEATURES
+    # ========
+
+    def features(self, tx: Dict[str, Any]) -> Dict[str, float]:
+        if self.history is not None:
+            return tx_to_features_mem(tx, self.history)
+        return tx_to_features(tx, self.conn())
+
+    def record(self, tx: Dict[str, Any]):
+        """Adds tx to history; the caller commits (SQLite, or hands it to the writer)."""
+        if self.history is not None:
+            token = add_to_history(self.history, tx)
+            if self.writer is not None:
+                self._unwritten.append(tx)
+            return token
+        self._local.inserted = getattr(self._local, "inserted", 0) + insert_tx(self.conn(), tx, commit=False)
+        self._stored += 1
+        return None
+
+    def _count_rows(self, n: int):
+        with self._rows_lock:
+            self._rows += n
+
+    def _commit(self) -> List[Dict[str, Any]]:
+        """
+        Commits SQLite inserts. In write-behind mode returns the rows for the
+        writer instead: the caller submits them after releasing self._lock,
+        since submit blocks while the writer's queue is full.
+        """
+        if self.history is None:
+            self.conn().commit()
+            self._count_rows(getattr(self._local, "inserted", 0))
+            self._local.inserted = 0
+            return []
+        rows, self._unwritten = self._unwritten, []
+        return rows
+
+    def _submit(self, rows: List[Dict[str, Any]]):
+        # Order across concurrent callers does not matter: replay reads rows by unix_time.
+        if rows:
+            self.writer.submit(rows)
+
+    def _restore(self, replay: bool):
+        """Memory history from the checkpoint (if any), plus newer rows from FRAUD_DB."""
+        history, since = build_history(), None
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            history, meta = load_history(self.checkpoint)
+            since = meta["through"]
+            log.info("Restored %d history entries / %d cards from %s",
+                     meta["entries"], meta["cards"], self.checkpoint)
+        if replay and os.path.exists(self.db_path):
+            ensure_schema(self.conn())
+            n = replay_tail(history, self.conn(), since)
+            log.info("Replayed %d transactions from %s", n, self.db_path)
+        return history
+
+    def save_checkpoint(self):
+        if self.history is None or not self.checkpoint:
+            return
+        with self._lock:
+            save_history(self.history, self.checkpoint)
+        self._checkpointed = time.monotonic()
+
+    def close(self):
+        """Drains the write-behind queue and writes a final checkpoint (memory mode)."""
+        if self._shadow_pool is not None:
+            self._shadow_pool.shutdown(wait=False, cancel_futures=True)
+        if self.writer is not None:
+            self.writer.close()
+        self.save_checkpoint()
+
+    def _maintain(self):
+        """Keeps history bounded; runs between batches, never with undo tokens pending."""
+        if self.history is not None:
+            self.history.maybe_evict()
+            if self.checkpoint and time.monotonic() - self._checkpointed >= CHECKPOINT_EVERY:
+                save_history(self.history, self.checkpoint)
+                self._checkpointed = time.monotonic()
+        elif self.db_ttl and self._stored >= EVICT_EVERY:
+            self._stored = 0
+            conn = self.conn()
+            newest = conn.execute("SELECT MAX(unix_time) FROM tx").fetchone()[0]
+            if newest is not None:
+                self._count_rows(-compact_history(conn, newest - self.db_ttl))
+
+    # =======
+    # SCORING
+    # =======
+
+    def score(self, X: np.ndarray, model=None) -> Tuple[np.ndarray, List]:
+        """
+        Scores a feature matrix with a single predict_proba call. Labels are the
+        argmax class, i.e. exactly what model.predict would return.
+        """
+        model = self.model if model is None else model
+        try:
+            P = model.predict_proba(X)
+        except Exception:
+            return model.predict(X).astype(int), [None] * len(X)
+        labels = np.asarray(model.classes_)[np.argmax(P, axis=1)].astype(int)
+        return labels, P[:, 1].astype(float).tolist()
+
+    def score_cascade(self, X: np.ndarray, bundle: Optional[ModelBundle] = None,
+                      count: bool = True) -> Tuple[np.ndarray, List, np.ndarray]:
+        """
+        score() through the cascade: rows the fast model puts inside the
+        uncertainty band (or cannot give a probability for) are rescored by the
+        main model. Also returns a bool mask of the rows decided by the fast tier.
+        count=False leaves the tier counters alone (shadow scoring).
+        """
+        bundle = self.bundle if bundle is None else bundle
+        labels, probas = self.score(X, bundle.fast_model)
+        p = np.array([np.nan if v is None else v for v in probas], dtype=float)
+        low, high = self.cascade
+        decided = (p < low) | (p > high)
+        unsure = np.flatnonzero(~decided)
+        if len(unsure):
+            full_labels, full_probas = self.score(X[unsure], bundle.model)
+            labels = labels.copy()
+            labels[unsure] = full_labels
+            for i, v in zip(unsure.tolist(), full_probas):
+                probas[i] = v
+        if not count:
+            return labels, probas, decided
+        with self._tier_lock:
+            self.tier_counts["fast"] += int(decided.sum())
+            self.tier_counts["full"] += len(unsure)
+        SCORED.labels("fast").inc(int(decided.sum()))
+        SCORED.labels("full").inc(len(unsure))
+        return labels, probas, decided
+
+    def cascade_stats(self) -> Optional[Dict[str, Any]]:
+        """Per-tier counts and hit rates since start (None without a fast model)."""
+        if self.fast_model is None:
+            return None
+        with self._tier_lock:
+            counts = dict(self.tier_counts)
+        total = sum(counts.values())
+        return {
+            "band": list(self.cascade),
+            "counts": counts,
+            "hit_rate": {k: (v / total if total else 0.0) for k, v in counts.items()},
+        }
+
+    def verdict(self, feat_map: Dict[str, Any], is_fraud, proba,
+                order: Optional[List[str]] = None, with_features: bool = True) -> Dict[str, Any]:
+        out = {"is_fraud": bool(is_fraud), "proba": proba}
+        if with_features:
+            out["features"] = {
+                k: float(feat_map.get(k, 0.0) if feat_map.get(k) is not None else 0.0)
+                for k in (self.feature_order if order is None else order)
+            }
+        return out
+
+    def _verdicts(self, feat_maps: List[Any], timings: Optional[Dict[str, float]] = None,
+                  with_features: bool = True) -> List[Any]:
+        ok = [i for i, f in enumerate(feat_maps) if isinstance(f, dict)]
+        results = list(feat_maps)
+        if ok:
+            bundle = self.bundle  # one model set per call, whatever swap() does meanwhile
+            X = np.array([ordered_feature_row(feat_maps[i], bundle.feature_order) for i in ok], dtype=float)
+            t0 = time.perf_counter()
+            if bundle.fast_model is None:
+                labels, probas = self.score(X, bundle.model)
+                SCORED.labels("full").inc(len(ok))
+            else:
+                labels, probas, decided = self.score_cascade(X, bundle)
+            elapsed = time.perf_counter() - t0
+            STAGE_SECONDS.labels("inference").observe(elapsed)
+            if timings is not None:
+                timings["inference_ms"] = elapsed * 1e3
+            for j, (i, l, p) in enumerate(zip(ok, labels, probas)):
+                results[i] = self.verdict(feat_maps[i], l, p, bundle.feature_order, with_features)
+                if bundle.fast_model is not None:
+                    results[i]["tier"] = "fast" if decided[j] else "full"
+            shadow = self.shadow
+            if shadow is not None:
+                self._shadow_submit(shadow, [feat_maps[i] for i in ok], labels, probas, elapsed)
+        return results
+
+    # ======
+    # MODELS
+    # ======
+
+    def swap(self, bundle: ModelBundle):
+        """Makes bundle live; calls already scoring finish with the old one."""
+        old, self.bundle = self.bundle, bundle
+        if self.shadow is bundle:
+            self.set_shadow(None)
+        log.info("Model swapped: %s -> %s", old.paths["model"], bundle.paths["model"])
+
+    def set_shadow(self, bundle: Optional[ModelBundle]):
+        """Scores every later call with bundle too, off the request path (None stops)."""
+        with self._shadow_lock:
+            self._shadow_stats = {"calls": 0, "rows": 0, "skipped_calls": 0, "label_disagree": 0,
+                                  "flag_disagree": 0, "abs_delta_sum": 0.0, "abs_delta_max": 0.0,
+                                  "live_s": 0.0, "shadow_s": 0.0, "errors": 0}
+            if bundle is not None and self._shadow_pool is None:
+                self._shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+            self.shadow = bundle
+
+    def _shadow_submit(self, shadow: ModelBundle, feat_maps: List[Dict[str, Any]], labels, probas,
+                       live_s: float):
+        with self._shadow_lock:
+            if self._shadow_pending >= SHADOW_MAX_PENDING:
+                self._shadow_stats["skipped_calls"] += 1
+                return
+            self._shadow_pending += 1
+        try:
+            self._shadow_pool.submit(self._shadow_run, shadow, feat_maps, labels, probas, live_s)
+        except RuntimeError:  # pool shut down
+            with self._shadow_lock:
+                self._shadow_pending -= 1
+
+    def _shadow_run(self, shadow: ModelBundle, feat_maps, labels, probas, live_s: float):
+        try:
+            X = np.array([ordered_feature_row(f, shadow.feature_order) for f in feat_maps], dtype=float)
+            t0 = time.perf_counter()
+            if shadow.fast_model is None:
+                s_labels, s_probas = self.score(X, shadow.model)
+            else:
+                s_labels, s_probas, _ = self.score_cascade(X, shadow, count=False)
+            shadow_s = time.perf_counter() - t0
+        except Exception as e:
+            with self._shadow_lock:
+                self._shadow_pending -= 1
+                self._shadow_stats["errors"] += 1
+            log.warning("Shadow scoring failed: %s", e)
+            return
+        SHADOW_SECONDS.labels("live").observe(live_s)
+        SHADOW_SECONDS.labels("shadow").observe(shadow_s)
+
+        def flag(label, proba) -> bool:
+            return bool(label) if proba is None else proba >= THRESHOLD
+
+        deltas = [abs(a - b) for a, b in zip(probas, s_probas) if a is not None and b is not None]
+        with self._shadow_lock:
+            self._shadow_pending -= 1
+            if self.shadow is not shadow:
+                return  # replaced or promoted meanwhile
+            st = self._shadow_stats
+            st["calls"] += 1
+            st["rows"] += len(feat_maps)
+            st["label_disagree"] += int(np.sum(np.asarray(labels) != np.asarray(s_labels)))
+            st["flag_disagree"] += sum(flag(a, p) != flag(b, q)
+                                       for a, p, b, q in zip(labels, probas, s_labels, s_probas))
+            st["abs_delta_sum"] += sum(deltas)
+            st["abs_delta_max"] = max([st["abs_delta_max"]] + deltas)
+            st["live_s"] += live_s
+            st["shadow_s"] += shadow_s
+
+    def shadow_stats(self) -> Optional[Dict[str, Any]]:
+        """Agreement and latency of the shadow model against the live one (None without a shadow)."""
+        shadow = self.shadow
+        if shadow is None:
+            return None
+        with self._shadow_lock:
+            st = dict(self._shadow_stats)
+            st["pending_calls"] = self._shadow_pending
+        rows, calls = st.pop("rows"), st["calls"]
+        live_s, shadow_s, delta_sum = st.pop("live_s"), st.pop("shadow_s"), st.pop("abs_delta_sum")
+        return {
+            **st,
+            "paths": shadow.paths,
+            "threshold": THRESHOLD,
+            "rows": rows,
+            "flag_disagree_rate": st["flag_disagree"] / rows if rows else 0.0,
+            "abs_delta_mean": delta_sum / rows if rows else 0.0,
+            "live_ms_per_call": live_s * 1e3 / calls if calls else None,
+            "shadow_ms_per_call": shadow_s * 1e3 / calls if calls else None,
+        }
+
+    def model_info(self) -> Dict[str, Any]:
+        b = self.bundle
+        return {"paths": b.paths, "loaded_at": b.loaded_at, "feature_count": len(b.feature_order)}
+
+    # ===========
+    # PREDICTIONS
+    # ===========
+
+    def predict_many(self, items: List[Tuple[Dict[str, Any], int]],
+                     timings: Optional[Dict[str, float]] = None, with_features: bool = True) -> List[Any]:
+        """
+        Independent (tx, store) requests in arrival order. Features and history
+        updates run sequentially so history stays ordered; scoring is one call.
+        A failing tx yields its Exception in place of a verdict. If given,
+        timings receives features_ms, store_ms and inference_ms for the whole call.
+        with_features=False leaves the feature values out of the verdicts.
+        """
+        feat_maps: List[Any] = []
+        with self._lock:
+            t0 = time.perf_counter()
+            stored = 0.0
+            for tx, store in items:
+                try:
+                    feat = self.features(tx)
+                    if store:
+                        t1 = time.perf_counter()
+                        self.record(tx)
+                        stored += time.perf_counter() - t1
+                    feat_maps.append(feat)
+                except Exception as e:
+                    feat_maps.append(e)
+            t1 = time.perf_counter()
+            unwritten = self._commit()
+            stored += time.perf_counter() - t1
+            self._maintain()
+            elapsed = time.perf_counter() - t0 - stored
+        t1 = time.perf_counter()
+        self._submit(unwritten)
+        stored += time.perf_counter() - t1
+        STAGE_SECONDS.labels("features").observe(elapsed)
+        if any(store for _, store in items):
+            STAGE_SECONDS.labels("store").observe(stored)
+        if timings is not None:
+            timings["features_ms"] = elapsed * 1e3
+            timings["store_ms"] = stored * 1e3
+        return self._verdicts(feat_maps, timings, with_features)
+
+    def predict(self, tx: Dict[str, Any], store: int = 0,
+                timings: Optional[Dict[str, float]] = None, with_features: bool = True) -> Dict[str, Any]:
+        res = self.predict_many([(tx, store)], timings, with_features)[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def predict_batch(self, txs: List[Dict[str, Any]], store: int = 0,
+                      with_features: bool = True) -> List[Dict[str, Any]]:
+        """
+        Ordered batch: later transactions see earlier ones from the same batch.
+        The batch's history updates are kept only when store=1. A failing tx
+        yields its Exception in place of a verdict and is left out of history.
+        """
+        feat_maps, tokens, unwritten = [], [], []
+        with self._lock:
+            t0 = time.perf_counter()
+            for tx in txs:
+                try:
+                    feat = self.features(tx)
+                    tokens.append(self.record(tx))
+                    feat_maps.append(feat)
+                except Exception as e:
+                    feat_maps.append(e)
+            if store:
+                unwritten = self._commit()
+            else:
+                self._undo(tokens)
+            self._maintain()
+        self._submit(unwritten)
+        STAGE_SECONDS.labels("features").observe(time.perf_counter() - t0)
+        return self._verdicts(feat_maps, with_features=with_features)
+
+    def history_size(self) -> Dict[str, int]:
+        """Cards and entries held in memory, or tx rows in SQLite; running counts, read without locking."""
+        if self.history is not None:
+            return {"cards": len(self.history), "entries": self.history.entries}
+        return {"entries": self._rows}
+
+    def _undo(self, tokens):
+        if self.history is None:
+            self.conn().rollback()
+            self._local.inserted = 0
+            return
+        self._unwritten = []
+        for token in reversed(tokens):
+            discard_from_history(self.history, token)
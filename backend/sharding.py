@@ -0,0 +1,264 @@
+"""
+Per-card sharded scoring across worker processes.
+
+Every cc_num hashes to one of N shard processes. Each shard owns its own
+FraudScorer (and so, with in-memory history, its own partition of the card
+histories) and consumes a FIFO queue, so transactions of one card are always
+featurized in submission order while different cards use different cores.
+Each shard drains whatever is queued and scores it with one predict_many call.
+
+Each shard answers on its own pipe, which one reader thread watches along
+with the process sentinels. When a shard dies (OOM, crash, kill), the
+requests waiting on it fail at once and it is restarted on a fresh queue and
+pipe, with exponential backoff if it keeps dying; its in-memory history
+restarts from its checkpoint, if any. A shard killed mid-write can only
+break its own pipe, never the other shards' results.
+"""
+
+import asyncio
+import itertools
+import multiprocessing as mp
+import multiprocessing.connection
+import queue
+import signal
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from features import safe_str
+from logs import get_logger
+
+SHARD_BATCH_MAX = 256
+# A shard that dies within RESTART_QUICK seconds of starting waits 1, 2, 4, ...
+# (at most RESTART_MAX_DELAY) seconds before the next restart.
+RESTART_QUICK = 60.0
+RESTART_MAX_DELAY = 60.0
+
+log = get_logger("sharding")
+
+def shard_of(cc_num, n_shards: int) -> int:
+    """Stable across processes and restarts (unlike hash())."""
+    return zlib.crc32(safe_str(cc_num).encode("utf-8")) % n_shards
+
+def _shard_main(index: int, n_shards: int, inbox, results, scorer_kwargs: Dict[str, Any]):
+    from scoring import FraudScorer, CHECKPOINT_PATH
+    # Ctrl+C reaches the whole process group; the parent shuts shards down via close().
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each shard owns a partition of the cards, so it checkpoints separately.
+    checkpoint = scorer_kwargs.pop("checkpoint", CHECKPOINT_PATH)
+    if checkpoint:
+        scorer_kwargs["checkpoint"] = f"{checkpoint}.shard{index}of{n_shards}"
+    try:
+        scorer = FraudScorer(**scorer_kwargs)
+    except Exception as e:
+        results.send(f"shard {index} failed to start: {e}")
+        return
+    # Shards are the parallelism; nested joblib pools cannot start in a daemon process.
+    if hasattr(scorer.model, "n_jobs"):
+        scorer.model.n_jobs = 1
+    results.send(None)
+
+    while True:
+        first = inbox.get()
+        if first is None:
+            scorer.close()
+            return
+        items = [first]
+        stop = False
+        while len(items) < SHARD_BATCH_MAX:
+            try:
+                nxt = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                stop = True
+                break
+            items.append(nxt)
+
+        verdicts = scorer.predict_many([(tx, store) for _, tx, store in items])
+        results.send([
+            (req_id, False, f"{type(res).__name__}: {res}") if isinstance(res, Exception) else (req_id, True, res)
+            for (req_id, _, _), res in zip(items, verdicts)
+        ])
+        if stop:
+            scorer.close()
+            return
+
+class ShardPool:
+    def __init__(self, n_shards: int, **scorer_kwargs):
+        self._ctx = mp.get_context("spawn")
+        self.n = n_shards
+        self._scorer_kwargs = scorer_kwargs
+        self._ids = itertools.count()
+        # req_id -> (future, shard)
+        self._pending: Dict[int, Tuple[asyncio.Future, int]] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closing = False
+        self._down = set()  # dead shards waiting for their restart
+        self._inboxes: List[Any] = [None] * n_shards
+        self._results: List[Any] = [None] * n_shards
+        self._senders: List[Any] = [None] * n_shards
+        self._procs: List[Any] = [None] * n_shards
+        self._started = [0.0] * n_shards
+        self._backoff = [0.0] * n_shards
+        self.submitted = [0] * n_shards
+        self.restarts = [0] * n_shards
+        for i in range(n_shards):
+            self._spawn(i)
+
+        # Wait for every shard to load its model before accepting work.
+        for i in range(n_shards):
+            if self._results[i] in mp.connection.wait([self._results[i], self._procs[i].sentinel]):
+                err = self._results[i].recv()
+            else:
+                err = f"shard {i} exited during startup (exit code {self._procs[i].exitcode})"
+            if err:
+                self.close()
+                raise RuntimeError(err)
+
+        self._reader = threading.Thread(target=self._read_results, name="shard-results", daemon=True)
+        self._reader.start()
+
+    def _spawn(self, i: int):
+        """Starts shard i on a fresh queue and result pipe."""
+        old = self._inboxes[i]
+        if old is not None:
+            old.cancel_join_thread()  # nobody reads it any more; do not block exit on it
+            old.close()
+        for conn in (self._results[i], self._senders[i]):
+            if conn is not None:
+                conn.close()
+        # The parent keeps the write end open (spawn hands it over lazily), so
+        # a dead shard shows up through its process sentinel rather than EOF.
+        recv, send = self._ctx.Pipe(duplex=False)
+        self._senders[i] = send
+        with self._lock:
+            self._inboxes[i] = self._ctx.Queue()
+            self._results[i] = recv
+            self._down.discard(i)
+        p = self._ctx.Process(target=_shard_main, name=f"shard-{i}", daemon=True,
+                              args=(i, self.n, self._inboxes[i], send, dict(self._scorer_kwargs)))
+        p.start()
+        self._procs[i] = p
+        self._started[i] = time.monotonic()
+
+    def submit(self, tx: Dict[str, Any], store: int) -> asyncio.Future:
+        """Queues tx on its card's shard; must be called from the event loop."""
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        fut = loop.create_future()
+        req_id = next(self._ids)
+        shard = shard_of(tx.get("cc_num"), self.n)
+        with self._lock:
+            if shard in self._down:
+                fut.set_exception(RuntimeError(f"shard {shard} is restarting"))
+                return fut
+            self._pending[req_id] = (fut, shard)
+            self.submitted[shard] += 1
+            self._inboxes[shard].put((req_id, tx, store))
+        fut.add_done_callback(lambda _, r=req_id: self._forget(r))  # also after a caller's timeout
+        return fut
+
+    def _forget(self, req_id: int):
+        with self._lock:
+            self._pending.pop(req_id, None)
+
+    # =======
+    # RESULTS
+    # =======
+
+    def _read_results(self):
+        """Delivers results; fails the requests of shards that died and restarts them."""
+        due: Dict[int, float] = {}  # dead shard -> restart time
+        while not self._closing:
+            live = [i for i in range(self.n) if i not in due]
+            handles = {self._results[i]: i for i in live}
+            handles.update({self._procs[i].sentinel: i for i in live})
+            timeout = min([1.0] + [max(0.0, at - time.monotonic()) for at in due.values()])
+            ready = mp.connection.wait(list(handles), timeout=timeout)
+            dead = set()
+            for h in ready:
+                i = handles[h]
+                if i in dead or h is not self._results[i]:
+                    continue
+                try:
+                    while self._results[i].poll():
+                        self._deliver(i, self._results[i].recv())
+                except (EOFError, OSError):
+                    dead.add(i)
+            for h in ready:
+                i = handles[h]
+                if h is self._procs[i].sentinel and i not in dead:
+                    self._drain(i)
+                    dead.add(i)
+            if self._closing:
+                return
+            for i in dead:
+                self._fail_shard(i)
+                quick = time.monotonic() - self._started[i] < RESTART_QUICK
+                self._backoff[i] = min(RESTART_MAX_DELAY, max(1.0, 2 * self._backoff[i])) if quick else 0.0
+                due[i] = time.monotonic() + self._backoff[i]
+            for i, at in list(due.items()):
+                if at <= time.monotonic() and not self._closing:
+                    del due[i]
+                    self.restarts[i] += 1
+                    log.warning("Restarting shard %d (restart %d)", i, self.restarts[i])
+                    self._spawn(i)
+
+    def _drain(self, i: int):
+        """Results shard i sent before exiting."""
+        try:
+            while self._results[i].poll():
+                self._deliver(i, self._results[i].recv())
+        except (EOFError, OSError):
+            pass
+
+    def _deliver(self, i: int, msg):
+        if msg is None or isinstance(msg, str):  # a restarted shard reporting in
+            if msg:
+                log.error("%s", msg)
+            else:
+                log.info("Shard %d is up again", i)
+            return
+        with self._lock:
+            entries = [(self._pending.pop(req_id, None), ok, payload) for req_id, ok, payload in msg]
+        if self._loop is not None:
+            for entry, ok, payload in entries:
+                if entry is not None:
+                    self._loop.call_soon_threadsafe(_resolve, entry[0], ok, payload)
+
+    def _fail_shard(self, i: int):
+        """Fails the requests shard i had not answered; new ones fail until it is restarted."""
+        code = self._procs[i].exitcode
+        with self._lock:
+            self._down.add(i)
+            lost = [self._pending.pop(r)[0] for r, (_, shard) in list(self._pending.items()) if shard == i]
+        log.error("Shard %d died (exit code %s); failing %d pending requests", i, code, len(lost))
+        if self._loop is not None:
+            for fut in lost:
+                self._loop.call_soon_threadsafe(_resolve, fut, False, f"shard {i} died (exit code {code})")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._pending)
+        return {"shards": self.n, "submitted": list(self.submitted), "in_flight": in_flight,
+                "restarts": list(self.restarts), "alive": [p.is_alive() for p in self._procs]}
+
+    def close(self, timeout: float = 5.0):
+        self._closing = True
+        for q in self._inboxes:
+            q.put(None)
+        for p in self._procs:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+
+def _resolve(fut: asyncio.Future, ok: bool, payload):
+    if fut.done():
+        return
+    if ok:
+        fut.set_result(payload)
+    else:
+        fut.set_exception(RuntimeError(payload))
@@ -3,22 +3,33 @@
 """
 For each transaction:
   1. Reads from hackathon stream
-  2. Predicts fraud locally via FastAPI (/predict?store=1)
-  3. Flags to hackathon FLAG_URL
-  4. Also POSTs full transaction (with model results) to your Next.js frontend
+  2. Predicts fraud locally via FastAPI (/predict?store=1), or in-process
+     with the same scoring engine when PREDICT_MODE=inprocess
+  3. Flags to hackathon FLAG_URL through a durable outbox (flag_outbox.py)
+  4. Also POSTs full transaction (with model results) to your Next.js frontend,
+     unless FRONTEND_POST_URL is empty and dashboards read a /stream hub instead
+     (fraud_api's, or in in-process mode the one next to /metrics, which
+     also serves /stats from the rollups when FRAUD_ROLLUPS=1)
+
+Runs on asyncio: the stream reader feeds a bounded queue (so a slow flag
+endpoint throttles reading instead of growing memory), MAX_WORKERS tasks
+drain it, and all HTTP goes through pooled keep-alive sessions.
 """
 
 import os
 import json
+import logging
 import time
-import threading
-import urllib3
-import requests
-from sseclient import SSEClient
+import asyncio
+import aiohttp
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from flag_outbox import FlagOutbox, http_sender
+from logs import get_logger
+from metrics import CONTENT_TYPE, Counter, Gauge, Histogram, render
+from stream_hub import StreamHub, decide_flag, scored_event
+import wire
 
 # =======================
 # HARDCODED CONFIGURATION
@@ -29,6 +40,9 @@ CONNECT_TIMEOUT = 5
 READ_TIMEOUT = None
 REQ_TIMEOUT = 10
 PRINT_FEATURES = False
+FLAG_MAX_ATTEMPTS = 0  # 0 = retry until delivered (permanent 4xx still give up)
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
 
 # ======================================================
 # CONFIGURATION (from .env) - API Key, URLs & Processing
@@ -41,36 +55,134 @@ API_KEY = os.getenv("API_KEY")
 STREAM_URL = os.getenv("STREAM_URL")
 FLAG_URL = os.getenv("FLAG_URL")
 LOCAL_PREDICT_URL = os.getenv("LOCAL_PREDICT_URL")
+# Empty skips the per-transaction POST to the Next.js /api/stream route.
 FRONTEND_POST_URL = os.getenv("FRONTEND_POST_URL")
 
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+QUEUE_SIZE = int(os.getenv("QUEUE_SIZE", str(4 * MAX_WORKERS)))
 THRESHOLD = float(os.getenv("THRESHOLD", "0.35"))
-
-stream_headers = {
+# Pending flags survive restarts in this append-only file ("" = memory only);
+# FLAG_CONCURRENCY bounds simultaneous flag POSTs.
+FLAG_OUTBOX = os.getenv("FLAG_OUTBOX", "flag_outbox.jsonl")
+FLAG_OUTBOX_FSYNC = os.getenv("FLAG_OUTBOX_FSYNC", "0") == "1"
+FLAG_OUTBOX_MAX_PENDING = int(os.getenv("FLAG_OUTBOX_MAX_PENDING", "100000"))
+FLAG_CONCURRENCY = int(os.getenv("FLAG_CONCURRENCY", str(4 * MAX_WORKERS)))
+# "http": POST to LOCAL_PREDICT_URL; "inprocess": load the model and history here
+# (FRAUD_MODEL / FRAUD_FEATURES / FRAUD_DB / FRAUD_HISTORY, as for fraud_api).
+PREDICT_MODE = os.getenv("PREDICT_MODE", "http")
+PREDICT_STORE = int(os.getenv("PREDICT_STORE", "1"))
+# In-process mode only: >0 spreads cards over that many scoring processes
+# (per-card order preserved). SHARD_HISTORY is their history backend.
+SHARDS = int(os.getenv("SHARDS", "0"))
+SHARD_HISTORY = os.getenv("SHARD_HISTORY", "memory")
+# A trans_num seen within the last DEDUP_TTL..2*DEDUP_TTL seconds is skipped.
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "3600"))
+# Optional JSON-lines file with per-transaction stage timings (see bench.py).
+TRACE_PATH = os.getenv("TRACE_PATH")
+# >0 serves Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# In-process mode: that server also broadcasts scored transactions at /stream
+# (fraud_api does it in http mode), keeping the last STREAM_BUFFER events.
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", "1024"))
+
+log = get_logger("stream")
+
+STAGE_SECONDS = Histogram("sse_stage_seconds",
+                          "Per-transaction time by stage: queue, predict, frontend, total", ["stage"])
+TX_TOTAL = Counter("sse_transactions_total", "Stream events by outcome", ["outcome"])
+IN_FLIGHT = Gauge("sse_in_flight", "Transactions being processed by workers")
+FRONTEND_ERRORS = Counter("sse_frontend_errors_total", "Frontend POSTs that raised")
+RECONNECTS = Counter("sse_stream_reconnects_total", "Stream connection attempts after a failure")
+
+def _headers(h: dict) -> dict:
+    # aiohttp rejects None values (requests used to drop them silently).
+    return {k: v for k, v in h.items() if v is not None}
+
+stream_headers = _headers({
     "X-API-Key": API_KEY,
     "Accept": "text/event-stream",
     "Cache-Control": "no-cache",
     "Connection": "keep-alive",
-}
-flag_headers_json = {
+})
+flag_headers_json = _headers({
     "X-API-Key": API_KEY,
     "Content-Type": "application/json",
     "Accept": "application/json",
-}
-flag_headers_form = {
+})
+flag_headers_form = _headers({
     "X-API-Key": API_KEY,
     "Content-Type": "application/x-www-form-urlencoded",
     "Accept": "application/json",
-}
+})
 
-_seen = set()
-_seen_lock = threading.Lock()
+class RecentKeys:
+    """
+    Time-bounded set: keys live in the current generation and, after a
+    rotation every ttl seconds, in the previous one, so membership lasts
+    between ttl and 2*ttl and memory tracks the arrival rate, not uptime.
+    """
 
-# Reuse sessions for efficiency
-sess_stream = requests.Session()
-sess_flag = requests.Session()
-sess_predict = requests.Session()
-sess_frontend = requests.Session()
+    def __init__(self, ttl: float, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.current, self.previous = set(), set()
+        self.rotated = clock()
+
+    def _rotate(self):
+        now = self.clock()
+        if now - self.rotated >= self.ttl:
+            # A gap of more than two periods expires everything.
+            self.previous = self.current if now - self.rotated < 2 * self.ttl else set()
+            self.current = set()
+            self.rotated = now
+
+    def __contains__(self, key) -> bool:
+        self._rotate()
+        return key in self.current or key in self.previous
+
+    def add(self, key):
+        self._rotate()
+        self.current.add(key)
+
+    def __len__(self) -> int:
+        return len(self.current) + len(self.previous)
+
+_seen = RecentKeys(DEDUP_TTL)
+
+# In-process scoring: one thread, so history updates keep stream order.
+_scorer = None
+_shards = None
+_score_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scorer")
+_trace = None
+_outbox = None
+_hub = None
+_rollups = None
+_reloader = None
+
+# ========
+# SESSIONS
+# ========
+
+class Sessions:
+    """Pooled keep-alive HTTP/1.1 clients, one pool per destination."""
+
+    def __init__(self):
+        def session(limit, timeout):
+            connector = aiohttp.TCPConnector(limit=limit, ssl=None if VERIFY_TLS else False,
+                                             keepalive_timeout=30)
+            return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        req_timeout = aiohttp.ClientTimeout(total=REQ_TIMEOUT)
+        self.stream = session(1, aiohttp.ClientTimeout(
+            total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT))
+        self.predict = session(MAX_WORKERS, req_timeout)
+        self.flag = session(FLAG_CONCURRENCY, req_timeout)
+        self.frontend = session(MAX_WORKERS, req_timeout)
+
+    async def close(self):
+        for s in (self.stream, self.predict, self.flag, self.frontend):
+            await s.close()
 
 # =======
 # HELPERS
@@ -82,182 +194,308 @@ def pretty(o):
     except Exception:
         return str(o)
 
-def predict_local(tx: dict) -> dict:
-    """Call local FastAPI predictor."""
-    r = sess_predict.post(LOCAL_PREDICT_URL, json=tx, timeout=REQ_TIMEOUT)
-    r.raise_for_status()
-    return r.json()
-
-def decide_flag(is_fraud_pred: bool, proba):
-    """Decide whether to flag based on threshold."""
-    if proba is not None:
-        try:
-            return 1 if float(proba) >= THRESHOLD else 0
-        except Exception:
-            pass
-    return 1 if is_fraud_pred else 0
-
-def post_flag(trans_num: str, flag_value: int, retries=3):
-    """Send flag to hackathon API and print response."""
-    payload = {"trans_num": trans_num, "flag_value": int(flag_value)}
-    for attempt in range(1, retries + 1):
-        try:
-            resp = sess_flag.post(
-                FLAG_URL,
-                headers=flag_headers_json,
-                json=payload,
-                verify=VERIFY_TLS,
-                timeout=REQ_TIMEOUT,
-            )
-            if resp.status_code in (400, 415):
-                resp = sess_flag.post(
-                    FLAG_URL,
-                    headers=flag_headers_form,
-                    data=payload,
-                    verify=VERIFY_TLS,
-                    timeout=REQ_TIMEOUT,
-                )
-
-            print(f"--- FLAG Response for {trans_num} ---")
-            print(f"HTTP {resp.status_code}")
-            print(resp.text.strip())
-            try:
-                print(pretty(resp.json()))
-            except Exception:
-                pass
-            print("-------------------------------------")
-
-            if 200 <= resp.status_code < 300:
-                return resp
-            else:
-                print(f"[WARN] Non-200 ({resp.status_code}), retrying {attempt}/{retries}")
-                time.sleep(1.5 * attempt)
-        except Exception as e:
-            print(f"[ERROR] Flagging {trans_num}: {e} (attempt {attempt}/{retries})")
-            time.sleep(1.5 * attempt)
-    print(f"[FAIL] Giving up on {trans_num}")
-    return None
-
-def post_frontend_transaction(tx: dict, verdict: dict, flag_value: int):
+def parse_server_timing(header: str, timings: dict):
+    """'features;dur=1.2, inference;dur=3.4' -> timings['features_ms'] = 1.2, ..."""
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    timings[f"{name}_ms"] = float(value)
+                except ValueError:
+                    pass
+
+JSON_HEADERS = {"Content-Type": wire.JSON, "Accept": wire.JSON}
+# The API leaves the feature values out of its verdicts unless asked for them.
+PREDICT_PARAMS = {"features": "1"} if PRINT_FEATURES else None
+
+async def predict_local(sessions: Sessions, tx: dict, timings: dict = None) -> dict:
+    """Call local FastAPI predictor, or score in-process with the same engine."""
+    if _shards is not None:
+        return await asyncio.wait_for(_shards.submit(tx, PREDICT_STORE), REQ_TIMEOUT)
+    if _scorer is not None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_score_pool, _scorer.predict, tx, PREDICT_STORE, timings)
+    async with sessions.predict.post(LOCAL_PREDICT_URL, data=wire.dumps(tx), headers=JSON_HEADERS,
+                                     params=PREDICT_PARAMS) as r:
+        r.raise_for_status()
+        if timings is not None and "Server-Timing" in r.headers:
+            parse_server_timing(r.headers["Server-Timing"], timings)
+        return wire.loads(await r.read())
+
+async def timed(coro, trace, key: str):
+    """Awaits coro, observing its duration in STAGE_SECONDS (and trace[key] in ms when tracing)."""
+    t0 = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.labels(key[:-3]).observe(elapsed)
+        if trace is not None:
+            trace[key] = elapsed * 1e3
+
+async def post_frontend_transaction(sessions: Sessions, event: dict):
     """
     Send full transaction (with model verdict) to your Next.js frontend.
     """
-    enriched = dict(tx)
-    enriched["fraud"] = int(flag_value)
-    enriched["is_fraud"] = int(flag_value)
-    enriched["model_is_fraud_pred"] = bool(verdict.get("is_fraud", False))
-    enriched["model_proba"] = verdict.get("proba", None)
-    enriched["model_threshold"] = THRESHOLD
-    enriched["source"] = "hackathon-stream"
-
-    payload = {"transaction": enriched}
+    payload = {"transaction": event}
 
     try:
-        resp = sess_frontend.post(FRONTEND_POST_URL, json=payload, timeout=REQ_TIMEOUT)
-        print(f"--- FRONTEND POST for {tx.get('trans_num')} ---")
-        print(f"HTTP {resp.status_code}")
-        print(resp.text.strip())
-        print("-----------------------------------------------")
-        return resp
+        async with sessions.frontend.post(FRONTEND_POST_URL, data=wire.dumps(payload), headers=JSON_HEADERS) as resp:
+            text = await resp.text()
+            log.debug("Frontend %s: HTTP %d %s", event.get("trans_num"), resp.status, text.strip())
+            return resp.status
     except Exception as e:
-        print(f"[FRONTEND] Error posting to {FRONTEND_POST_URL}: {e}")
+        FRONTEND_ERRORS.inc()
+        log.warning("Frontend POST to %s failed: %s", FRONTEND_POST_URL, e)
         return None
 
 # ===========
 # MAIN WORKER
 # ===========
 
-def process_transaction(tx: dict):
+async def process_transaction(sessions: Sessions, tx: dict, trace: dict = None):
     trans_num = tx.get("trans_num")
     if not trans_num:
-        print("[WARN] Missing trans_num; skipping.")
+        TX_TOTAL.labels("invalid").inc()
+        log.warning("Missing trans_num; skipping")
         return
 
-    with _seen_lock:
-        if trans_num in _seen:
-            print(f"[SKIP] Already processed {trans_num}")
-            return
-        _seen.add(trans_num)
+    if trans_num in _seen:
+        TX_TOTAL.labels("duplicate").inc()
+        log.debug("Already processed %s", trans_num)
+        return
+    _seen.add(trans_num)
 
-    amt = float(tx.get("amt", 0) or 0)
-    category = tx.get("category")
-    merchant = tx.get("merchant")
-    print(f"→ TX {trans_num}: ${amt:.2f} | {category} | {merchant}")
+    log.debug("TX %s: %s | %s | %s", trans_num, tx.get("amt"), tx.get("category"), tx.get("merchant"))
 
     # Predict
     try:
-        verdict = predict_local(tx)
+        verdict = await timed(predict_local(sessions, tx, trace), trace, "predict_ms")
     except Exception as e:
-        print(f"[PREDICT] Error for {trans_num}: {e}")
+        TX_TOTAL.labels("predict_error").inc()
+        log.error("Predict failed for %s: %s", trans_num, e)
         return
 
     is_fraud_pred = bool(verdict.get("is_fraud", False))
     proba = verdict.get("proba", None)
 
-    if PRINT_FEATURES:
-        print("Features:", pretty(verdict.get("features", {})))
-
-    flag_value = decide_flag(is_fraud_pred, proba)
-    print(f"   Model: is_fraud={is_fraud_pred}  proba={proba}  → flag_value={flag_value}")
-
-    # 1. Send flag to hackathon backend
-    post_flag(trans_num, flag_value)
-
-    # 2. Send enriched transaction to local frontend
-    post_frontend_transaction(tx, verdict, flag_value)
-
-    print("-" * 80)
+    if PRINT_FEATURES and log.isEnabledFor(logging.DEBUG):
+        log.debug("Features %s: %s", trans_num, pretty(verdict.get("features", {})))
+
+    flag_value = decide_flag(is_fraud_pred, proba, THRESHOLD)
+    log.debug("Model %s: is_fraud=%s proba=%s flag_value=%d", trans_num, is_fraud_pred, proba, flag_value)
+
+    # The outbox sends the flag in the background; the frontend POST is awaited here.
+    _outbox.add(trans_num, flag_value)
+    if _rollups is not None:
+        _rollups.add(tx, flag_value)
+    if _hub is not None or FRONTEND_POST_URL:
+        event = scored_event(tx, verdict, flag_value, THRESHOLD)
+        if _hub is not None:
+            _hub.publish(event)
+        if FRONTEND_POST_URL:
+            await timed(post_frontend_transaction(sessions, event), trace, "frontend_ms")
+    TX_TOTAL.labels("processed").inc()
+
+async def worker(sessions: Sessions, queue: asyncio.Queue):
+    while True:
+        tx, enqueued = await queue.get()
+        start = time.perf_counter()
+        STAGE_SECONDS.labels("queue").observe(start - enqueued)
+        IN_FLIGHT.inc()
+        trace = None
+        if _trace is not None:
+            trace = {"trans_num": tx.get("trans_num"), "queue_ms": (start - enqueued) * 1e3}
+        try:
+            await process_transaction(sessions, tx, trace)
+        except Exception as e:
+            log.exception("Unexpected error for %s: %s", tx.get("trans_num"), e)
+        finally:
+            queue.task_done()
+            IN_FLIGHT.dec()
+            total = time.perf_counter() - start
+            STAGE_SECONDS.labels("total").observe(total)
+            if trace is not None:
+                trace["total_ms"] = total * 1e3
+                trace["done"] = time.time()
+                _trace.write(json.dumps(trace) + "\n")
 
 # ===========
 # STREAM LOOP
 # ===========
 
-def run_stream():
-    backoff = 1.0
-    while True:
+async def sse_events(resp: aiohttp.ClientResponse):
+    """Yields the data payload of each server-sent event."""
+    data = []
+    async for raw in resp.content:
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data:
+                yield "\n".join(data)
+                data = []
+        elif line.startswith("data:"):
+            value = line[5:]
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield "\n".join(data)
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST):
+    """
+    Serves GET /metrics (rendered off the event loop; it may query history)
+    and, when _hub / _rollups are set, GET /stream and GET /stats.
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        body = await asyncio.get_running_loop().run_in_executor(None, render)
+        return web.Response(body=body.encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def handle_stream(request):
         try:
-            print("Connecting to stream...")
-            resp = sess_stream.get(
-                STREAM_URL,
-                headers=stream_headers,
-                stream=True,
-                verify=VERIFY_TLS,
-                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
-            )
-            resp.raise_for_status()
-            client = SSEClient(resp)
-            print("Connected. Waiting for transactions...\n")
-
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
-                for event in client.events():
-                    if not event or not getattr(event, "data", None):
-                        continue
-                    try:
-                        tx = json.loads(event.data)
-                    except json.JSONDecodeError as e:
-                        print(f"[STREAM] JSON parse error: {e}")
-                        continue
-
-                    trans_num = tx.get("trans_num", "<unknown>")
-                    print(f"Event: {trans_num}")
-                    pool.submit(process_transaction, tx)
-        except KeyboardInterrupt:
-            print("\nStopped by user.")
-            return
-        except requests.exceptions.RequestException as e:
-            print(f"[STREAM] Connection error: {e}. Reconnecting in {backoff:.1f}s...")
-            time.sleep(backoff)
-            backoff = min(backoff * 2, 15)
-        except Exception as e:
-            print(f"[STREAM] Unexpected error: {e}. Reconnecting in {backoff:.1f}s...")
-            time.sleep(backoff)
+            backlog = max(0, int(request.query.get("backlog", "0")))
+        except ValueError:
+            backlog = 0
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no", "Access-Control-Allow-Origin": "*"})
+        await resp.prepare(request)
+        try:
+            async for chunk in _hub.events(_hub.cursor_for(request.headers.get("Last-Event-ID"), backlog)):
+                await resp.write(chunk.encode("utf-8"))
+        except ConnectionResetError:
+            pass
+        return resp
+
+    async def handle_stats(request):
+        q = request.query
+        try:
+            args = (int(q["start"]) if "start" in q else None, int(q["end"]) if "end" in q else None,
+                    int(q.get("limit", "20")), q.get("series"))
+            body = await asyncio.get_running_loop().run_in_executor(None, _rollups.query, *args)
+        except ValueError as e:
+            return web.json_response({"detail": str(e)}, status=400)
+        return web.json_response(body)
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    if _hub is not None:
+        app.router.add_get("/stream", handle_stream)
+    if _rollups is not None:
+        app.router.add_get("/stats", handle_stats)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Metrics at http://%s:%d/metrics", host, port)
+    return runner
+
+async def run_stream():
+    global _trace, _outbox, _hub, _rollups
+    if TRACE_PATH:
+        _trace = open(TRACE_PATH, "a", encoding="utf-8", buffering=1)
+    sessions = Sessions()
+    _outbox = FlagOutbox(http_sender(sessions.flag, FLAG_URL, flag_headers_json, flag_headers_form),
+                         FLAG_OUTBOX, FLAG_CONCURRENCY, FLAG_MAX_ATTEMPTS, RETRY_BASE_DELAY,
+                         RETRY_MAX_DELAY, fsync=FLAG_OUTBOX_FSYNC, max_pending=FLAG_OUTBOX_MAX_PENDING)
+    await _outbox.start()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    Gauge("sse_queue_depth", "Events read from the stream and waiting for a worker", fn=queue.qsize)
+    Gauge("sse_dedup_keys", "trans_nums remembered for deduplication", fn=lambda: len(_seen))
+    if _scorer is not None:
+        Gauge("fraud_history_entries", "Transactions held in scoring history",
+              fn=lambda: _scorer.history_size()["entries"])
+    if _shards is not None:
+        Gauge("sse_shard_in_flight", "Requests submitted to scoring shards and not yet answered",
+              fn=lambda: _shards.stats()["in_flight"])
+    if METRICS_PORT > 0 and (_scorer is not None or _shards is not None):
+        _hub = StreamHub(STREAM_BUFFER)
+        from rollups import ROLLUPS, Rollups
+        from scoring import DB_PATH
+        if ROLLUPS and PREDICT_STORE:
+            _rollups = Rollups(DB_PATH)
+    metrics_runner = await start_metrics_server(METRICS_PORT) if METRICS_PORT > 0 else None
+    workers = [asyncio.create_task(worker(sessions, queue)) for _ in range(MAX_WORKERS)]
+    backoff = 1.0
+    try:
+        while True:
+            try:
+                log.info("Connecting to stream...")
+                async with sessions.stream.get(STREAM_URL, headers=stream_headers) as resp:
+                    resp.raise_for_status()
+                    log.info("Connected. Waiting for transactions...")
+                    backoff = 1.0
+                    async for data in sse_events(resp):
+                        try:
+                            tx = wire.loads(data)
+                        except json.JSONDecodeError as e:
+                            TX_TOTAL.labels("invalid").inc()
+                            log.warning("Stream JSON parse error: %s", e)
+                            continue
+
+                        log.debug("Event: %s", tx.get("trans_num", "<unknown>"))
+                        # Blocks while QUEUE_SIZE events are pending: backpressure on the reader.
+                        await queue.put((tx, time.perf_counter()))
+                raise aiohttp.ClientPayloadError("stream closed by server")
+            except aiohttp.ClientError as e:
+                log.warning("Stream connection error: %s. Reconnecting in %.1fs...", e, backoff)
+            except asyncio.TimeoutError:
+                log.warning("Stream timed out. Reconnecting in %.1fs...", backoff)
+            except Exception as e:
+                log.error("Unexpected stream error: %s. Reconnecting in %.1fs...", e, backoff)
+            RECONNECTS.inc()
+            await asyncio.sleep(backoff)
             backoff = min(backoff * 2, 15)
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await _outbox.close()
+        await sessions.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if _rollups is not None:
+            _rollups.close()
+        if _trace is not None:
+            _trace.close()
 
 # ====
 # MAIN
 # ====
 
+def load_scorer():
+    """The in-process scorer; FRAUD_MODEL_WATCH > 0 also reloads it when the model files change."""
+    global _scorer, _reloader
+    from scoring import FraudScorer
+    from model_reload import MODEL_WATCH, ModelReloader
+    _scorer = FraudScorer()
+    if MODEL_WATCH > 0:
+        _reloader = ModelReloader(_scorer)
+    return _scorer
+
+def start_shards(n: int):
+    global _shards
+    from sharding import ShardPool
+    _shards = ShardPool(n, history=SHARD_HISTORY)
+    return _shards
+
 if __name__ == "__main__":
-    print(f"Frontend POST URL: {FRONTEND_POST_URL}")
-    print(f"FastAPI predictor: {LOCAL_PREDICT_URL}")
-    run_stream()
+    log.info("Frontend POST URL: %s", FRONTEND_POST_URL or "(disabled)")
+    if PREDICT_MODE == "inprocess" and SHARDS > 0:
+        start_shards(SHARDS)
+        log.info("In-process predictor: %d shards, %s history", SHARDS, SHARD_HISTORY)
+    elif PREDICT_MODE == "inprocess":
+        s = load_scorer()
+        log.info("In-process predictor: %s history, %d features", s.history_mode, len(s.feature_order))
+    else:
+        log.info("FastAPI predictor: %s", LOCAL_PREDICT_URL)
+    try:
+        asyncio.run(run_stream())
+    except KeyboardInterrupt:
+        log.info("Stopped by user.")
+    finally:
+        if _shards is not None:
+            _shards.close()
+        if _reloader is not None:
+            _reloader.close()
+        if _scorer is not None:
+            _scorer.close()
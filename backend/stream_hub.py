@@ -0,0 +1,148 @@
+"""
+Server-sent event fan-out of scored transactions for the dashboards.
+
+StreamHub keeps the last `size` events in a ring of ready-to-send SSE
+frames; publishing never waits for clients and memory does not grow with
+their number. Each client only holds a cursor into the ring: when woken it
+writes every frame it has not seen as one chunk (slow clients get bigger,
+fewer writes), and a client that fell further behind than the ring skips
+ahead, counting the dropped events, instead of holding the publisher back.
+
+Event ids are "<epoch>:<seq>", so a reconnecting EventSource resumes via
+Last-Event-ID right after the last event it got, and one whose id comes
+from an earlier process replays the whole ring.
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from metrics import Counter, Gauge
+
+PUBLISHED = Counter("stream_hub_events_total", "Events published to /stream")
+DROPPED = Counter("stream_hub_dropped_total", "Events skipped for clients that fell behind the ring")
+CHUNKS = Counter("stream_hub_chunks_total", "Chunks written to /stream clients")
+
+# Numeric fields the dashboard expects as numbers rather than strings.
+FLOAT_FIELDS = ("lat", "long", "amt", "merch_lat", "merch_long")
+INT_FIELDS = ("city_pop", "unix_time")
+
+def decide_flag(is_fraud_pred: bool, proba, threshold: float) -> int:
+    """Flag when proba >= threshold; falls back to the model label without a probability."""
+    if proba is not None:
+        try:
+            return 1 if float(proba) >= threshold else 0
+        except Exception:
+            pass
+    return 1 if is_fraud_pred else 0
+
+def scored_event(tx: Dict[str, Any], verdict: Dict[str, Any], flag_value: int, threshold: float) -> Dict[str, Any]:
+    """The transaction as the dashboard shows it: raw fields plus the model's verdict."""
+    event = dict(tx)
+    for k in FLOAT_FIELDS:
+        try:
+            event[k] = float(event[k])
+        except (KeyError, TypeError, ValueError):
+            pass
+    for k in INT_FIELDS:
+        try:
+            event[k] = int(float(event[k]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    event["fraud"] = int(flag_value)
+    event["is_fraud"] = int(flag_value)
+    event["model_is_fraud_pred"] = bool(verdict.get("is_fraud", False))
+    event["model_proba"] = verdict.get("proba", None)
+    event["model_threshold"] = threshold
+    event["source"] = "hackathon-stream"
+    return event
+
+class StreamHub:
+    def __init__(self, size: int = 1024, max_chunk: int = 256, heartbeat: float = 15.0):
+        self.size = max(1, int(size))
+        self.max_chunk = max(1, int(max_chunk))
+        self.heartbeat = heartbeat
+        self.epoch = str(int(time.time()))
+        self.frames: List[Optional[str]] = [None] * self.size
+        self.newest = 0  # seq of the last published event; events are 1, 2, ...
+        self.clients = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed = asyncio.Event()
+        Gauge("stream_hub_clients", "Connected /stream clients", fn=lambda: self.clients)
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Event loop that serves the clients; publish_threadsafe schedules onto it."""
+        self._loop = loop
+
+    # ==========
+    # PUBLISHING
+    # ==========
+
+    def publish(self, event: Dict[str, Any]):
+        """Adds an event; call on the hub's event loop."""
+        self._append(json.dumps(event, ensure_ascii=False, separators=(",", ":")))
+
+    def publish_threadsafe(self, event: Dict[str, Any]):
+        """publish() from any thread; the JSON encoding happens in the caller."""
+        if self._loop is None:
+            return
+        data = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+        try:
+            self._loop.call_soon_threadsafe(self._append, data)
+        except RuntimeError:
+            pass  # loop closed during shutdown
+
+    def _append(self, data: str):
+        self.newest += 1
+        self.frames[self.newest % self.size] = f"id: {self.epoch}:{self.newest}\ndata: {data}\n\n"
+        PUBLISHED.inc()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    # =======
+    # CLIENTS
+    # =======
+
+    def _oldest(self) -> int:
+        return max(1, self.newest - self.size + 1)
+
+    def cursor_for(self, last_event_id: Optional[str], backlog: int = 0) -> int:
+        """Seq after which a client starts: its Last-Event-ID, else the last `backlog` events."""
+        if last_event_id:
+            epoch, _, seq = last_event_id.strip().partition(":")
+            if epoch == self.epoch and seq.isdigit():
+                return min(int(seq), self.newest)
+            return self._oldest() - 1  # id from another process: replay what we have
+        return max(self._oldest() - 1, self.newest - max(0, backlog))
+
+    async def events(self, cursor: int) -> AsyncIterator[str]:
+        """SSE chunks for one client, starting after seq `cursor`; runs until cancelled."""
+        self.clients += 1
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                if cursor >= self.newest:
+                    changed = self._changed
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.heartbeat)
+                    except asyncio.TimeoutError:
+                        yield ": ping\n\n"
+                    continue
+                oldest = self._oldest()
+                parts = []
+                if cursor < oldest - 1:
+                    DROPPED.inc(oldest - 1 - cursor)
+                    parts.append(f": dropped {oldest - 1 - cursor}\n\n")
+                    cursor = oldest - 1
+                end = min(self.newest, cursor + self.max_chunk)
+                parts.extend(self.frames[s % self.size] for s in range(cursor + 1, end + 1))
+                cursor = end
+                CHUNKS.inc()
+                yield "".join(parts)
+        finally:
+            self.clients -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"clients": self.clients, "newest": self.newest, "buffered": self.newest - self._oldest() + 1
+                if self.newest else 0, "size": self.size}
@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
-import argparse, csv, json, os, sys
+import argparse, json, os, sys, tempfile
 import numpy as np
+import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report
 from sklearn.model_selection import train_test_split
 import joblib
 
 from features import (
-    build_history, add_to_history,
+    build_history, add_to_history, to_int,
     tx_to_features_mem, ordered_feature_row, FEATURE_ORDER,
 )
+from batch_features import build_feature_matrix, map_unique
+from compact_forest import export_forest
+from feature_cache import (
+    cache_meta, invalidate_feature_cache, load_feature_cache, matrix_path,
+    merge_feature_cache, reusable_columns, save_feature_cache,
+)
+from parallel_features import CHUNK_ROWS, build_training_matrix
 
 def coerce_label(v):
     if v is None or str(v).strip() == "":
@@ -22,6 +30,71 @@ def coerce_label(v):
         if s in ("false", "no", "n", "f"): return 0
     return None
 
+def features_in_memory(args, order=FEATURE_ORDER):
+    """batch / stream engines: whole file in memory, sorted by time."""
+    # Load input as raw strings, exactly like csv.DictReader would see them
+    df = pd.read_csv(args.input, sep="|", dtype=str, keep_default_na=False)
+
+    # Sort chronologically so each row only sees past data
+    df["_ux"] = map_unique(df["unix_time"], lambda v: to_int(v) or 0, dtype=np.int64)
+    df = df.sort_values("_ux", kind="stable").drop(columns="_ux").reset_index(drop=True)
+    if args.limit > 0:
+        df = df.iloc[:args.limit]
+
+    labels = map_unique(df["is_fraud"], lambda v: coerce_label(v) or 0, dtype=np.int64)
+    labeled = map_unique(df["is_fraud"], lambda v: coerce_label(v) is not None, dtype=bool)
+
+    if args.engine == "batch":
+        X = build_feature_matrix(df, order)[labeled]
+    else:
+        history = build_history()
+        X_rows = []
+        for i, r in enumerate(df.to_dict("records"), 1):
+            if labeled[i - 1]:
+                X_rows.append(ordered_feature_row(tx_to_features_mem(r, history), order))
+            add_to_history(history, r)
+            history.maybe_evict()
+            if i % 10000 == 0:
+                print(f"...processed {i}", file=sys.stderr)
+        X = np.array(X_rows, dtype=float).reshape(-1, len(order))
+    return X, labels[labeled].astype(int)
+
+def compute_features(args, order, out_path=""):
+    """(X, y) for the given columns; the parallel engine writes X to out_path."""
+    if args.engine != "parallel":
+        return features_in_memory(args, order)
+    X, y = build_training_matrix(args.input, out_path, coerce_label, workers=args.workers,
+                                 limit=args.limit, chunksize=args.chunksize, order=order)
+    return X, y.astype(int)
+
+def fast_model():
+    """First-stage cascade model: a shallow forest, cheap enough to score everything."""
+    return RandomForestClassifier(
+        n_estimators=24,
+        max_depth=8,
+        min_samples_leaf=5,
+        max_features="sqrt",
+        n_jobs=-1,
+        random_state=42,
+        class_weight="balanced_subsample",
+    )
+
+def cascade_report(fast, full, X_test, y_test, threshold):
+    """Per-band share of test rows the fast tier decides alone, and what the cascade costs."""
+    p_fast = fast.predict_proba(X_test)[:, 1]
+    p_full = full.predict_proba(X_test)[:, 1]
+    base = p_full >= threshold
+    print(f"=== Cascade (fast tier -> full model, threshold {threshold}) ===")
+    print(f"{'band':>12} {'fast hit':>9} {'agree':>8} {'recall':>8} {'full recall':>12}")
+    frauds = max(int((y_test == 1).sum()), 1)
+    for low, high in ((0.01, 0.95), (0.02, 0.9), (0.05, 0.9), (0.1, 0.8), (0.2, 0.7)):
+        if not low <= threshold <= high:
+            continue
+        decided = (p_fast < low) | (p_fast > high)
+        flagged = np.where(decided, p_fast, p_full) >= threshold
+        print(f"{low:>5.2f}-{high:<6.2f} {decided.mean():>9.2%} {(flagged == base).mean():>8.4%} "
+              f"{(flagged & (y_test == 1)).sum() / frauds:>8.4f} {(base & (y_test == 1)).sum() / frauds:>12.4f}")
+
 def main():
     ap = argparse.ArgumentParser(description="Fast in-memory model trainer")
     ap.add_argument("--input", required=True, help="Pipe-delimited CSV with header")
@@ -29,46 +102,74 @@ def main():
     ap.add_argument("--output-model", default="model.pkl")
     ap.add_argument("--features", default="features.json")
     ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--engine", choices=("batch", "stream", "parallel"), default="batch",
+                    help="batch: columnar feature builder; stream: row-by-row online path; "
+                         "parallel: chunked input, per-card partitions built in a process pool")
+    ap.add_argument("--workers", type=int, default=0, help="parallel engine: processes (0 = all cores)")
+    ap.add_argument("--chunksize", type=int, default=CHUNK_ROWS, help="parallel engine: rows per read")
+    ap.add_argument("--feature-cache", default="",
+                    help="Directory caching the feature matrix; reused while input content, limit, "
+                         "feature list and feature code match")
+    ap.add_argument("--reuse-cached-columns", action="store_true",
+                    help="With --feature-cache: keep cached columns after a feature code change "
+                         "and compute only columns the cache lacks")
+    ap.add_argument("--export-forest", default="",
+                    help="Also write the forest as memory-mappable arrays to this directory")
+    ap.add_argument("--fast-model", default="",
+                    help="Also train the first-stage cascade model and save it here (FRAUD_FAST_MODEL)")
+    ap.add_argument("--export-fast-forest", default="",
+                    help="Also write the fast model as memory-mappable arrays to this directory")
+    ap.add_argument("--threshold", type=float, default=float(os.getenv("THRESHOLD", "0.35")),
+                    help="Flagging threshold the cascade report is computed at")
     args = ap.parse_args()
 
     # Ignore --db but print note for clarity
     if os.path.exists(args.db):
         print(f"[INFO] Ignoring SQLite DB '{args.db}' (in-memory mode)", file=sys.stderr)
 
-    # Load input
-    with open(args.input, "r", encoding="utf-8") as f:
-        rdr = csv.DictReader(f, delimiter="|")
-        rows = list(rdr)
-
-    if "is_fraud" not in (rdr.fieldnames or []):
+    header = pd.read_csv(args.input, sep="|", dtype=str, nrows=0)
+    if "is_fraud" not in header.columns:
         print("ERROR: Column 'is_fraud' not found in input CSV.", file=sys.stderr)
         sys.exit(1)
 
-    # Sort chronologically so each row only sees past data
-    rows.sort(key=lambda r: int(float(r.get("unix_time", "0"))) if r.get("unix_time") else 0)
-    if args.limit > 0:
-        rows = rows[:args.limit]
-
-    history = build_history()
-    X_rows, y_rows = [], []
-
-    for i, r in enumerate(rows, 1):
-        y = coerce_label(r.get("is_fraud"))
-        if y is not None:
-            feat = tx_to_features_mem(r, history)
-            X_rows.append(ordered_feature_row(feat, FEATURE_ORDER))
-            y_rows.append(y)
-        add_to_history(history, r)
-        if i % 10000 == 0:
-            print(f"...processed {i}", file=sys.stderr)
-
-    if not X_rows:
+    X = y = None
+    scratch = None
+    if args.feature_cache:
+        meta = cache_meta(args.input, args.limit, FEATURE_ORDER)
+        cached = load_feature_cache(args.feature_cache, meta)
+        if cached is not None:
+            X, y = cached
+            print(f"[INFO] Using cached features from '{args.feature_cache}' ({len(y)} rows)", file=sys.stderr)
+        else:
+            partial = reusable_columns(args.feature_cache, meta, trust_code=args.reuse_cached_columns)
+            if partial is not None:
+                X_old, y, kept = partial
+                missing = [f for f in FEATURE_ORDER if f not in kept]
+                print(f"[INFO] Reusing {len(FEATURE_ORDER) - len(missing)} cached feature columns, "
+                      f"computing {len(missing)}: {', '.join(missing) or '-'}", file=sys.stderr)
+                parts = [(X_old, kept)]
+                if missing:
+                    if args.engine == "parallel":
+                        fd, scratch = tempfile.mkstemp(suffix=".npy", dir=args.feature_cache)
+                        os.close(fd)
+                    X_new, y = compute_features(args, missing, scratch)
+                    parts.append((X_new, missing))
+                X = merge_feature_cache(args.feature_cache, meta, y, parts)
+            else:
+                invalidate_feature_cache(args.feature_cache)
+                os.makedirs(args.feature_cache, exist_ok=True)
+                X, y = compute_features(args, FEATURE_ORDER, matrix_path(args.feature_cache))
+                save_feature_cache(args.feature_cache, X, y, meta)
+    else:
+        if args.engine == "parallel":
+            fd, scratch = tempfile.mkstemp(suffix=".npy")
+            os.close(fd)
+        X, y = compute_features(args, FEATURE_ORDER, scratch)
+
+    if len(y) == 0:
         print("No labeled rows found.", file=sys.stderr)
         sys.exit(1)
 
-    X = np.array(X_rows, dtype=float)
-    y = np.array(y_rows, dtype=int)
-
     try:
         X_train, X_test, y_train, y_test = train_test_split(
             X, y, test_size=0.20, random_state=42, stratify=y
@@ -97,7 +198,22 @@ def main():
 
     print(f"Saved model -> {args.output_model}")
     print(f"Saved feature names -> {args.features}")
+    if args.export_forest:
+        meta = export_forest(model, args.export_forest)
+        print(f"Saved compact forest ({meta['n_nodes']} nodes) -> {args.export_forest}")
+    if args.fast_model or args.export_fast_forest:
+        fast = fast_model()
+        fast.fit(X_train, y_train)
+        cascade_report(fast, model, X_test, y_test, args.threshold)
+        if args.fast_model:
+            joblib.dump(fast, args.fast_model)
+            print(f"Saved fast model -> {args.fast_model}")
+        if args.export_fast_forest:
+            meta = export_forest(fast, args.export_fast_forest)
+            print(f"Saved compact fast forest ({meta['n_nodes']} nodes) -> {args.export_fast_forest}")
     print(f"Train size: {len(y_train)} | Test size: {len(y_test)}")
+    if scratch is not None:
+        os.remove(scratch)
 
 if __name__ == "__main__":
     main()
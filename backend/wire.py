@@ -0,0 +1,164 @@
+"""
+Wire formats of the prediction API.
+
+Transaction is the request body: known fields are coerced like
+features.to_float / to_int do (blank or unparseable values become None, so
+such rows are still scored) and unknown ones are passed through. Verdict
+and BatchVerdicts describe the responses; a batch item that could not be
+scored is an ItemError instead. encode() writes them in the media type
+picked by negotiate() from the Accept header:
+
+  application/json          default; orjson when installed, else json
+  application/msgpack       when msgpack is installed
+  application/octet-stream  little-endian float32 matrix, one row per
+                            verdict: proba (NaN if none), is_fraud, then the
+                            features when requested; all NaN for an error.
+                            X-Fraud-Columns names the columns, X-Fraud-Rows
+                            counts the rows.
+
+Features are only sent when asked for (?features=1).
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from pydantic import BaseModel, BeforeValidator, ConfigDict
+from typing_extensions import Annotated
+
+try:
+    import orjson
+except ImportError:  # plain json fallback
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+FLOAT32 = "application/octet-stream"
+_ALIASES = {"application/x-msgpack": MSGPACK, "*/*": JSON, "application/*": JSON}
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# =======
+# SCHEMAS
+# =======
+
+def _float(v):
+    try:
+        return None if v is None or v == "" else float(v)
+    except Exception:
+        return None
+
+def _int(v):
+    v = _float(v)
+    try:
+        return None if v is None else int(v)
+    except Exception:  # inf / nan
+        return None
+
+def _text(v):
+    return None if v is None else str(v)
+
+Num = Annotated[Optional[float], BeforeValidator(_float)]
+Int = Annotated[Optional[int], BeforeValidator(_int)]
+Text = Annotated[Optional[str], BeforeValidator(_text)]
+
+class Transaction(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    unix_time: Int = None
+    trans_num: Text = None
+    trans_date: Text = None
+    trans_time: Text = None
+    ssn: Text = None
+    cc_num: Text = None
+    acct_num: Text = None
+    first: Text = None
+    last: Text = None
+    gender: Text = None
+    street: Text = None
+    city: Text = None
+    state: Text = None
+    zip: Text = None
+    lat: Num = None
+    long: Num = None
+    city_pop: Int = None
+    job: Text = None
+    dob: Text = None
+    category: Text = None
+    amt: Num = None
+    merchant: Text = None
+    merch_lat: Num = None
+    merch_long: Num = None
+
+    def as_tx(self) -> Dict[str, Any]:
+        """The fields the caller sent, as the plain dict the scorer takes."""
+        return self.model_dump(exclude_unset=True)
+
+class Verdict(BaseModel):
+    is_fraud: bool
+    proba: Optional[float] = None
+    tier: Optional[str] = None
+    features: Optional[Dict[str, float]] = None
+
+class ItemError(BaseModel):
+    error: str
+
+class BatchVerdicts(BaseModel):
+    results: List[Union[Verdict, ItemError]]
+
+# ========
+# ENCODING
+# ========
+
+def negotiate(accept: Optional[str]) -> str:
+    """First supported media type in the Accept header (quality values ignored); JSON otherwise."""
+    for part in (accept or "").split(","):
+        media = part.split(";", 1)[0].strip().lower()
+        media = _ALIASES.get(media, media)
+        if media == JSON or media == FLOAT32 or (media == MSGPACK and msgpack is not None):
+            return media
+    return JSON
+
+def lean(verdict: Dict[str, Any], features: bool) -> Dict[str, Any]:
+    if features or "features" not in verdict:
+        return verdict
+    return {k: v for k, v in verdict.items() if k != "features"}
+
+def encode(verdicts: List[Dict[str, Any]], media: str, features: bool, batch: bool
+           ) -> Tuple[bytes, Dict[str, str]]:
+    """Response body and extra headers for one verdict (batch=False) or a list of them."""
+    if media == FLOAT32:
+        first = next((v for v in verdicts if "error" not in v), {})
+        names = list(first.get("features", {})) if features else []
+        m = np.empty((len(verdicts), 2 + len(names)), dtype="<f4")
+        for i, v in enumerate(verdicts):
+            if "error" in v:
+                m[i] = np.nan
+                continue
+            m[i, 0] = np.nan if v.get("proba") is None else v["proba"]
+            m[i, 1] = 1.0 if v.get("is_fraud") else 0.0
+            if names:
+                m[i, 2:] = [v["features"].get(k, 0.0) for k in names]
+        return m.tobytes(), {"X-Fraud-Columns": ",".join(["proba", "is_fraud"] + names),
+                             "X-Fraud-Rows": str(len(verdicts))}
+    body: Any = [lean(v, features) for v in verdicts]
+    body = {"results": body} if batch else body[0]
+    if media == MSGPACK:
+        return msgpack.packb(body, use_bin_type=True), {}
+    return dumps(body), {}
+
+def decode_float32(body: bytes, columns: str) -> List[Dict[str, Any]]:
+    """Client side of FLOAT32: one dict per row keyed by X-Fraud-Columns."""
+    names = columns.split(",")
+    m = np.frombuffer(body, dtype="<f4").reshape(-1, len(names))
+    return [dict(zip(names, row.tolist())) for row in m]
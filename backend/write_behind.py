@@ -0,0 +1,189 @@
+"""
+Write-behind persistence of stored transactions (memory history mode).
+
+The in-memory history is updated on the request path, so later predictions
+see a transaction at once; its tx row is handed to a WriteBehind whose
+thread group-commits rows with one executemany per SQLite transaction.
+A batch is written as soon as max_batch rows are pending or the oldest has
+waited max_delay_ms. Crash safety is set by those two limits plus sync, the
+writer connection's synchronous pragma: with WAL, NORMAL (default) survives
+a process crash but may lose the last commits on power loss, FULL fsyncs
+every commit, OFF leaves it to the OS.
+
+The queue is bounded (max_pending rows): a stalled disk slows submitters
+down instead of growing memory. A batch whose commit fails is retried with
+backoff (retries times); only then are its rows dropped, counted and
+reported in stats()["last_error"]. flush() waits until everything submitted so
+far is committed; close() flushes and stops the thread.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from features import EVICT_EVERY, compact_history, connect_db, ensure_schema, insert_txs
+from logs import get_logger
+from metrics import Counter, Histogram
+
+SYNC_MODES = ("OFF", "NORMAL", "FULL")
+
+log = get_logger("write_behind")
+
+COMMIT_SECONDS = Histogram("fraud_write_behind_commit_seconds", "Time per group commit of tx rows")
+ROWS_WRITTEN = Counter("fraud_write_behind_rows_total", "tx rows handled by the writer", ["result"])
+
+_STOP = object()
+
+class WriteBehind:
+    def __init__(self, db_path: str, max_batch: int = 1000, max_delay_ms: float = 50.0,
+                 sync: str = "NORMAL", max_pending: int = 100_000, ttl: int = 0,
+                 retries: int = 5, retry_delay: float = 0.1, name: str = "write-behind"):
+        """ttl > 0 compacts tx rows that much older than the newest one, as FRAUD_DB_TTL does."""
+        sync = sync.upper()
+        if sync not in SYNC_MODES:
+            raise ValueError(f"Unknown sync mode '{sync}' (expected one of {', '.join(SYNC_MODES)})")
+        self.db_path = db_path
+        self.max_batch = max(1, int(max_batch))
+        self.max_delay = max(0.0, float(max_delay_ms)) / 1000.0
+        self.sync = sync
+        self.ttl = ttl
+        self.retries = max(0, int(retries))
+        self.retry_delay = max(0.0, float(retry_delay))
+        # Items: (tx, submitted_at), or a threading.Event flush marker, or _STOP.
+        self._q: "queue.Queue" = queue.Queue(maxsize=max(1, int(max_pending)))
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "written": 0, "failed": 0, "retries": 0, "batches": 0,
+                       "max_batch_seen": 0, "lag_s_max": 0.0, "last_error": None}
+        self._since_compact = 0
+        self._ready = threading.Event()
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, txs: List[Dict[str, Any]]):
+        """Queues txs for insertion in order; blocks while max_pending rows are waiting."""
+        now = time.perf_counter()
+        for tx in txs:
+            self._q.put((tx, now))
+        with self._lock:
+            self._stats["submitted"] += len(txs)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every row submitted before the call is committed; False on timeout."""
+        done = threading.Event()
+        self._q.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        self._q.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+        out["queue_depth"] = self._q.qsize()
+        out["max_batch"] = self.max_batch
+        out["max_delay_ms"] = self.max_delay * 1000.0
+        out["sync"] = self.sync
+        return out
+
+    # ===========
+    # WRITER LOOP
+    # ===========
+
+    def _collect(self, first):
+        """Rows up to max_batch / max_delay after first; stops early at a marker or _STOP."""
+        rows, markers = [first], []
+        deadline = first[1] + self.max_delay
+        while len(rows) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                nxt = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is _STOP:
+                self._q.put(_STOP)
+                break
+            if isinstance(nxt, threading.Event):
+                markers.append(nxt)
+                break
+            rows.append(nxt)
+        return rows, markers
+
+    def _insert(self, conn: sqlite3.Connection, rows) -> bool:
+        """One group commit, retried with doubling delays; False once retries run out."""
+        txs = [tx for tx, _ in rows]
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                with conn:
+                    insert_txs(conn, txs, commit=False)
+                return True
+            except sqlite3.Error as e:
+                with self._lock:
+                    self._stats["last_error"] = f"{type(e).__name__}: {e}"
+                if attempt == self.retries:
+                    log.error("Write-behind batch of %d rows failed after %d attempts, dropping it: %s",
+                              len(rows), attempt + 1, e)
+                    return False
+                log.error("Write-behind batch of %d rows failed (attempt %d of %d), retrying in %.2fs: %s",
+                          len(rows), attempt + 1, self.retries + 1, delay, e)
+                with self._lock:
+                    self._stats["retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        return False
+
+    def _write(self, conn: sqlite3.Connection, rows):
+        t0 = time.perf_counter()
+        if not self._insert(conn, rows):
+            ROWS_WRITTEN.labels("failed").inc(len(rows))
+            with self._lock:
+                self._stats["failed"] += len(rows)
+            return
+        done = time.perf_counter()
+        COMMIT_SECONDS.observe(done - t0)
+        ROWS_WRITTEN.labels("written").inc(len(rows))
+        with self._lock:
+            st = self._stats
+            st["written"] += len(rows)
+            st["batches"] += 1
+            st["max_batch_seen"] = max(st["max_batch_seen"], len(rows))
+            st["lag_s_max"] = max(st["lag_s_max"], done - rows[0][1])
+
+        self._since_compact += len(rows)
+        if self.ttl and self._since_compact >= EVICT_EVERY:
+            self._since_compact = 0
+            newest = conn.execute("SELECT MAX(unix_time) FROM tx").fetchone()[0]
+            if newest is not None:
+                compact_history(conn, newest - self.ttl)
+
+    def _loop(self):
+        try:
+            conn = connect_db(self.db_path)
+            conn.execute(f"PRAGMA synchronous={self.sync}")
+            ensure_schema(conn)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            while True:
+                first = self._q.get()
+                if first is _STOP:
+                    return
+                if isinstance(first, threading.Event):
+                    first.set()
+                    continue
+                rows, markers = self._collect(first)
+                self._write(conn, rows)
+                for m in markers:
+                    m.set()
+        finally:
+            conn.close()
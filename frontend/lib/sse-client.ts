@@ -4,7 +4,8 @@ export function SSEClient(
   onError: (error: any) => void,
   onDisconnect?: () => void
 ) {
-	  const eventSource = new EventSource("/api/stream");
+	  // NEXT_PUBLIC_STREAM_URL points at fraud_api's /stream hub instead of the Next.js route.
+	  const eventSource = new EventSource(process.env.NEXT_PUBLIC_STREAM_URL || "/api/stream");
 	  
 	  eventSource.onmessage = (event) => {
 	    const data = JSON.parse(event.data);